@@ -0,0 +1,171 @@
+"""
+Benchmark of decoding and reading documents.
+
+Measures, for documents shaped like those of a busy lobby:
+
+- decoding a lobby, and a page of events
+- the read made by a session check on a cache miss: the whole lobby, as
+  before, or the `LobbySummary` projection
+
+Reads go to the MongoDB server at `MONGODB_HOST` (a local server, unless
+set), or to the in-memory storage with `--storage memory`. One lobby is
+inserted into the database, and removed again afterwards.
+
+Run from the repository root with `python -m benchmarks.decode`.
+"""
+
+# stdlib imports
+import argparse
+import asyncio
+import datetime
+import os
+import time
+import typing
+
+# vendor imports
+
+# local imports
+
+os.environ.setdefault(
+    "MONGODB_HOST", "mongodb://localhost:27017/lobbyopoly_benchmark"
+)
+
+from server import model  # noqa: E402
+
+
+def make_lobby(players: int) -> model.db.Lobby:
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    lobby = model.db.Lobby(
+        code="BNCH",
+        created=now,
+        expires=now + datetime.timedelta(hours=24),
+        disbanded=False,
+        options=model.db.CreateLobbyForm(
+            unlimitedBank=False,
+            freeParking=True,
+            maxPlayers=players,
+            bankBalance=20580,
+            startingBalance=1500,
+            currency=model.db.LobbyCurrency.Dollars,
+        ),
+        bank=20580 - players * 1500,
+        freeParking=0,
+        banker=None,
+        players=[],
+    )
+    lobby.players = [
+        model.db.Player(name=f"Player {i}", balance=1500)
+        for i in range(players)
+    ]
+    lobby.banker = lobby.players[0].id
+    return lobby
+
+
+def make_events(lobby: model.db.Lobby, count: int) -> list[model.db.Event]:
+    return [
+        model.db.Event(
+            lobby=lobby.id,
+            time=lobby.created + datetime.timedelta(seconds=i),
+            key="EVENT_TRANSFER",
+            inserts=[
+                ["player", lobby.players[i % len(lobby.players)].id],
+                ["currency", i],
+                ["bundle", "TRANSFER_BANK"],
+            ],
+        )
+        for i in range(count)
+    ]
+
+
+def timed(function: typing.Callable[[], typing.Any], rounds: int) -> float:
+    """Mean seconds per call of `function`."""
+    started = time.perf_counter()
+    for _ in range(rounds):
+        function()
+    return (time.perf_counter() - started) / rounds
+
+
+async def timed_async(
+    function: typing.Callable[[], typing.Awaitable[typing.Any]], rounds: int
+) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        await function()
+    return (time.perf_counter() - started) / rounds
+
+
+async def run(args: argparse.Namespace) -> list[tuple[str, float]]:
+    """Mean seconds of each measurement."""
+    lobby = make_lobby(args.players)
+    document = lobby.document()
+    events = [event.document() for event in make_events(lobby, args.events)]
+
+    results = [
+        (
+            "lobby",
+            timed(
+                lambda: model.db.Lobby.model_validate(document), args.rounds
+            ),
+        ),
+        (
+            f"{args.events} events",
+            timed(
+                lambda: [model.db.Event.model_validate(e) for e in events],
+                args.rounds // 10,
+            ),
+        ),
+    ]
+
+    model.db.storage_backend = args.storage
+    await model.db.connect_and_init_db()
+    storage = model.db.get_storage()
+    try:
+        await storage.insert_many(model.storage.LOBBIES, [document])
+        now = datetime.datetime.utcnow()
+        projection = model.db.LobbySummary.projection
+
+        for name, decode, projected in [
+            ("session read", model.db.Lobby.model_validate, False),
+            (
+                "session read, projected",
+                model.db.LobbySummary.model_validate,
+                True,
+            ),
+        ]:
+
+            async def read():
+                return decode(
+                    await storage.find_lobby(
+                        lobby.id,
+                        now=now,
+                        projection=projection if projected else None,
+                    )
+                )
+
+            results.append((name, await timed_async(read, args.reads)))
+    finally:
+        await storage.remove_lobbies([document], None)
+        await model.db.close_db_connect()
+
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--players", type=int, default=8)
+    parser.add_argument("--events", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=20000)
+    parser.add_argument("--reads", type=int, default=2000)
+    parser.add_argument(
+        "--storage", choices=["mongo", "memory"], default="mongo"
+    )
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    print(f"\n{'':>28} {'us':>10}")
+    for name, seconds in results:
+        print(f"{name:>28} {seconds * 1e6:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,406 @@
+"""
+Load benchmark of the API and the WebSocket fan-out.
+
+Drives the application in-process: HTTP requests go through httpx's ASGI
+transport, and WebSockets through a minimal ASGI client, so no server or
+network is involved. Each simulated lobby is created by its banker and joined
+by up to `maxPlayers` clients, each with a socket attached. The clients then
+make random transfers, the players leave, and the banker disbands the lobby.
+
+Lobbies run concurrently, but the requests within a lobby are made one at a
+time. After every request that changes a lobby, the benchmark waits for each
+of the lobby's sockets to receive the broadcast, and records the delivery
+latency from the start of the request.
+
+By default, documents are stored in the MongoDB server at `MONGODB_HOST` (a
+local server, unless set). Use a throwaway database, as the benchmark leaves
+lobbies behind. Pass `--storage memory` to use the in-memory storage instead.
+
+Run from the repository root with `python -m benchmarks.load`. See `--help`
+for the options. Results are saved as JSON, and can be compared with an
+earlier run with `--compare`.
+"""
+
+# stdlib imports
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import pathlib
+import random
+import time
+import typing
+
+# vendor imports
+import httpx
+
+# local imports
+
+os.environ.setdefault(
+    "MONGODB_HOST", "mongodb://localhost:27017/lobbyopoly_benchmark"
+)
+
+from server import model  # noqa: E402
+from server.main import app  # noqa: E402
+
+# Seconds to wait for a socket to receive a broadcast before counting it lost
+DELIVERY_TIMEOUT = 5.0
+
+Samples = dict[str, list[float]]
+
+PING = '{"type":"ping"}'
+PONG = '{"type":"pong"}'
+
+
+class Socket:
+    """Minimal in-process ASGI WebSocket client."""
+
+    def __init__(self, path: str, query: str = "") -> None:
+        self.path = path
+        self.query = query
+        self.messages: asyncio.Queue[tuple[float, typing.Any]] = (
+            asyncio.Queue()
+        )
+        self.closed = False
+        self._incoming: asyncio.Queue[dict] = asyncio.Queue()
+        self._receives = 0
+        self._listening = asyncio.Event()
+        self._task: typing.Optional[asyncio.Task] = None
+
+    async def _receive(self) -> dict:
+        # The endpoint registers the socket before it first waits for a
+        # message from the client (after the initial connect message)
+        self._receives += 1
+        if self._receives == 2:
+            self._listening.set()
+        return await self._incoming.get()
+
+    async def _send(self, message: dict) -> None:
+        if message["type"] == "websocket.send":
+            # Answer heartbeats, like clients do
+            if message.get("text") == PING:
+                self._incoming.put_nowait(
+                    {"type": "websocket.receive", "text": PONG}
+                )
+                return
+            self.messages.put_nowait(
+                (time.perf_counter(), message.get("bytes") or message["text"])
+            )
+        elif message["type"] == "websocket.close":
+            self.closed = True
+
+    async def connect(self) -> None:
+        """Connect, and wait until the socket is registered for updates."""
+        scope = {
+            "type": "websocket",
+            "asgi": {"version": "3.0"},
+            "scheme": "ws",
+            "path": self.path,
+            "raw_path": self.path.encode(),
+            "root_path": "",
+            "query_string": self.query.encode(),
+            "headers": [(b"host", b"benchmark")],
+            "client": ("127.0.0.1", 0),
+            "server": ("benchmark", 80),
+            "subprotocols": [],
+        }
+        self._incoming.put_nowait({"type": "websocket.connect"})
+        self._task = asyncio.create_task(app(scope, self._receive, self._send))
+        listening = asyncio.create_task(self._listening.wait())
+        await asyncio.wait(
+            [self._task, listening], return_when=asyncio.FIRST_COMPLETED
+        )
+        listening.cancel()
+
+        # Discard the history sent on connection
+        while not self.messages.empty():
+            self.messages.get_nowait()
+
+    async def close(self) -> None:
+        self._incoming.put_nowait(
+            {"type": "websocket.disconnect", "code": 1000}
+        )
+        if self._task is not None:
+            try:
+                await self._task
+            except Exception:
+                pass
+
+
+class Client:
+    """A player, with their own session cookie and socket."""
+
+    def __init__(self, name: str, samples: Samples) -> None:
+        self.name = name
+        self.samples = samples
+        self.http = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app, raise_app_exceptions=False),
+            base_url="http://benchmark",
+        )
+        self.socket: typing.Optional[Socket] = None
+        self.player: typing.Optional[str] = None
+
+    async def request(
+        self, route: str, method: str, url: str, **kwargs
+    ) -> typing.Any:
+        """Make a request, recording its latency under `route`."""
+        started = time.perf_counter()
+        response = await self.http.request(method, url, **kwargs)
+        elapsed = time.perf_counter() - started
+        self.samples.setdefault(route, []).append(elapsed)
+
+        body = response.json() if response.status_code == 200 else None
+        if body is None or body["error"] is not None:
+            self.samples.setdefault(f"{route}:errors", []).append(elapsed)
+        return body
+
+    async def close(self) -> None:
+        if self.socket is not None:
+            await self.socket.close()
+        await self.http.aclose()
+
+
+async def expect_broadcast(
+    started: float, sockets: list[Socket], samples: Samples
+) -> None:
+    """Wait for every socket to receive a broadcast started at `started`."""
+
+    async def receive(socket: Socket) -> None:
+        try:
+            received, _ = await asyncio.wait_for(
+                socket.messages.get(), DELIVERY_TIMEOUT
+            )
+            samples.setdefault("broadcast", []).append(received - started)
+        except asyncio.TimeoutError:
+            samples.setdefault("broadcast:lost", []).append(DELIVERY_TIMEOUT)
+
+    await asyncio.gather(*(receive(socket) for socket in sockets))
+
+
+async def mutate(
+    client: Client,
+    lobby: list[Client],
+    samples: Samples,
+    route: str,
+    method: str,
+    url: str,
+    **kwargs,
+) -> typing.Any:
+    """Make a request that changes the lobby, and wait for its broadcast."""
+    sockets = [
+        member.socket
+        for member in lobby
+        if member.socket is not None and not member.socket.closed
+    ]
+    started = time.perf_counter()
+    body = await client.request(route, method, url, **kwargs)
+    if body is not None and body["error"] is None:
+        await expect_broadcast(started, sockets, samples)
+    return body
+
+
+async def run_lobby(
+    index: int, players: int, transfers: int, deltas: bool, samples: Samples
+) -> None:
+    banker = Client(f"Banker {index}", samples)
+    clients = [banker] + [
+        Client(f"Player {index}.{i}", samples) for i in range(1, players)
+    ]
+    lobby: list[Client] = []
+    query = "deltas=true" if deltas else ""
+
+    try:
+        created = await banker.request(
+            "create",
+            "POST",
+            "/api/create",
+            json={
+                "unlimitedBank": False,
+                "freeParking": True,
+                "maxPlayers": players,
+                "bankBalance": 20580,
+                "startingBalance": 1500,
+                "currency": "$",
+            },
+        )
+        if created is None or created["error"] is not None:
+            return
+        lobby_id, code = created["payload"]["id"], created["payload"]["code"]
+
+        # Everyone joins, and attaches a socket
+        for client in clients:
+            joined = await mutate(
+                client,
+                lobby,
+                samples,
+                "join",
+                "POST",
+                "/api/join",
+                json={"code": code, "name": client.name},
+            )
+            if joined is None or joined["error"] is not None:
+                continue
+            client.player = joined["payload"]["player"]
+            client.socket = Socket(f"/events/{lobby_id}", query)
+            await client.socket.connect()
+            lobby.append(client)
+
+        # Random transfers between the players, the bank and free parking
+        for _ in range(transfers):
+            client = random.choice(lobby)
+            others = [c.player for c in lobby if c is not client]
+            if client is banker and random.random() < 0.5:
+                source = random.choice(["__bank__", "__fp__"])
+                destination = random.choice(others or ["__fp__"])
+            else:
+                source = "__self__"
+                destination = random.choice(others + ["__fp__", "__bank__"])
+            await mutate(
+                client,
+                lobby,
+                samples,
+                "transfer",
+                "POST",
+                "/api/transfer",
+                json={
+                    "source": source,
+                    "destination": destination,
+                    "amount": random.randint(1, 50),
+                },
+            )
+
+        # The players leave, and the banker disbands the lobby
+        for client in list(lobby[1:]):
+            await mutate(client, lobby, samples, "leave", "GET", "/api/leave")
+            lobby.remove(client)
+            if client.socket is not None:
+                await client.socket.close()
+        await mutate(banker, lobby, samples, "disband", "GET", "/api/disband")
+    finally:
+        for client in clients:
+            await client.close()
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """Nearest-rank percentile of sorted `values`."""
+    rank = max(int(round(fraction * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def summarize(samples: Samples, seconds: float) -> dict[str, typing.Any]:
+    summary = {}
+    for name, values in sorted(samples.items()):
+        if ":" in name:
+            continue
+        values = sorted(values)
+        summary[name] = {
+            "count": len(values),
+            "errors": len(samples.get(f"{name}:errors", [])),
+            "lost": len(samples.get(f"{name}:lost", [])),
+            "throughput": round(len(values) / seconds, 2),
+            "mean_ms": round(sum(values) / len(values) * 1000, 3),
+            "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+            "p95_ms": round(percentile(values, 0.95) * 1000, 3),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+        }
+    return summary
+
+
+def report(
+    results: dict[str, typing.Any],
+    baseline: typing.Optional[dict[str, typing.Any]] = None,
+) -> None:
+    print(
+        f"{results['config']['lobbies']} lobbies in "
+        f"{results['seconds']:.2f}s\n"
+    )
+    print(
+        f"{'':>10} {'count':>7} {'errors':>6} {'/s':>8} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+        + (f" {'p95 vs base':>12}" if baseline else "")
+    )
+    for name, stats in results["metrics"].items():
+        line = (
+            f"{name:>10} {stats['count']:>7} "
+            f"{stats['errors'] + stats['lost']:>6} "
+            f"{stats['throughput']:>8.1f} {stats['p50_ms']:>8.2f} "
+            f"{stats['p95_ms']:>8.2f} {stats['p99_ms']:>8.2f}"
+        )
+        base = (baseline or {}).get("metrics", {}).get(name)
+        if base:
+            change = (stats["p95_ms"] / base["p95_ms"] - 1) * 100
+            line += f" {change:>+11.1f}%"
+        print(line)
+
+
+async def run(args: argparse.Namespace) -> dict[str, typing.Any]:
+    random.seed(args.seed)
+    samples: Samples = {}
+    model.db.storage_backend = args.storage
+
+    await app.router.startup()
+    try:
+        started = time.perf_counter()
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def limited(index: int) -> None:
+            async with semaphore:
+                await run_lobby(
+                    index, args.players, args.transfers, args.deltas, samples
+                )
+
+        await asyncio.gather(*(limited(i) for i in range(args.lobbies)))
+        seconds = time.perf_counter() - started
+    finally:
+        await app.router.shutdown()
+
+    return {
+        "date": datetime.datetime.utcnow().isoformat(),
+        "config": vars(args) | {"output": None, "compare": None},
+        "seconds": round(seconds, 3),
+        "metrics": summarize(samples, seconds),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--lobbies", type=int, default=20)
+    parser.add_argument("--players", type=int, default=6)
+    parser.add_argument("--transfers", type=int, default=50)
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=10,
+        help="number of lobbies running at once",
+    )
+    parser.add_argument(
+        "--deltas", action="store_true", help="ask sockets for deltas"
+    )
+    parser.add_argument(
+        "--storage", choices=["mongo", "memory"], default="mongo"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output",
+        type=pathlib.Path,
+        default=pathlib.Path("benchmarks/results/load.json"),
+    )
+    parser.add_argument(
+        "--compare",
+        type=pathlib.Path,
+        help="results of an earlier run, to compare against",
+    )
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    baseline = json.loads(args.compare.read_text()) if args.compare else None
+    report(results, baseline)
+
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    args.output.write_text(json.dumps(results, indent=2))
+    print(f"\nResults saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
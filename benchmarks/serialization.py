@@ -0,0 +1,95 @@
+"""
+Micro-benchmark of update message encoding.
+
+Compares the `bson.json_util` encoder with the pydantic-core encoder used by
+`compose_update_message`, for a lobby of 8 players and 500 events.
+
+Run from the repository root with `python -m benchmarks.serialization`.
+"""
+
+# stdlib imports
+import datetime
+import json
+import timeit
+
+# vendor imports
+
+# local imports
+from server import messages, model, socket
+
+
+def make_lobby(players: int = 8) -> model.db.Lobby:
+    now = datetime.datetime.utcnow()
+    return model.db.Lobby(
+        code="0123",
+        created=now,
+        expires=now + datetime.timedelta(hours=24),
+        disbanded=False,
+        options=model.db.CreateLobbyForm(
+            unlimitedBank=False,
+            freeParking=True,
+            maxPlayers=players,
+            bankBalance=20580,
+            startingBalance=1500,
+            currency=model.db.LobbyCurrency.Dollars,
+        ),
+        players=[
+            model.db.Player(name=f"Player {i}", balance=1500)
+            for i in range(players)
+        ],
+        banker=None,
+        bank=20580 - 1500 * players,
+        freeParking=0,
+    )
+
+
+def make_events(lobby: model.db.Lobby, count: int = 500):
+    start = datetime.datetime.utcnow()
+    return [
+        model.db.Event(
+            lobby=lobby.id,
+            time=start + datetime.timedelta(milliseconds=1234 * i),
+            key="EVENT_TRANSFER",
+            inserts=[
+                ["player", lobby.players[i % len(lobby.players)].id],
+                ["currency", 50],
+                ["bundle", "TRANSFER_SELF"],
+                ["player", lobby.players[(i + 1) % len(lobby.players)].id],
+            ],
+        )
+        for i in range(count)
+    ]
+
+
+def encode(fast: bool, lobby, events) -> str:
+    messages.FAST_ENCODING = fast
+    return socket.compose_update_message(lobby, events).text()
+
+
+def main(number: int = 50) -> None:
+    lobby = make_lobby()
+    events = make_events(lobby)
+
+    # Both encoders must produce the same message
+    legacy = encode(False, lobby, events)
+    fast = encode(True, lobby, events)
+    assert json.loads(legacy) == json.loads(fast)
+
+    results = {}
+    for name, is_fast in (("bson.json_util", False), ("pydantic-core", True)):
+        seconds = min(
+            timeit.repeat(
+                lambda: encode(is_fast, lobby, events), number=number, repeat=5
+            )
+        )
+        results[name] = seconds / number * 1000
+        print(f"{name:>16}: {results[name]:8.3f} ms per message")
+
+    print(
+        f"{'speedup':>16}: "
+        f"{results['bson.json_util'] / results['pydantic-core']:8.1f}x"
+    )
+
+
+if __name__ == "__main__":
+    main()
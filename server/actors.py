@@ -0,0 +1,306 @@
+# stdlib imports
+import asyncio
+import os
+import typing
+
+# vendor imports
+
+# local imports
+from . import codes, metrics, model, socket, strings, transfer
+
+# Seconds an actor waits for a command before shutting down
+IDLE_TIMEOUT = float(os.environ.get("LOBBY_ACTOR_IDLE_TIMEOUT", 60))
+
+# Maximum number of queued commands coalesced into a single write
+BATCH_SIZE = int(os.environ.get("LOBBY_ACTOR_BATCH_SIZE", 64))
+
+# Attempts at a batch before giving up on repeated write conflicts
+MAX_ATTEMPTS = 5
+
+
+class LobbyUnavailable(Exception):
+    """Raised when a command targets a lobby that is gone or has expired."""
+
+
+class CommandRejected(Exception):
+    """
+    Raised by a command to reject itself with an error. Commands must raise
+    this before they have changed anything.
+    """
+
+    def __init__(self, error: strings.Bundle) -> None:
+        super().__init__(error.name)
+        self.error = error
+
+
+class CommandContext:
+    """
+    What a command sees while it runs: a working copy of the lobby, and the
+    writes queued by the commands of the same batch.
+
+    Commands that only move money call `transfer`, so that a batch of them
+    is committed as a single atomic `$inc` update. Any other change to the
+    lobby must be followed by `save`, which makes the batch replace the lobby
+    document instead (conditionally on its version).
+    """
+
+    def __init__(self, lobby: model.db.Lobby) -> None:
+        self.lobby = lobby
+        self.version = lobby.version
+        self.work = model.db.UnitOfWork()
+        self.transfers = transfer.TransferUpdate(lobby.id)
+        self.banker: typing.Optional[model.db.ObjectId] = None
+        self.kicked: list[model.db.Player] = []
+
+    def add_event(self, event: model.db.Event) -> model.db.Event:
+        """Queue a new event, to be inserted and broadcast with the batch."""
+        return self.work.add_event(event)
+
+    def save(self) -> None:
+        """Mark the lobby as changed beyond balances."""
+        self.work.save_lobby(self.lobby, if_version=self.version)
+
+    def transfer(
+        self,
+        source: transfer.Account,
+        destination: transfer.Account,
+        amount: int,
+        check_funds: bool = True,
+        banker: typing.Optional[model.db.ObjectId] = None,
+    ) -> None:
+        """
+        Move `amount` between two accounts. If `banker` is given, the write
+        only applies while that player is still the banker.
+        """
+        transfer.apply_transfer(self.lobby, source, destination, amount)
+        self.transfers.add(source, destination, amount, check_funds)
+        if banker is not None:
+            self.banker = banker
+
+    def kick(self, player: model.db.Player) -> None:
+        """Send a kick message to `player` once the batch is committed."""
+        self.kicked.append(player)
+
+
+# A command runs against the lobby state, and returns the result of the call
+Command = typing.Callable[[CommandContext], typing.Any]
+
+# A queued command, with the future of its result, and the metrics of the
+# request that submitted it
+Submission = tuple[
+    Command, asyncio.Future, typing.Optional[metrics.RequestMetrics]
+]
+
+
+class LobbyActor:
+    """
+    Single writer of a lobby within this process.
+
+    Commands are queued and applied in order by one task, which owns the
+    authoritative state of the lobby. Commands that arrive while a write is
+    in flight are coalesced, so that a burst is persisted with one write and
+    announced with one broadcast. The actor shuts down once it has been idle
+    for `IDLE_TIMEOUT` seconds.
+
+    Other processes may write to the same lobby, so every batch is committed
+    conditionally. If the lobby has changed underneath the actor, its state
+    is reloaded and the batch is run again. The state is also reloaded, and
+    the batch run again, before any command of it is rejected, in case the
+    rejection is down to writes the actor hasn't seen.
+    """
+
+    def __init__(self, lobby_id: model.db.ObjectId, registry: "ActorRegistry"):
+        self.lobby_id = lobby_id
+        self.registry = registry
+        self.lobby: typing.Optional[model.db.Lobby] = None
+        self.queue: asyncio.Queue[Submission] = asyncio.Queue()
+        self.task = asyncio.create_task(self._run())
+
+    def submit(self, command: Command) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((command, future, metrics.current_request.get()))
+        return future
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                batch = [
+                    await asyncio.wait_for(self.queue.get(), IDLE_TIMEOUT)
+                ]
+            except asyncio.TimeoutError:
+                # Nothing can be queued between this check and the removal,
+                # since neither awaits
+                if self.queue.empty():
+                    self.registry.remove(self)
+                    return
+                continue
+
+            while len(batch) < BATCH_SIZE and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            # Callers that have given up (e.g. on disconnect) are skipped
+            batch = [item for item in batch if not item[1].done()]
+            if not batch:
+                continue
+
+            # The storage operations of a batch are counted towards every
+            # request that submitted to it
+            routes = {request.route for _, _, request in batch if request}
+            counts = metrics.RequestMetrics(
+                route=",".join(sorted(filter(None, routes))) or None,
+                lobby=str(self.lobby_id),
+            )
+            token = metrics.current_request.set(counts)
+            try:
+                await self._apply(batch)
+            except Exception as error:
+                self.lobby = None
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(error)
+            finally:
+                metrics.current_request.reset(token)
+                for _, _, request in batch:
+                    if request is not None:
+                        request.add(counts)
+
+    async def _load(
+        self, reload: bool = False
+    ) -> typing.Optional[model.db.Lobby]:
+        """
+        The actor's state of the lobby. If the actor has none, it's taken
+        from the cache or the database. With `reload`, it's always read from
+        the database, since the cache only follows writes of this process.
+        """
+        if reload:
+            self.lobby = await model.db.Lobby.get_by_id(self.lobby_id)
+            if self.lobby is not None:
+                model.db.Lobby.cache.put(self.lobby)
+            return self.lobby
+
+        if self.lobby is None:
+            self.lobby = model.db.Lobby.cache.get(self.lobby_id)
+        if self.lobby is None:
+            self.lobby = await model.db.Lobby.get_by_id(self.lobby_id)
+        return self.lobby
+
+    async def _apply(self, batch: list[Submission]):
+        reload = False
+        for _ in range(MAX_ATTEMPTS):
+            lobby = await self._load(reload)
+            if lobby is None or not lobby.cacheable():
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(LobbyUnavailable())
+                return
+
+            # Commands run against a copy, so a failed write leaves the
+            # actor's state untouched
+            context = CommandContext(lobby.clone())
+            results: list[tuple[bool, typing.Any]] = []
+            for command, _, _ in batch:
+                try:
+                    results.append((True, command(context)))
+                except Exception as error:
+                    results.append((False, error))
+
+            rejected = any(
+                isinstance(result, CommandRejected) for _, result in results
+            )
+            if rejected and not reload:
+                reload = True
+                continue
+
+            try:
+                await self._commit(context)
+            except model.db.WriteConflict:
+                self.lobby = None
+                continue
+
+            # The batch is committed, so it succeeded even if announcing it
+            # fails. Sockets that miss the update resync on the next one.
+            try:
+                await self._broadcast(context)
+            except Exception as error:
+                print(
+                    "Broadcast of lobby {} failed: {!r}".format(
+                        self.lobby_id, error
+                    )
+                )
+            for (ok, result), (_, future, _) in zip(results, batch):
+                if future.done():
+                    continue
+                if ok:
+                    future.set_result(result)
+                else:
+                    future.set_exception(result)
+            return
+
+        raise model.db.WriteConflict()
+
+    async def _commit(self, context: CommandContext) -> None:
+        work = context.work
+        if work.lobby is None and context.transfers.increments:
+            work.apply_transfers(context.transfers, context.banker)
+            await work.commit()
+            context.lobby = typing.cast(model.db.Lobby, work.lobby)
+        elif work.lobby is not None or work.events:
+            await work.commit()
+        self.lobby = context.lobby
+
+    async def _broadcast(self, context: CommandContext) -> None:
+        lobby = context.lobby
+        if lobby.disbanded:
+            # Instead of broadcasting the events to players (what's the
+            # point?) we just broadcast a message to kick them all
+            codes.allocator.release(lobby.code)
+            model.db.removed_lobbies.add(lobby.id)
+            await socket.manager.broadcast_disband(lobby)
+            return
+
+        if context.work.lobby is not None or context.transfers.increments:
+            await socket.manager.broadcast_update(lobby, context.work.events)
+        for player in context.kicked:
+            model.db.removed_players.add(player.id)
+            await socket.manager.broadcast_kick(lobby, player)
+
+
+class ActorRegistry:
+    """The live lobby actors of this process."""
+
+    def __init__(self) -> None:
+        self.actors: dict[model.db.ObjectId, LobbyActor] = {}
+
+    def __len__(self) -> int:
+        return len(self.actors)
+
+    def remove(self, actor: LobbyActor) -> None:
+        if self.actors.get(actor.lobby_id) is actor:
+            del self.actors[actor.lobby_id]
+
+    def submit(
+        self, lobby_id: model.db.ObjectId, command: Command
+    ) -> asyncio.Future:
+        """Queue a command for a lobby, starting its actor if needed."""
+        actor = self.actors.get(lobby_id)
+        if actor is None:
+            actor = self.actors[lobby_id] = LobbyActor(lobby_id, self)
+        return actor.submit(command)
+
+    async def execute(
+        self, lobby_id: model.db.ObjectId, command: Command
+    ) -> typing.Any:
+        """Run a command for a lobby and wait for its result."""
+        return await self.submit(lobby_id, command)
+
+    async def stop(self) -> None:
+        for actor in list(self.actors.values()):
+            actor.task.cancel()
+        self.actors.clear()
+
+    async def collect_metrics(self):
+        return [(metrics.lobby_actors, (), len(self.actors))]
+
+
+registry = ActorRegistry()
+metrics.registry.add_collector(registry.collect_metrics, metrics.lobby_actors)
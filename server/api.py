@@ -1,38 +1,98 @@
 # stdlib imports
+import csv
 import datetime
-import random
+import hashlib
+import io
+import json
+import os
+import typing
 
 # vendor imports
 import fastapi
+import fastapi.responses
 
 # local imports
-from . import helpers, strings, model, socket
+from . import actors, codes, helpers, metrics, strings, model, transfer
 
 
-async def validateSession(request: fastapi.Request):
+# Sessions signed with another epoch are rejected. Changing it logs everyone
+# out, e.g. after the database has been wiped.
+SESSION_EPOCH = os.environ.get("SESSION_EPOCH", "1")
+
+
+def startSession(
+    request: fastapi.Request,
+    lobby_id: str,
+    player_id: str,
+    expires: datetime.datetime,
+):
+    request.session["lobbyId"] = lobby_id
+    request.session["playerId"] = player_id
+    request.session["expires"] = expires.isoformat()
+    request.session["epoch"] = SESSION_EPOCH
+
+
+async def validateSession(request: fastapi.Request, full: bool = True):
+    """
+    Check the session of a request, and return an error, or its lobby and
+    player. Lobbies are only read in full if `full` is set, so that a cache
+    miss also fills the cache for the command that follows. Otherwise, just
+    what identifies the lobby and its players is read.
+    """
     # Fetch the lobby id from the session
     lobby_id = request.session.get("lobbyId", None)
     if not lobby_id:
         return (strings.Bundle.ERROR_SESSION_INVALID, None, None)
 
-    db = model.db.get_db()
-    lobby_document = await db[model.db.Lobby.collection].find_one(
-        {
-            "_id": model.db.ObjectId(lobby_id),
-            "expires": {"$gt": datetime.datetime.utcnow()},
-            "disbanded": False,
-        }
-    )
+    # Reject sessions that can't be valid without going to the database.
+    # Sessions from before the expiry and epoch were stored are looked up.
+    epoch = request.session.get("epoch", SESSION_EPOCH)
+    if epoch != SESSION_EPOCH:
+        return (strings.Bundle.ERROR_SESSION_INVALID, None, None)
+    expires = request.session.get("expires", None)
+    now = datetime.datetime.utcnow()
+    if expires and datetime.datetime.fromisoformat(expires) <= now:
+        return (strings.Bundle.ERROR_LOBBY_INVALID, None, None)
 
-    if lobby_document is None:
+    lobby_id = model.db.ObjectId(lobby_id)
+    player_id = model.db.ObjectId(request.session.get("playerId", ""))
+    if lobby_id in model.db.removed_lobbies:
         return (strings.Bundle.ERROR_LOBBY_INVALID, None, None)
+    if player_id in model.db.removed_players:
+        return (strings.Bundle.ERROR_PLY_NOT_ACTIVE, None, None)
 
-    # Fetch the player from the lobby document
-    lobby = model.db.Lobby.parse_obj(lobby_document)
-    player = lobby.get_player(
-        model.db.ObjectId(request.session.get("playerId", ""))
-    )
+    # Check the lobby cache before going to the database
+    lobby: typing.Union[model.db.Lobby, model.db.LobbySummary, None]
+    lobby = model.db.Lobby.cache.get(lobby_id)
+    if lobby is not None and lobby.get_player(player_id) is None:
+        # The cached copy may be older than the player, if they joined
+        # through another process, so only the database can tell
+        model.db.Lobby.cache.invalidate(lobby_id)
+        lobby = None
+    if lobby is None:
+        lobby_document = await model.db.get_storage().find_lobby(
+            lobby_id,
+            now=now,
+            projection=None if full else model.db.LobbySummary.projection,
+        )
+
+        if lobby_document is None:
+            model.db.removed_lobbies.add(lobby_id)
+            return (strings.Bundle.ERROR_LOBBY_INVALID, None, None)
+
+        if full:
+            lobby = model.db.Lobby.parse_document(lobby_document)
+            model.db.Lobby.cache.put(lobby)
+        else:
+            lobby = model.db.LobbySummary.model_validate(lobby_document)
+
+    metrics.set_request_lobby(lobby.id)
+
+    # Fetch the player from the lobby document, which was read from the
+    # database if the player is missing
+    player = lobby.get_player(player_id)
     if player is None:
+        model.db.removed_players.add(player_id)
         return (strings.Bundle.ERROR_PLY_NOT_ACTIVE, None, None)
 
     return (None, lobby, player)
@@ -66,12 +126,91 @@ def currencyInsert(amount: int) -> model.db.EventInsertType:
     return ["currency", amount]
 
 
-def randomCode(n=4):
-    return "".join(random.sample("0123456789", n))
+async def runCommand(
+    lobby_id: model.db.ObjectId, command: actors.Command
+) -> typing.Any:
+    """
+    Run a command on the lobby's actor, and return its response. This is
+    a `fastapi.Response` (not a composed response) if the lobby was busy.
+    """
+    try:
+        return await actors.registry.execute(lobby_id, command)
+    except actors.CommandRejected as rejection:
+        return helpers.composeError(rejection.error)
+    except actors.LobbyUnavailable:
+        return helpers.composeError(strings.Bundle.ERROR_LOBBY_INVALID)
+    except model.db.WriteConflict:
+        # Other processes kept changing the lobby, so the client may retry
+        return helpers.NegotiatedResponse(
+            helpers.composeError(strings.Bundle.ERROR_LOBBY_BUSY),
+            status_code=409,
+        )
+
+
+def commandPlayer(
+    context: actors.CommandContext, player_id: model.db.ObjectId
+) -> model.db.Player:
+    """Find the calling player in the lobby, as it stands in the actor."""
+    player = context.lobby.get_player(player_id)
+    if player is None:
+        raise actors.CommandRejected(strings.Bundle.ERROR_PLY_NOT_ACTIVE)
+    return player
+
+
+def commandBanker(
+    context: actors.CommandContext, player_id: model.db.ObjectId
+) -> model.db.Player:
+    """Find the calling player, who must be the banker."""
+    player = commandPlayer(context, player_id)
+    if player.id != context.lobby.banker:
+        raise actors.CommandRejected(strings.Bundle.ERROR_PLY_NOT_BANKER)
+    return player
+
+
+# Create the router. Its routes speak JSON or MessagePack, as negotiated.
+apiRouter = fastapi.APIRouter(
+    route_class=helpers.NegotiatedRoute,
+    default_response_class=helpers.NegotiatedResponse,
+)
+
+
+# The string bundles only change between deployments, so they are serialized
+# once and served from a content-hashed URL that clients can cache forever
+stringsBundle = json.dumps(
+    helpers.composeResponse(
+        {
+            "bundleMap": strings.bundleMap,
+            "transferEntityMap": strings.transferEntityMap,
+        }
+    ),
+    ensure_ascii=False,
+    separators=(",", ":"),
+).encode("utf-8")
+stringsBundleHash = hashlib.sha256(stringsBundle).hexdigest()[:16]
+stringsBundleUrl = f"/api/strings/{stringsBundleHash}"
+
+
+@apiRouter.get("/api/strings/{bundle_hash}")
+async def api_strings(request: fastapi.Request, bundle_hash: str):
+    """
+    API returning all string bundles, at the URL given by the preflight.
+
+    Responses are immutable. Requests for an outdated hash are redirected to
+    the current one.
+    """
+    if bundle_hash != stringsBundleHash:
+        return fastapi.responses.RedirectResponse(stringsBundleUrl)
 
+    headers = {
+        "ETag": f'"{stringsBundleHash}"',
+        "Cache-Control": "public, max-age=31536000, immutable",
+    }
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return fastapi.Response(status_code=304, headers=headers)
 
-# Create the router
-apiRouter = fastapi.APIRouter()
+    return fastapi.Response(
+        stringsBundle, media_type="application/json", headers=headers
+    )
 
 
 @apiRouter.get("/api/preflight")
@@ -79,19 +218,18 @@ async def api_preflight(request: fastapi.Request):
     """
     API checked by clients on page load.
 
-    Returns the player's current session as well as all string bundles.
+    Returns the player's current session, and the URL of the string bundles.
     """
 
     # Create the basic data structure to return
     data = {
-        "bundleMap": strings.bundleMap,
-        "transferEntityMap": strings.transferEntityMap,
+        "stringsUrl": stringsBundleUrl,
         "lobbyId": None,
         "playerId": None,
     }
 
     # Verify session info, and if there are errors, wipe the session
-    (error, lobby, player) = await validateSession(request)
+    (error, lobby, player) = await validateSession(request, full=False)
     if error:
         request.session.clear()
     else:
@@ -110,26 +248,19 @@ async def api_create(request: fastapi.Request, form: model.db.CreateLobbyForm):
     Returns the join code of the new lobby.
     """
     now = datetime.datetime.utcnow()
-    db = model.db.get_db()
-
-    # Fetch a list of existing (valid) lobby codes, and generate a new one until
-    # a unique one is found.
-    existingCodes: list[str] = (
-        await db[model.db.Lobby.collection]
-        .find({"expires": {"$gt": now}, "disbanded": False})
-        .distinct("code")
-    )
-    lobbyCode: str = ""
-    while True:
-        lobbyCode = randomCode()
-        if lobbyCode not in existingCodes:
-            break
+    expires = now + datetime.timedelta(hours=24)
+
+    # Allocate a join code that isn't used by any other active lobby
+    try:
+        lobbyCode = await codes.allocator.allocate(expires)
+    except codes.CodeSpaceExhausted:
+        return helpers.composeError(strings.Bundle.ERROR_LOBBY_CODES_EXHAUSTED)
 
     # Now that we have a unique code, let's create a new lobby
     lobby = model.db.Lobby(
         code=lobbyCode,
         created=now,
-        expires=now + datetime.timedelta(hours=24),
+        expires=expires,
         disbanded=False,
         options=form,
         players=[],
@@ -138,7 +269,7 @@ async def api_create(request: fastapi.Request, form: model.db.CreateLobbyForm):
         freeParking=0,
     )
 
-    await db[model.db.Lobby.collection].insert_one(lobby.document())
+    await codes.allocator.insert(lobby)
 
     return helpers.composeResponse({"id": str(lobby.id), "code": lobby.code})
 
@@ -156,143 +287,174 @@ async def api_join(request: fastapi.Request, form: model.db.JoinLobbyForm):
 
     # If a code was given,
     # check the code to make sure that the lobby actually exists
-    db = model.db.get_db()
-    lobby_doc = await db[model.db.Lobby.collection].find_one(
-        {
-            "code": form.code.upper(),
-            "expires": {"$gt": now},
-            "disbanded": False,
-        }
+    lobby_doc = await model.db.get_storage().find_lobby(
+        code=form.code.upper(), now=now
     )
     if lobby_doc is None:
         return helpers.composeError(strings.Bundle.ERROR_LOBBY_CODE_INVALID)
-    lobby = model.db.Lobby.parse_document(lobby_doc)
+    metrics.set_request_lobby(lobby_doc["_id"])
 
-    # Double check there's enough room (maximum of 8 players)
-    if len(lobby.players) >= lobby.options.maxPlayers:
-        return helpers.composeError(strings.Bundle.ERROR_LOBBY_FULL)
+    def join(context: actors.CommandContext):
+        lobby = context.lobby
 
-    # It's been found (or made), so let's create the player document
-    # and attach it to the lobby. Also, subtract the player's starting
-    # balance from the bank.
-    player = model.db.Player(
-        name=form.name, balance=lobby.options.startingBalance
-    )
-    lobby.players.append(player)
-    lobby.bank -= player.balance
-
-    # Log an event announcing the player has joined the game
-    join_event = model.db.Event(
-        lobby=lobby.id,
-        time=datetime.datetime.utcnow(),
-        key=strings.Bundle.EVENT_PLY_JOIN.name,
-        inserts=[playerInsert(player), currencyInsert(player.balance)],
-    )
-    await join_event.insert()
+        # Double check there's enough room (maximum of 8 players)
+        if len(lobby.players) >= lobby.options.maxPlayers:
+            raise actors.CommandRejected(strings.Bundle.ERROR_LOBBY_FULL)
+
+        # It's been found (or made), so let's create the player document
+        # and attach it to the lobby. Also, subtract the player's starting
+        # balance from the bank.
+        player = model.db.Player(
+            name=form.name, balance=lobby.options.startingBalance
+        )
+        lobby.players.append(player)
+        lobby.bank -= player.balance
+
+        # Log an event announcing the player has joined the game
+        context.add_event(
+            model.db.Event(
+                lobby=lobby.id,
+                time=datetime.datetime.utcnow(),
+                key=strings.Bundle.EVENT_PLY_JOIN.name,
+                inserts=[playerInsert(player), currencyInsert(player.balance)],
+            )
+        )
 
-    new_events: list[model.db.Event] = [join_event]
+        # The first player to join the lobby gets made the banker
+        if len(lobby.players) == 1:
+            lobby.banker = player.id
+            context.add_event(
+                model.db.Event(
+                    lobby=lobby.id,
+                    time=datetime.datetime.utcnow(),
+                    key=strings.Bundle.EVENT_PLY_MADE_BANKER.name,
+                    inserts=[playerInsert(player)],
+                )
+            )
 
-    # The first player to join the lobby gets made the banker
-    if len(lobby.players) == 1:
-        lobby.banker = player.id
-        banker_event = model.db.Event(
-            lobby=lobby.id,
-            time=datetime.datetime.utcnow(),
-            key=strings.Bundle.EVENT_PLY_MADE_BANKER.name,
-            inserts=[playerInsert(player)],
+        context.save()
+        return helpers.composeResponse(
+            {"lobby": str(lobby.id), "player": str(player.id)}
         )
-        await banker_event.insert()
-        new_events.append(banker_event)
 
-    # Save changes to the lobby
-    await lobby.update()
+    response = await runCommand(lobby_doc["_id"], join)
+    if isinstance(response, fastapi.Response) or response["error"] is not None:
+        return response
+
+    # Store the lobby id and player id in the player's session, with the
+    # expiry of the lobby so that stale sessions are rejected cheaply
+    startSession(
+        request,
+        response["payload"]["lobby"],
+        response["payload"]["player"],
+        lobby_doc["expires"],
+    )
 
-    # Broadcast the lobby updates and new events to all players
-    await socket.manager.broadcast_update(lobby, new_events)
+    return response
 
-    # Store the lobby id and player id in the player's session
-    request.session["lobbyId"] = str(lobby.id)
-    request.session["playerId"] = str(player.id)
 
-    return helpers.composeResponse(
-        {"lobby": str(lobby.id), "player": str(player.id)}
-    )
+class PlannedTransfer(typing.NamedTuple):
+    """A transfer that has been checked, and can be applied."""
 
+    source: transfer.Account
+    destination: transfer.Account
+    amount: int
+    check_funds: bool
+    banker: typing.Optional[model.db.ObjectId]
+    inserts: list[model.db.EventInsertType]
 
-@apiRouter.post("/api/transfer")
-async def api_transfer(
-    request: fastapi.Request, form: model.forms.TransferForm
-):
-    """API method to transfer funds from one account to another."""
-    # Verify that the lobby and player are valid. Return any errors
-    (error, lobby, player) = await validateSession(request)
-    if error:
-        return helpers.composeError(error)
-    if lobby is None or player is None:
-        return helpers.composeError(strings.Bundle.ERROR_UNKNOWN)
 
-    # Parse and extract the data sent by the client
-    source = decodeTransferEntity(form.source)
-    destination = decodeTransferEntity(form.destination)
-    amount = form.amount
+# A side of a transfer: an entity or player id sent by the client, or a player
+# that a fan-out was expanded to
+TransferSide = typing.Union[strings.TransferEntity, str, model.db.Player]
+
+
+def planTransfer(
+    lobby: model.db.Lobby,
+    player: model.db.Player,
+    source: TransferSide,
+    destination: TransferSide,
+    amount: int,
+    pending: typing.Optional[dict[transfer.Account, int]] = None,
+) -> PlannedTransfer:
+    """
+    Check a transfer made by `player`, without changing anything. `pending`
+    holds the balance changes of transfers planned before this one, that
+    have not been applied to the lobby yet.
+    """
+    pending = pending or {}
+
+    # Only positive amounts can be transferred, or a transfer would pull
+    # funds from its destination
+    if amount <= 0:
+        raise actors.CommandRejected(
+            strings.Bundle.ERROR_TRANSFER_INVALID_AMOUNT
+        )
 
     # First, make sure that the player has permission
     # If the source is anything besides the current player, then the
     # current player must be the banker.
     if source is not strings.TransferEntity.SELF and player.id != lobby.banker:
-        return helpers.composeError(strings.Bundle.ERROR_PLY_NOT_BANKER)
+        raise actors.CommandRejected(strings.Bundle.ERROR_PLY_NOT_BANKER)
 
     # Next, make sure the debted party has enough funds
-    sufficient = None
+    sourceInsert: model.db.EventInsertType
+    balance: typing.Optional[int]
     if source is strings.TransferEntity.SELF:
-        sufficient = player.balance >= amount
+        sourceAccount, balance = player.id, player.balance
+        sourceInsert = bundleInsert(strings.Bundle.TRANSFER_SELF)
     elif source is strings.TransferEntity.BANK:
-        if lobby.options.unlimitedBank:
-            sufficient = True
-        else:
-            sufficient = lobby.bank >= amount
+        sourceAccount = "bank"
+        balance = None if lobby.options.unlimitedBank else lobby.bank
+        sourceInsert = bundleInsert(strings.Bundle.TRANSFER_BANK)
     elif source is strings.TransferEntity.FP:
-        sufficient = lobby.freeParking >= amount
+        sourceAccount, balance = "freeParking", lobby.freeParking
+        sourceInsert = bundleInsert(strings.Bundle.TRANSFER_FP)
+    elif isinstance(source, model.db.Player):
+        sourceAccount, balance = source.id, source.balance
+        sourceInsert = playerInsert(source)
     else:
-        return helpers.composeError(strings.Bundle.ERROR_TRANSFER_INVALID_SRC)
+        raise actors.CommandRejected(strings.Bundle.ERROR_TRANSFER_INVALID_SRC)
 
-    if not sufficient:
-        return helpers.composeError(strings.Bundle.ERROR_TRANSFER_FUNDS)
+    if (
+        balance is not None
+        and balance + pending.get(sourceAccount, 0) < amount
+    ):
+        raise actors.CommandRejected(strings.Bundle.ERROR_TRANSFER_FUNDS)
 
-    # Now, deduct that amount from the debited party
-    if source is strings.TransferEntity.SELF:
-        player.balance -= amount
-    elif source is strings.TransferEntity.BANK:
-        lobby.bank -= amount
-    elif source is strings.TransferEntity.FP:
-        lobby.freeParking -= amount
-
-    # Next, add the amount to the credited party
+    # Resolve the account on the other side of the transfer, and compose the
+    # event inserts that describe it
     destinationInsert: model.db.EventInsertType
-    if isinstance(destination, strings.TransferEntity):
+    destinationAccount: transfer.Account
+    if isinstance(destination, model.db.Player):
+        destinationAccount = destination.id
+        destinationInsert = playerInsert(destination)
+    elif destination in transferEntityStrings:
+        destinationAccount = transfer.resolve_account(destination, player)
         destinationInsert = bundleInsert(transferEntityStrings[destination])
-        if destination is strings.TransferEntity.SELF:
-            player.balance += amount
-        elif destination is strings.TransferEntity.BANK:
-            lobby.bank += amount
-        elif destination is strings.TransferEntity.FP:
-            lobby.freeParking += amount
     else:
-        destinationPlayer = lobby.get_player(model.db.ObjectId(destination))
+        destinationPlayer = (
+            lobby.get_player(model.db.ObjectId(destination))
+            if model.db.ObjectId.is_valid(destination)
+            else None
+        )
         if destinationPlayer is None:
-            return helpers.composeError(
+            raise actors.CommandRejected(
                 strings.Bundle.ERROR_TRANSFER_INVALID_DEST
             )
-        destinationPlayer.balance += amount
+        destinationAccount = destinationPlayer.id
         destinationInsert = playerInsert(destinationPlayer)
 
-    sourceInsert = bundleInsert(transferEntityStrings[source])
-
-    # Almost there, we just gotta log the transfer
-    event = model.db.Event(
-        lobby=lobby.id,
-        time=datetime.datetime.utcnow(),
-        key=strings.Bundle.EVENT_TRANSFER.name,
+    # The funds checks above are repeated by the database, so a write to the
+    # same lobby from another process can never overdraw an account.
+    return PlannedTransfer(
+        source=sourceAccount,
+        destination=destinationAccount,
+        amount=amount,
+        check_funds=balance is not None,
+        banker=(
+            lobby.banker if source is not strings.TransferEntity.SELF else None
+        ),
         inserts=[
             playerInsert(player),
             currencyInsert(amount),
@@ -300,14 +462,146 @@ async def api_transfer(
             destinationInsert,
         ],
     )
-    await event.insert()
 
-    # Finally, save changes to the lobby document and broadcast the updates
-    await lobby.update()
-    await socket.manager.broadcast_update(lobby, [event])
 
-    # If all is well, just return True
-    return helpers.composeResponse(True)
+def applyTransfer(context: actors.CommandContext, planned: PlannedTransfer):
+    """Apply the debit and credit of a planned transfer, and log it."""
+    context.transfer(
+        planned.source,
+        planned.destination,
+        planned.amount,
+        check_funds=planned.check_funds,
+        banker=planned.banker,
+    )
+    context.add_event(
+        model.db.Event(
+            lobby=context.lobby.id,
+            time=datetime.datetime.utcnow(),
+            key=strings.Bundle.EVENT_TRANSFER.name,
+            inserts=planned.inserts,
+        )
+    )
+
+
+def expandTransfer(
+    lobby: model.db.Lobby,
+    player: model.db.Player,
+    source: TransferSide,
+    destination: TransferSide,
+) -> list[tuple[TransferSide, TransferSide]]:
+    """
+    Expand a transfer from or to all players into one transfer per player.
+    Players are never asked to pay themselves.
+    """
+    everyone = strings.TransferEntity.ALL
+    if source is everyone and destination is everyone:
+        raise actors.CommandRejected(strings.Bundle.ERROR_TRANSFER_INVALID_SRC)
+
+    def account(side: TransferSide) -> typing.Any:
+        if side is strings.TransferEntity.SELF:
+            return player.id
+        if isinstance(side, str) and model.db.ObjectId.is_valid(side):
+            return model.db.ObjectId(side)
+        return None
+
+    if source is everyone:
+        return [
+            (other, destination)
+            for other in lobby.players
+            if other.id != account(destination)
+        ]
+    if destination is everyone:
+        return [
+            (source, other)
+            for other in lobby.players
+            if other.id != account(source)
+        ]
+    return [(source, destination)]
+
+
+@apiRouter.post("/api/transfer")
+async def api_transfer(
+    request: fastapi.Request, form: model.forms.TransferForm
+):
+    """API method to transfer funds from one account to another."""
+    # Verify that the lobby and player are valid. Return any errors
+    (error, lobby, player) = await validateSession(request)
+    if error:
+        return helpers.composeError(error)
+    if lobby is None or player is None:
+        return helpers.composeError(strings.Bundle.ERROR_UNKNOWN)
+
+    # Parse and extract the data sent by the client
+    source = decodeTransferEntity(form.source)
+    destination = decodeTransferEntity(form.destination)
+    amount = form.amount
+    player_id = player.id
+
+    def transferFunds(context: actors.CommandContext):
+        player = commandPlayer(context, player_id)
+        applyTransfer(
+            context,
+            planTransfer(context.lobby, player, source, destination, amount),
+        )
+
+        # If all is well, just return True
+        return helpers.composeResponse(True)
+
+    return await runCommand(lobby.id, transferFunds)
+
+
+@apiRouter.post("/api/transfer/batch")
+async def api_transfer_batch(
+    request: fastapi.Request, form: model.forms.BatchTransferForm
+):
+    """
+    API method to make several transfers at once, following the rules of
+    `/api/transfer`. A source or destination of "__all__" stands for every
+    player in the lobby.
+
+    Either every transfer is made, or none are: they are all checked against
+    the same state of the lobby, committed with one write, and announced with
+    one update.
+    """
+    # Verify that the lobby and player are valid. Return any errors
+    (error, lobby, player) = await validateSession(request)
+    if error:
+        return helpers.composeError(error)
+    if lobby is None or player is None:
+        return helpers.composeError(strings.Bundle.ERROR_UNKNOWN)
+
+    requested = [
+        (
+            decodeTransferEntity(item.source),
+            decodeTransferEntity(item.destination),
+            item.amount,
+        )
+        for item in form.transfers
+    ]
+    player_id = player.id
+
+    def transferBatch(context: actors.CommandContext):
+        lobby = context.lobby
+        player = commandPlayer(context, player_id)
+
+        # Check every transfer before applying any, so that a rejection
+        # leaves the lobby untouched
+        pending: dict[transfer.Account, int] = {}
+        planned: list[PlannedTransfer] = []
+        for source, destination, amount in requested:
+            for side in expandTransfer(lobby, player, source, destination):
+                plan = planTransfer(lobby, player, *side, amount, pending)
+                pending[plan.source] = pending.get(plan.source, 0) - amount
+                pending[plan.destination] = (
+                    pending.get(plan.destination, 0) + amount
+                )
+                planned.append(plan)
+
+        for plan in planned:
+            applyTransfer(context, plan)
+        return helpers.composeResponse(len(planned))
+
+    return await runCommand(lobby.id, transferBatch)
 
 
 @apiRouter.get("/api/leave")
@@ -321,34 +615,47 @@ async def api_leave(request: fastapi.Request):
         return helpers.composeError(error)
     elif lobby is None or player is None:
         return helpers.composeError(strings.Bundle.ERROR_UNKNOWN)
+    player_id = player.id
 
-    # If the player is the banker, don't allow them to leave
-    if player.id == lobby.banker:
-        return helpers.composeError(strings.Bundle.ERROR_BANKER_CANNOT_LEAVE)
+    def leave(context: actors.CommandContext):
+        lobby = context.lobby
+        player = commandPlayer(context, player_id)
 
-    # Transfer the player's balance back to the bank
-    lobby.bank += player.balance
+        # If the player is the banker, don't allow them to leave
+        if player.id == lobby.banker:
+            raise actors.CommandRejected(
+                strings.Bundle.ERROR_BANKER_CANNOT_LEAVE
+            )
 
-    # Remove the player from the lobby
-    lobby.players.remove(player)
+        # Transfer the player's balance back to the bank
+        lobby.bank += player.balance
 
-    # Log the event
-    event = model.db.Event(
-        lobby=lobby.id,
-        time=datetime.datetime.utcnow(),
-        key=strings.Bundle.EVENT_PLY_LEAVE.name,
-        inserts=[],
-    )
-    await event.insert()
+        # Remove the player from the lobby
+        lobby.players.remove(player)
 
-    # Save changes to the lobby and broadcast them to the websockets
-    await lobby.update()
-    await socket.manager.broadcast_update(lobby, [event])
+        # Log the event
+        context.add_event(
+            model.db.Event(
+                lobby=lobby.id,
+                time=datetime.datetime.utcnow(),
+                key=strings.Bundle.EVENT_PLY_LEAVE.name,
+                inserts=[],
+            )
+        )
+        context.save()
+        return helpers.composeResponse()
+
+    response = await runCommand(lobby.id, leave)
 
     # Finally, zero out the player's session
-    request.session.clear()
+    if (
+        not isinstance(response, fastapi.Response)
+        and response["error"] is None
+    ):
+        request.session.clear()
+        model.db.removed_players.add(player_id)
 
-    return helpers.composeResponse()
+    return response
 
 
 @apiRouter.get("/api/disband")
@@ -363,30 +670,205 @@ async def api_disband(request: fastapi.Request):
 
     if lobby is None or player is None:
         return helpers.composeError(strings.Bundle.ERROR_UNKNOWN)
+    player_id = player.id
+
+    def disband(context: actors.CommandContext):
+        # If the player is not the banker, return permission error
+        commandBanker(context, player_id)
+
+        # Mark the lobby as disbanded and log the event. Its code is freed,
+        # and the players are kicked, once this is saved.
+        context.lobby.disbanded = True
+        context.add_event(
+            model.db.Event(
+                lobby=context.lobby.id,
+                time=datetime.datetime.utcnow(),
+                key=strings.Bundle.EVENT_DISBANDED.name,
+                inserts=[],
+            )
+        )
+        context.save()
+        return helpers.composeResponse()
+
+    return await runCommand(lobby.id, disband)
 
-    # If the player is not the banker, return permission error
-    if player.id != lobby.banker:
-        return helpers.composeError(strings.Bundle.ERROR_PLY_NOT_BANKER)
 
-    # Mark the lobby as disbanded
-    lobby.disbanded = True
-    await lobby.update()
+@apiRouter.get("/api/ledger")
+async def api_ledger(request: fastapi.Request):
+    """
+    API returning the ledger of the player's lobby: the funds received and
+    sent by every account, and the number of transfers.
+    """
+    # Verify that the lobby and player are valid. Return any errors
+    (error, lobby, player) = await validateSession(request, full=False)
+    if error:
+        return helpers.composeError(error)
+    elif lobby is None or player is None:
+        return helpers.composeError(strings.Bundle.ERROR_UNKNOWN)
 
-    # Log the event and broadcast it
-    event = model.db.Event(
-        lobby=lobby.id,
-        time=datetime.datetime.utcnow(),
-        key=strings.Bundle.EVENT_DISBANDED.name,
-        inserts=[],
+    ledger = await model.db.Ledger.summarize(lobby.id)
+    return helpers.composeResponse(
+        ledger.model_dump(mode="json", by_alias=True)
     )
-    await event.insert()
 
-    # Instead of broadcasting this event to players (what's the point?)
-    # we just broadcast a message to kick them all from the game
-    await socket.manager.broadcast_disband(lobby)
 
-    # Return empty response
-    return helpers.composeResponse()
+# Events in a page of history, by default and at most
+EVENTS_PAGE_SIZE = 50
+EVENTS_PAGE_MAX = 200
+
+# Events read from the database, and written to the response, at a time when
+# exporting the history of a lobby
+EVENTS_EXPORT_BATCH = 500
+
+eventExportTypes = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+def encodeEventCursor(event: model.db.Event) -> str:
+    """A cursor to the events that follow an event, by (time, _id)."""
+    return f"{event.time.isoformat()}_{event.id}"
+
+
+def decodeEventCursor(
+    cursor: str,
+) -> typing.Optional[model.storage.EventPosition]:
+    time, _, event_id = cursor.partition("_")
+    if not model.db.ObjectId.is_valid(event_id):
+        return None
+    try:
+        return (
+            datetime.datetime.fromisoformat(time),
+            model.db.ObjectId(event_id),
+        )
+    except ValueError:
+        return None
+
+
+async def exportEvents(
+    lobby_id: model.db.ObjectId, format: str
+) -> typing.AsyncIterator[str]:
+    """
+    The history of a lobby as NDJSON or CSV, in chunks of
+    `EVENTS_EXPORT_BATCH` events, read as they are written. Events are
+    encoded in MongoDB extended JSON, as they are sent to sockets. CSV
+    columns hold the plain id and time, and the inserts as extended JSON.
+    """
+    documents = model.db.get_storage().lobby_events(
+        lobby_id, batch_size=EVENTS_EXPORT_BATCH
+    )
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if format == "csv":
+        writer.writerow(["_id", "time", "key", "inserts"])
+
+    count = 0
+    async for document in documents:
+        event = model.db.Event.parse_document(document)
+        if format == "csv":
+            data = event.model_dump(
+                mode="json", by_alias=True, context=model.db.EXTJSON_CONTEXT
+            )
+            writer.writerow(
+                [
+                    data["_id"]["$oid"],
+                    data["time"]["$date"],
+                    data["key"],
+                    json.dumps(data["inserts"], separators=(",", ":")),
+                ]
+            )
+        else:
+            buffer.write(model.db.extjson_dumps(event))
+            buffer.write("\n")
+
+        count += 1
+        if count % EVENTS_EXPORT_BATCH == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+@apiRouter.get("/api/events")
+async def api_events(
+    request: fastapi.Request,
+    after: typing.Optional[str] = None,
+    limit: int = EVENTS_PAGE_SIZE,
+):
+    """
+    API returning a page of the history of the player's lobby, in order,
+    with events encoded as they are sent to sockets. The page follows the
+    event of the `after` cursor, if given, and `next` is the cursor of the
+    following page, if there is one.
+    """
+    # Verify that the lobby and player are valid. Return any errors
+    (error, lobby, player) = await validateSession(request, full=False)
+    if error:
+        return helpers.composeError(error)
+    elif lobby is None or player is None:
+        return helpers.composeError(strings.Bundle.ERROR_UNKNOWN)
+
+    position = None
+    if after:
+        position = decodeEventCursor(after)
+        if position is None:
+            return helpers.composeError(strings.Bundle.ERROR_CURSOR_INVALID)
+
+    # Read one more event than asked for, to know whether there are more
+    limit = min(max(limit, 1), EVENTS_PAGE_MAX)
+    events = [
+        model.db.Event.parse_document(document)
+        async for document in model.db.get_storage().lobby_events(
+            lobby.id, after=position, limit=limit + 1, batch_size=limit + 1
+        )
+    ]
+    return helpers.composeResponse(
+        {
+            "events": [
+                event.model_dump(
+                    mode="json",
+                    by_alias=True,
+                    context=model.db.EXTJSON_CONTEXT,
+                )
+                for event in events[:limit]
+            ],
+            "next": (
+                encodeEventCursor(events[limit - 1])
+                if len(events) > limit
+                else None
+            ),
+        }
+    )
+
+
+@apiRouter.get("/api/events/export")
+async def api_events_export(
+    request: fastapi.Request,
+    format: typing.Literal["ndjson", "csv"] = "ndjson",
+):
+    """
+    API exporting the whole history of the player's lobby, as NDJSON or CSV.
+    The history is streamed from the database, a batch at a time.
+    """
+    # Verify that the lobby and player are valid. Return any errors
+    (error, lobby, player) = await validateSession(request, full=False)
+    if error:
+        return helpers.composeError(error)
+    elif lobby is None or player is None:
+        return helpers.composeError(strings.Bundle.ERROR_UNKNOWN)
+
+    return fastapi.responses.StreamingResponse(
+        exportEvents(lobby.id, format),
+        media_type=eventExportTypes[format],
+        headers={
+            "Content-Disposition": (
+                f'attachment; filename="events-{lobby.id}.{format}"'
+            )
+        },
+    )
 
 
 ################################################################################
@@ -405,31 +887,35 @@ async def api_promote(request: fastapi.Request, target_id_str: str):
         return helpers.composeError(error)
     elif lobby is None or player is None:
         return helpers.composeError(strings.Bundle.ERROR_UNKNOWN)
+    player_id = player.id
+
+    def promote(context: actors.CommandContext):
+        lobby = context.lobby
+
+        # Make sure the current player is the banker
+        player = commandBanker(context, player_id)
+
+        target_id = model.db.ObjectId(target_id_str)
+        target = lobby.get_player(target_id)
+        if target is None:
+            raise actors.CommandRejected(strings.Bundle.ERROR_PLY_NOT_FOUND)
+
+        # Log the transfer of power
+        context.add_event(
+            model.db.Event(
+                lobby=lobby.id,
+                time=datetime.datetime.utcnow(),
+                key=strings.Bundle.EVENT_PLY_TRANSFER_BANKER.name,
+                inserts=[playerInsert(player), playerInsert(target)],
+            )
+        )
 
-    # Make sure the current player is the banker
-    if player.id != lobby.banker:
-        return helpers.composeError(strings.Bundle.ERROR_PLY_NOT_BANKER)
-
-    target_id = model.db.ObjectId(target_id_str)
-    target = lobby.get_player(target_id)
-    if target is None:
-        return helpers.composeError(strings.Bundle.ERROR_PLY_NOT_FOUND)
-
-    # Log the transfer of power
-    event = model.db.Event(
-        lobby=lobby.id,
-        time=datetime.datetime.utcnow(),
-        key=strings.Bundle.EVENT_PLY_TRANSFER_BANKER.name,
-        inserts=[playerInsert(player), playerInsert(target)],
-    )
-    await event.insert()
-
-    # Update the banker in the lobby doc and broadcast the changes
-    lobby.banker = target_id
-    await lobby.update()
-    await socket.manager.broadcast_update(lobby, [event])
+        # Update the banker in the lobby doc
+        lobby.banker = target_id
+        context.save()
+        return helpers.composeResponse()
 
-    return helpers.composeResponse()
+    return await runCommand(lobby.id, promote)
 
 
 @apiRouter.get("/api/kick/{target_id_str}")
@@ -443,41 +929,43 @@ async def api_kick(request: fastapi.Request, target_id_str: str):
         return helpers.composeError(error)
     elif lobby is None or player is None:
         return helpers.composeError(strings.Bundle.ERROR_UNKNOWN)
+    player_id = player.id
 
-    # Make sure the current player is the banker
-    if player.id != lobby.banker:
-        return helpers.composeError(strings.Bundle.ERROR_PLY_NOT_BANKER)
+    def kick(context: actors.CommandContext):
+        lobby = context.lobby
 
-    # Parse the request data and find the target player
-    target_id = model.db.ObjectId(target_id_str)
-    target = lobby.get_player(target_id)
-    if target is None:
-        return helpers.composeError(strings.Bundle.ERROR_PLY_NOT_FOUND)
+        # Make sure the current player is the banker
+        player = commandBanker(context, player_id)
 
-    # Make sure the target isn't themselves
-    if target.id == player.id:
-        return helpers.composeError(strings.Bundle.ERROR_KICK_YOURSELF)
+        # Parse the request data and find the target player
+        target_id = model.db.ObjectId(target_id_str)
+        target = lobby.get_player(target_id)
+        if target is None:
+            raise actors.CommandRejected(strings.Bundle.ERROR_PLY_NOT_FOUND)
 
-    # Transfer the target's balance back to the bank
-    lobby.bank += target.balance
+        # Make sure the target isn't themselves
+        if target.id == player.id:
+            raise actors.CommandRejected(strings.Bundle.ERROR_KICK_YOURSELF)
 
-    # Remove the target player from the lobby
-    lobby.players.remove(target)
+        # Transfer the target's balance back to the bank
+        lobby.bank += target.balance
 
-    # Log the event
-    event = model.db.Event(
-        lobby=lobby.id,
-        time=datetime.datetime.utcnow(),
-        key=strings.Bundle.EVENT_PLY_KICK.name,
-        inserts=[],
-    )
-    await event.insert()
+        # Remove the target player from the lobby
+        lobby.players.remove(target)
 
-    # Update the lobby document and broadcast the changes
-    await lobby.update()
-    await socket.manager.broadcast_update(lobby, [event])
+        # Log the event
+        context.add_event(
+            model.db.Event(
+                lobby=lobby.id,
+                time=datetime.datetime.utcnow(),
+                key=strings.Bundle.EVENT_PLY_KICK.name,
+                inserts=[],
+            )
+        )
 
-    # Broadcast the message to kick the player from the lobby
-    await socket.manager.broadcast_kick(lobby, player)
+        # Save the lobby, then send the message to kick the target player
+        context.save()
+        context.kick(target)
+        return helpers.composeResponse()
 
-    return helpers.composeResponse()
+    return await runCommand(lobby.id, kick)
@@ -0,0 +1,185 @@
+# stdlib imports
+import abc
+import asyncio
+import os
+import typing
+
+# vendor imports
+import bson
+import pymongo
+import pymongo.errors
+
+# local imports
+from . import model
+from .messages import Message
+
+# Callback used by a backend to hand a message to the local sockets of a lobby
+DeliverCallback = typing.Callable[[model.db.ObjectId, Message], None]
+
+
+class BroadcastBackend(abc.ABC):
+    """
+    Base class for the bus that carries broadcast messages between server
+    processes. Every process subscribes with a callback that delivers messages
+    to the sockets it holds locally.
+    """
+
+    @abc.abstractmethod
+    async def start(self, deliver: DeliverCallback) -> None:
+        raise NotImplementedError
+
+    async def stop(self) -> None:
+        pass
+
+    @abc.abstractmethod
+    async def publish(
+        self, lobby_id: model.db.ObjectId, message: Message
+    ) -> None:
+        raise NotImplementedError
+
+
+class MemoryBroadcastBackend(BroadcastBackend):
+    """
+    Delivers messages to subscribers in the same process. This is the default
+    for a single server process, and a single instance can be shared between
+    several connection managers to stand in for a shared bus.
+    """
+
+    def __init__(self) -> None:
+        self.subscribers: list[DeliverCallback] = []
+
+    async def start(self, deliver: DeliverCallback) -> None:
+        self.subscribers.append(deliver)
+
+    async def stop(self) -> None:
+        self.subscribers.clear()
+
+    async def publish(
+        self, lobby_id: model.db.ObjectId, message: Message
+    ) -> None:
+        for deliver in self.subscribers:
+            deliver(lobby_id, message)
+
+
+class MongoBroadcastBackend(BroadcastBackend):
+    """
+    Carries messages between processes (and nodes) through a capped MongoDB
+    collection. Each process tails the collection with a tailable cursor, and
+    delivers messages published by the other processes to its own sockets.
+
+    Capped collection tailing is used instead of change streams because it
+    also works on a standalone server, without a replica set.
+
+    Messages are inserted with an empty timestamp, which the server replaces
+    with the current one. Timestamps increase in insertion order, unlike the
+    ids made by each process, so a cursor that is reopened resumes after the
+    timestamp of the last message seen.
+    """
+
+    collection = "broadcasts"
+
+    def __init__(self, size: int = 16 * 1024 * 1024) -> None:
+        self.size = size
+        self.origin = model.db.ObjectId()
+        self.deliver: typing.Optional[DeliverCallback] = None
+        self.task: typing.Optional[asyncio.Task] = None
+
+    async def _ensure_collection(self) -> None:
+        db = model.db.get_db()
+        try:
+            await db.create_collection(
+                self.collection, capped=True, size=self.size
+            )
+
+            # Tailable cursors on an empty collection die immediately, so seed
+            # the collection with a message that no process will deliver.
+            await db[self.collection].insert_one(
+                {"ts": bson.Timestamp(0, 0), "lobby": None}
+            )
+        except pymongo.errors.CollectionInvalid:
+            pass
+
+    async def start(self, deliver: DeliverCallback) -> None:
+        await self._ensure_collection()
+        self.deliver = deliver
+
+        # Only messages published after startup are of interest
+        newest = (
+            await model.db.get_db()[self.collection]
+            .find({}, {"ts": 1})
+            .sort("$natural", -1)
+            .limit(1)
+            .to_list(1)
+        )
+        self.task = asyncio.create_task(
+            self._tail(
+                newest[0].get("ts", bson.Timestamp(0, 0))
+                if newest
+                else bson.Timestamp(0, 0)
+            )
+        )
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def _tail(self, last: bson.Timestamp):
+        collection = model.db.get_db()[self.collection]
+        while True:
+            cursor = collection.find(
+                {"ts": {"$gt": last}},
+                cursor_type=pymongo.CursorType.TAILABLE_AWAIT,
+            )
+            try:
+                while cursor.alive:
+                    async for document in cursor:
+                        last = document["ts"]
+                        if (
+                            document.get("origin") != self.origin
+                            and document.get("lobby") is not None
+                            and self.deliver is not None
+                        ):
+                            self.deliver(
+                                document["lobby"],
+                                Message.from_documents(
+                                    document["message"], document.get("delta")
+                                ),
+                            )
+            except pymongo.errors.PyMongoError as error:
+                print("Broadcast tailing cursor failed:", error)
+
+            # The cursor has died (e.g. the collection wrapped around), so
+            # wait a moment and reopen it from the last message seen
+            await asyncio.sleep(1)
+
+    async def publish(
+        self, lobby_id: model.db.ObjectId, message: Message
+    ) -> None:
+        # Messages for our own sockets are delivered without the round trip
+        if self.deliver is not None:
+            self.deliver(lobby_id, message)
+
+        # The timestamp must be one of the first two fields (after the id)
+        # for the server to fill it in
+        await model.db.get_db()[self.collection].insert_one(
+            {
+                "ts": bson.Timestamp(0, 0),
+                "lobby": lobby_id,
+                "origin": self.origin,
+                "message": message.documents(),
+                "delta": (
+                    message.delta.documents()
+                    if message.delta is not None
+                    else None
+                ),
+            }
+        )
+
+
+def create_backend() -> BroadcastBackend:
+    """Create the backend selected by the `BROADCAST_BACKEND` variable."""
+    name = os.environ.get("BROADCAST_BACKEND", "memory")
+    if name == "mongo":
+        return MongoBroadcastBackend()
+    return MemoryBroadcastBackend()
@@ -0,0 +1,147 @@
+# stdlib imports
+import datetime
+import heapq
+import itertools
+import math
+import os
+import random
+import typing
+
+# vendor imports
+import pymongo.errors
+
+# local imports
+from . import model
+
+# Digits that lobby codes are made of. Digits are not repeated within a code.
+DIGITS = "0123456789"
+
+
+class CodeSpaceExhausted(Exception):
+    """Raised when every lobby code is held by an active lobby."""
+
+
+class CodeAllocator:
+    """
+    Allocates lobby join codes at random, avoiding those held in memory.
+
+    Codes are strings of `length` distinct digits. The held codes are loaded
+    from the active lobbies once. A code is then allocated by drawing random
+    codes until one is not held, which takes O(1) draws unless most of the
+    code space is held (plus O(log n) to schedule the code's expiry). Codes
+    held by expired lobbies are released lazily, on allocation.
+
+    Several server processes may allocate codes at the same time, so the
+    held codes are only a hint. The unique partial index on the code of
+    lobbies that are not disbanded (see `Lobby.indexes`) has the final say,
+    and `insert` retries with another code when it loses a race.
+    """
+
+    # Random draws before falling back to a scan of the whole code space
+    DRAWS = 32
+
+    def __init__(self, length: int = 4) -> None:
+        if not 1 <= length <= len(DIGITS):
+            raise ValueError(
+                f"Lobby codes must have 1 to {len(DIGITS)} digits, "
+                f"not {length}"
+            )
+        self.length = length
+        self.size = math.perm(len(DIGITS), length)
+        self.loaded = False
+        self._held: dict[str, datetime.datetime] = {}
+        self._expiries: list[tuple[datetime.datetime, str]] = []
+
+    def __len__(self) -> int:
+        """Number of codes currently free."""
+        return self.size - len(self._held)
+
+    async def load(self) -> None:
+        """Load the codes held by active lobbies."""
+        now = datetime.datetime.utcnow()
+
+        self._held = {}
+        self._expiries = []
+        for code, expires in await model.db.get_storage().lobby_codes(now):
+            self.hold(code, expires)
+
+        self.loaded = True
+
+    def _release_expired(self, now: datetime.datetime) -> None:
+        while self._expiries and self._expiries[0][0] <= now:
+            expires, code = heapq.heappop(self._expiries)
+
+            # Skip entries that were superseded by a later hold of the code
+            if self._held.get(code) == expires:
+                self.release(code)
+
+    def _draw(self) -> typing.Optional[str]:
+        """A random code that isn't held, or None if all are held."""
+        for _ in range(self.DRAWS):
+            code = "".join(random.sample(DIGITS, self.length))
+            if code not in self._held:
+                return code
+
+        # Most codes are held, so look through all of them
+        free = [
+            code
+            for code in map(
+                "".join, itertools.permutations(DIGITS, self.length)
+            )
+            if code not in self._held
+        ]
+        return random.choice(free) if free else None
+
+    def hold(self, code: str, expires: datetime.datetime) -> None:
+        """Mark a code as held by a lobby until it `expires`."""
+        self._held[code] = expires
+        heapq.heappush(self._expiries, (expires, code))
+
+    def release(self, code: str) -> None:
+        """Free a code (e.g. once its lobby disbands)."""
+        self._held.pop(code, None)
+
+    async def allocate(self, expires: datetime.datetime) -> str:
+        """Allocate a random free code, held until `expires`."""
+        if not self.loaded:
+            await self.load()
+
+        self._release_expired(datetime.datetime.utcnow())
+        code = self._draw()
+        if code is None:
+            raise CodeSpaceExhausted()
+
+        self.hold(code, expires)
+        return code
+
+    async def insert(self, lobby: model.db.Lobby) -> None:
+        """
+        Insert a new lobby, whose code was allocated by `allocate`. If another
+        process has taken the code in the meantime, a new one is allocated.
+        """
+        storage = model.db.get_storage()
+        while True:
+            try:
+                await lobby.insert()
+                return
+            except pymongo.errors.DuplicateKeyError:
+                pass
+
+            holder = await storage.find_lobby(code=lobby.code)
+
+            # The holder disbanded in the meantime, so just try again
+            if holder is None:
+                continue
+
+            # The code was held by a lobby that has since expired, so retire
+            # that lobby and try the same code again
+            if holder["expires"] <= datetime.datetime.utcnow():
+                await storage.disband_lobby(holder["_id"])
+                continue
+
+            # Otherwise, another process is using the code
+            self.hold(lobby.code, holder["expires"])
+            lobby.code = await self.allocate(lobby.expires)
+
+
+allocator = CodeAllocator(int(os.environ.get("LOBBY_CODE_LENGTH", 4)))
@@ -1,10 +1,27 @@
 # stdlib imports
+import contextvars
+import datetime
+import time
 import typing
 
 # vendor imports
+from bson.objectid import ObjectId
+import fastapi
+import fastapi.responses
+import fastapi.routing
+import msgpack
+import starlette.datastructures
 
 # local imports
-from . import strings
+from . import metrics, strings
+
+# MIME type (and WebSocket subprotocol) of the MessagePack wire protocol
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+MSGPACK_SUBPROTOCOL = "msgpack"
+
+# MessagePack extension type code for ObjectIds. Datetimes are encoded with
+# the standard MessagePack timestamp extension type (-1).
+MSGPACK_EXT_OBJECT_ID = 1
 
 
 def composeResponse(
@@ -16,3 +33,111 @@ def composeResponse(
 
 def composeError(error: strings.Bundle):
     return composeResponse(None, error)
+
+
+def _packDefault(value: typing.Any) -> typing.Any:
+    if isinstance(value, ObjectId):
+        return msgpack.ExtType(MSGPACK_EXT_OBJECT_ID, value.binary)
+    if isinstance(value, datetime.datetime):
+        # Stored datetimes are naive UTC
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return msgpack.Timestamp.from_datetime(value)
+    raise TypeError(f"Cannot pack {type(value)}")
+
+
+def _unpackExtHook(code: int, data: bytes) -> typing.Any:
+    if code == MSGPACK_EXT_OBJECT_ID:
+        return ObjectId(data)
+    return msgpack.ExtType(code, data)
+
+
+def packMessage(data: typing.Any) -> bytes:
+    """Pack data (which may contain ObjectIds and datetimes) to MessagePack."""
+    return msgpack.packb(data, default=_packDefault)
+
+
+def unpackMessage(data: bytes) -> typing.Any:
+    """Unpack MessagePack data packed by `packMessage`."""
+    return msgpack.unpackb(data, ext_hook=_unpackExtHook, timestamp=3)
+
+
+def acceptsMsgpack(accept: typing.Optional[str]) -> bool:
+    """Whether an Accept header asks for MessagePack."""
+    return accept is not None and MSGPACK_MEDIA_TYPE in accept
+
+
+# Whether the response to the current request should be MessagePack
+_responseMsgpack: contextvars.ContextVar[bool] = contextvars.ContextVar(
+    "responseMsgpack", default=False
+)
+
+
+class NegotiatedResponse(fastapi.responses.JSONResponse):
+    """
+    Response rendered as JSON, or as MessagePack if the request negotiated it
+    (see `NegotiatedRoute`).
+    """
+
+    def render(self, content: typing.Any) -> bytes:
+        if _responseMsgpack.get():
+            self.media_type = MSGPACK_MEDIA_TYPE
+            return packMessage(content)
+        return super().render(content)
+
+
+class _MsgpackRequest(fastapi.Request):
+    async def json(self) -> typing.Any:
+        if not hasattr(self, "_json"):
+            self._json = unpackMessage(await self.body())
+        return self._json
+
+
+class NegotiatedRoute(fastapi.routing.APIRoute):
+    """
+    Route that negotiates the MessagePack wire protocol. Request bodies sent
+    with a MessagePack Content-Type are unpacked, and responses are packed if
+    the Accept header asks for MessagePack.
+
+    The latency and storage operations of each request are recorded in the
+    metrics, by route.
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        path = self.path
+
+        async def negotiated_handler(request: fastapi.Request):
+            started = time.perf_counter()
+            if request.headers.get("content-type") == MSGPACK_MEDIA_TYPE:
+                # Present the request to FastAPI as JSON, so that the unpacked
+                # body goes through the usual validation
+                scope = dict(request.scope)
+                headers = starlette.datastructures.MutableHeaders(scope=scope)
+                headers["content-type"] = "application/json"
+                request = _MsgpackRequest(scope, request.receive)
+
+            token = _responseMsgpack.set(
+                acceptsMsgpack(request.headers.get("accept"))
+            )
+            counts = metrics.RequestMetrics(route=path)
+            metrics_token = metrics.current_request.set(counts)
+            try:
+                return await handler(request)
+            finally:
+                _responseMsgpack.reset(token)
+                metrics.current_request.reset(metrics_token)
+                metrics.request_duration.observe(
+                    time.perf_counter() - started, path, request.method
+                )
+                metrics.request_storage_operations.observe(
+                    counts.operations, path, request.method
+                )
+                metrics.request_mongo_commands.observe(
+                    counts.mongo_commands, path, request.method
+                )
+                metrics.request_mongo_duration.observe(
+                    counts.mongo_seconds, path, request.method
+                )
+
+        return negotiated_handler
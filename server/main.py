@@ -10,8 +10,11 @@ from starlette.middleware.sessions import SessionMiddleware
 from starlette.middleware.gzip import GZipMiddleware
 
 # local imports
+from .actors import registry
 from .api import apiRouter
-from .socket import socketRouter
+from .metrics import metricsRouter
+from .reaper import reaper
+from .socket import socketRouter, manager
 from .model.db import connect_and_init_db, close_db_connect
 
 # Create the FastAPI application
@@ -19,6 +22,18 @@ app = fastapi.FastAPI()
 
 # Database connection events
 app.add_event_handler("startup", connect_and_init_db)
+
+# Broadcast backend events (started after, and stopped before, the database)
+app.add_event_handler("startup", manager.start)
+
+# Lobby actors are stopped before the backend and database they rely on
+app.add_event_handler("shutdown", registry.stop)
+app.add_event_handler("shutdown", manager.stop)
+
+# Background archival of finished lobbies
+app.add_event_handler("startup", reaper.start)
+app.add_event_handler("shutdown", reaper.stop)
+
 app.add_event_handler("shutdown", close_db_connect)
 
 # GZip compression middleware
@@ -32,6 +47,7 @@ app.add_middleware(
 # Attach the API routes
 app.include_router(apiRouter)
 app.include_router(socketRouter)
+app.include_router(metricsRouter)
 
 
 # Default route redirect to build
@@ -40,7 +56,10 @@ def app_default():
     return RedirectResponse("/index.html")
 
 
-# Mount static file server for UI build
+# Mount static file server for UI build. The directory isn't required to exist,
+# so that the app can be imported by scripts and benchmarks without a UI build.
 staticDir = (pathlib.Path(__file__).parent / ".." / "build").resolve()
 staticUrl = "/"
-app.mount(staticUrl, StaticFiles(directory=staticDir), "static")
+app.mount(
+    staticUrl, StaticFiles(directory=staticDir, check_dir=False), "static"
+)
@@ -0,0 +1,168 @@
+# stdlib imports
+import os
+import typing
+
+# vendor imports
+import bson.json_util
+
+# local imports
+from . import helpers, model
+
+# Whether to encode update messages with the compiled pydantic-core
+# serializer, instead of `bson.json_util`. Both produce the same wire format.
+FAST_ENCODING = os.environ.get("FAST_ENCODING", "1") == "1"
+
+
+def _to_documents(value: typing.Any) -> typing.Any:
+    if isinstance(value, model.db.MongoDocument):
+        return value.document()
+    if isinstance(value, dict):
+        return {k: _to_documents(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_to_documents(v) for v in value]
+    return value
+
+
+def _fast_encodable(value: typing.Any) -> bool:
+    """
+    Whether `value` can be encoded by `extjson_dumps`: documents, and plain
+    JSON values around them. Bare ObjectIds and datetimes are left to
+    `bson.json_util`.
+    """
+    if isinstance(value, model.db.MongoDocument):
+        return True
+    if isinstance(value, dict):
+        return all(_fast_encodable(v) for v in value.values())
+    if isinstance(value, list):
+        return all(_fast_encodable(v) for v in value)
+    return value is None or isinstance(value, (str, int, float))
+
+
+class Message:
+    """
+    A message to be sent to sockets. It is encoded lazily, at most once per
+    wire protocol, no matter how many sockets it is sent to.
+
+    The data may contain documents (e.g. the lobby), which are encoded in
+    their stored form.
+    """
+
+    def __init__(
+        self,
+        data: dict[str, typing.Any],
+        delta: typing.Optional["Message"] = None,
+    ) -> None:
+        self.data: typing.Optional[dict[str, typing.Any]] = data
+
+        # Smaller alternative to this message, for sockets that accept deltas
+        self.delta = delta
+
+        self._documents: typing.Optional[dict[str, typing.Any]] = None
+        self._text: typing.Optional[str] = None
+        self._text_size: typing.Optional[int] = None
+        self._binary: typing.Optional[bytes] = None
+
+    @classmethod
+    def from_documents(
+        cls,
+        documents: dict[str, typing.Any],
+        delta: typing.Optional[dict[str, typing.Any]] = None,
+    ) -> "Message":
+        """Create a message from data that is already in stored form."""
+        message = cls(
+            {}, cls.from_documents(delta) if delta is not None else None
+        )
+        message.data = None
+        message._documents = documents
+        return message
+
+    def documents(self) -> dict[str, typing.Any]:
+        """The message data, with documents converted to dictionaries."""
+        if self._documents is None:
+            self._documents = _to_documents(self.data)
+        return self._documents
+
+    def text(self) -> str:
+        """The message as MongoDB extended JSON."""
+        if self._text is None:
+            if (
+                FAST_ENCODING
+                and self.data is not None
+                and _fast_encodable(self.data)
+            ):
+                self._text = model.db.extjson_dumps(self.data)
+            else:
+                self._text = bson.json_util.dumps(self.documents())
+        return self._text
+
+    def binary(self) -> bytes:
+        """The message as MessagePack."""
+        if self._binary is None:
+            self._binary = helpers.packMessage(self.documents())
+        return self._binary
+
+    @property
+    def type(self) -> str:
+        return (self.data or self.documents()).get("type", "")
+
+    def size(self, binary: bool = False) -> int:
+        """Size in bytes of the message, in either protocol."""
+        if binary:
+            return len(self.binary())
+        if self._text_size is None:
+            self._text_size = len(self.text().encode("utf-8"))
+        return self._text_size
+
+
+def compose_lobby_delta(
+    previous: model.db.Lobby,
+    lobby: model.db.Lobby,
+    events: list[model.db.Event],
+) -> Message:
+    """
+    Compose a delta message carrying only what changed between two versions
+    of a lobby, plus the new events. Clients apply it to the `base` version.
+    """
+    before = previous.document()
+    after = lobby.document()
+
+    # Top level fields (bank, freeParking, banker, ...) that changed
+    fields = {
+        key: value
+        for key, value in after.items()
+        if key not in ("_id", "players", "version")
+        and before.get(key) != value
+    }
+
+    # Players that joined or left, and balances that changed
+    before_players = {ply.id: ply for ply in previous.players}
+    after_players = {ply.id: ply for ply in lobby.players}
+    added = [
+        ply for id, ply in after_players.items() if id not in before_players
+    ]
+    removed = [id for id in before_players if id not in after_players]
+    balances = [
+        [id, ply.balance]
+        for id, ply in after_players.items()
+        if id in before_players and before_players[id].balance != ply.balance
+    ]
+
+    # Deltas are small, so they are kept in stored form and encoded with
+    # `bson.json_util`, which handles the raw ObjectIds and datetimes in them
+    return Message.from_documents(
+        _to_documents(
+            {
+                "type": "delta",
+                "payload": {
+                    "lobby": lobby.id,
+                    "base": previous.version,
+                    "version": lobby.version,
+                    "fields": fields,
+                    "added": added,
+                    "removed": removed,
+                    "balances": balances,
+                    "events": events,
+                },
+            }
+        )
+    )
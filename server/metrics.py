@@ -0,0 +1,382 @@
+# stdlib imports
+import bisect
+import contextvars
+import dataclasses
+import math
+import os
+import typing
+
+# vendor imports
+import fastapi
+
+# local imports
+
+# Whether per-lobby series (e.g. sockets per lobby) are exposed. These are
+# labelled with lobby ids, which give access to the lobby's socket, so they
+# are only exposed on request, where the metrics endpoint is protected.
+PER_LOBBY = os.environ.get("METRICS_PER_LOBBY", "0") == "1"
+
+Labels = tuple[str, ...]
+
+# A collector is called on every scrape, and returns samples of the gauges it
+# owns, for values that are cheaper to compute on demand than to keep current
+Collector = typing.Callable[
+    [], typing.Awaitable[typing.Iterable[tuple["Gauge", Labels, float]]]
+]
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metric:
+    """
+    Base class of the metric types. Samples are kept per combination of
+    label values, passed positionally in the order of `labels`.
+    """
+
+    type = "untyped"
+
+    def __init__(
+        self, name: str, documentation: str, labels: Labels = ()
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+
+    def _series(self, suffix: str, values: Labels, **extra: str) -> str:
+        pairs = list(zip(self.labels, values)) + list(extra.items())
+        if not pairs:
+            return self.name + suffix
+        labels = ",".join(f'{key}="{_escape(value)}"' for key, value in pairs)
+        return f"{self.name}{suffix}{{{labels}}}"
+
+    def samples(self) -> typing.Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return "\n".join(
+            [
+                f"# HELP {self.name} {self.documentation}",
+                f"# TYPE {self.name} {self.type}",
+                *self.samples(),
+            ]
+        )
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(
+        self, name: str, documentation: str, labels: Labels = ()
+    ) -> None:
+        super().__init__(name, documentation, labels)
+        self.values: dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> typing.Iterable[str]:
+        for labels, value in self.values.items():
+            yield f"{self._series('_total', labels)} {_format_value(value)}"
+
+
+class Gauge(Metric):
+    """Gauge whose samples are set directly, or by a collector on scrape."""
+
+    type = "gauge"
+
+    def __init__(
+        self, name: str, documentation: str, labels: Labels = ()
+    ) -> None:
+        super().__init__(name, documentation, labels)
+        self.values: dict[Labels, float] = {}
+
+    def set(self, value: float, *labels: str) -> None:
+        self.values[labels] = value
+
+    def samples(self) -> typing.Iterable[str]:
+        for labels, value in self.values.items():
+            yield f"{self._series('', labels)} {_format_value(value)}"
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Labels = (),
+        buckets: typing.Sequence[float] = (
+            0.001,
+            0.0025,
+            0.005,
+            0.01,
+            0.025,
+            0.05,
+            0.1,
+            0.25,
+            0.5,
+            1,
+            2.5,
+        ),
+    ) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets = list(buckets)
+
+        # Per series: the count of each bucket (not cumulative, plus one for
+        # +Inf), and the sum of the observed values
+        self.series: dict[Labels, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = ([0] * (len(self.buckets) + 1), [0])
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1][0] += value
+
+    def samples(self) -> typing.Iterable[str]:
+        for labels, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + [math.inf], counts):
+                cumulative += count
+                series = self._series(
+                    "_bucket", labels, le=_format_value(bound)
+                )
+                yield f"{series} {cumulative}"
+            yield f"{self._series('_sum', labels)} {_format_value(total[0])}"
+            yield f"{self._series('_count', labels)} {cumulative}"
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: list[Metric] = []
+        self.collectors: list[tuple[Collector, tuple["Gauge", ...]]] = []
+
+    def register(self, metric: Metric) -> typing.Any:
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Collector, *gauges: Gauge) -> None:
+        """Add a collector, which sets the samples of `gauges` on scrape."""
+        self.collectors.append((collector, gauges))
+
+    async def render(self) -> str:
+        """Render every metric in the Prometheus text format."""
+        for collector, gauges in self.collectors:
+            for gauge in gauges:
+                gauge.values = {}
+            for gauge, labels, value in await collector():
+                gauge.values[labels] = value
+
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+registry = Registry()
+
+request_duration: Histogram = registry.register(
+    Histogram(
+        "lobbyopoly_http_request_duration_seconds",
+        "Time taken to handle API requests.",
+        ("route", "method"),
+    )
+)
+request_storage_operations: Histogram = registry.register(
+    Histogram(
+        "lobbyopoly_http_request_storage_operations",
+        "Storage operations made while handling API requests.",
+        ("route", "method"),
+        buckets=(0, 1, 2, 3, 4, 6, 8, 12, 16, 32),
+    )
+)
+request_mongo_commands: Histogram = registry.register(
+    Histogram(
+        "lobbyopoly_http_request_mongo_commands",
+        "MongoDB round trips made while handling API requests.",
+        ("route", "method"),
+        buckets=(0, 1, 2, 3, 4, 6, 8, 12, 16, 32),
+    )
+)
+request_mongo_duration: Histogram = registry.register(
+    Histogram(
+        "lobbyopoly_http_request_mongo_duration_seconds",
+        "Time spent in MongoDB commands while handling API requests.",
+        ("route", "method"),
+    )
+)
+storage_operations: Counter = registry.register(
+    Counter(
+        "lobbyopoly_storage_operations",
+        "Storage operations, by operation.",
+        ("operation",),
+    )
+)
+mongo_commands: Counter = registry.register(
+    Counter(
+        "lobbyopoly_mongo_commands",
+        "Commands sent to MongoDB, by command.",
+        ("command",),
+    )
+)
+mongo_command_duration: Histogram = registry.register(
+    Histogram(
+        "lobbyopoly_mongo_command_duration_seconds",
+        "Time taken by MongoDB commands, by command.",
+        ("command",),
+    )
+)
+mongo_slow_commands: Counter = registry.register(
+    Counter(
+        "lobbyopoly_mongo_slow_commands",
+        "MongoDB commands slower than the slow command threshold.",
+        ("command",),
+    )
+)
+mongo_unindexed_queries: Counter = registry.register(
+    Counter(
+        "lobbyopoly_mongo_unindexed_queries",
+        "Distinct sampled query shapes that scanned a whole collection.",
+        ("collection",),
+    )
+)
+websockets: Gauge = registry.register(
+    Gauge("lobbyopoly_websockets", "Open WebSockets held by this process.")
+)
+websocket_lobbies: Gauge = registry.register(
+    Gauge(
+        "lobbyopoly_websocket_lobbies",
+        "Lobbies with open WebSockets held by this process.",
+    )
+)
+websocket_queued_messages: Gauge = registry.register(
+    Gauge(
+        "lobbyopoly_websocket_queued_messages",
+        "Messages queued for the WebSockets held by this process.",
+    )
+)
+websocket_closes: Counter = registry.register(
+    Counter(
+        "lobbyopoly_websocket_closes",
+        "WebSockets closed by the server, by reason.",
+        ("reason",),
+    )
+)
+lobby_websockets: Gauge = registry.register(
+    Gauge(
+        "lobbyopoly_lobby_websockets",
+        "Open WebSockets held by this process, per lobby.",
+        ("lobby",),
+    )
+)
+broadcast_duration: Histogram = registry.register(
+    Histogram(
+        "lobbyopoly_broadcast_duration_seconds",
+        "Time taken to publish a broadcast and queue it for local sockets.",
+        ("type",),
+    )
+)
+broadcast_coalesced: Counter = registry.register(
+    Counter(
+        "lobbyopoly_broadcast_coalesced_updates",
+        "Lobby updates merged into a pending update, instead of being sent.",
+    )
+)
+broadcast_recipients: Histogram = registry.register(
+    Histogram(
+        "lobbyopoly_broadcast_recipients",
+        "Local sockets a broadcast was queued for.",
+        buckets=(0, 1, 2, 4, 8, 16, 32),
+    )
+)
+socket_send_delay: Histogram = registry.register(
+    Histogram(
+        "lobbyopoly_websocket_send_delay_seconds",
+        "Time from queueing a message for a socket until it was sent.",
+    )
+)
+socket_message_bytes: Histogram = registry.register(
+    Histogram(
+        "lobbyopoly_websocket_message_bytes",
+        "Size of the messages sent to sockets.",
+        ("encoding",),
+        buckets=(256, 1024, 4096, 16384, 65536, 262144),
+    )
+)
+lobby_actors: Gauge = registry.register(
+    Gauge("lobbyopoly_lobby_actors", "Live lobby actors in this process.")
+)
+lobbies: Gauge = registry.register(
+    Gauge("lobbyopoly_lobbies", "Stored lobbies, by state.", ("state",))
+)
+document_cache_requests: Counter = registry.register(
+    Counter(
+        "lobbyopoly_document_cache_requests",
+        "Lookups in the in-process document caches, by result.",
+        ("cache", "result"),
+    )
+)
+document_cache_entries: Gauge = registry.register(
+    Gauge(
+        "lobbyopoly_document_cache_entries",
+        "Documents held by the in-process document caches.",
+        ("cache",),
+    )
+)
+
+
+@dataclasses.dataclass
+class RequestMetrics:
+    """Counts kept while handling a single request."""
+
+    route: typing.Optional[str] = None
+    lobby: typing.Optional[str] = None
+    operations: int = 0
+    mongo_commands: int = 0
+    mongo_seconds: float = 0
+
+    def add(self, other: "RequestMetrics") -> None:
+        """Count the work of `other` towards this request too."""
+        self.operations += other.operations
+        self.mongo_commands += other.mongo_commands
+        self.mongo_seconds += other.mongo_seconds
+
+
+# Metrics of the request being handled, if any
+current_request: contextvars.ContextVar[typing.Optional[RequestMetrics]] = (
+    contextvars.ContextVar("current_request", default=None)
+)
+
+
+def set_request_lobby(lobby_id: typing.Any) -> None:
+    """Note the lobby the current request is for, for the slow query log."""
+    request = current_request.get()
+    if request is not None:
+        request.lobby = str(lobby_id)
+
+
+def count_storage_operation(operation: str) -> None:
+    storage_operations.inc(operation)
+    request = current_request.get()
+    if request is not None:
+        request.operations += 1
+
+
+# Create the router
+metricsRouter = fastapi.APIRouter()
+
+
+@metricsRouter.get("/metrics")
+async def metrics_endpoint():
+    """Metrics, in the Prometheus text format."""
+    return fastapi.responses.PlainTextResponse(
+        await registry.render(), media_type="text/plain; version=0.0.4"
+    )
@@ -1 +1 @@
-from . import db, forms
+from . import db, forms, storage
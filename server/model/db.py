@@ -1,22 +1,40 @@
 # stdlib imports
+import collections
 import datetime
 import enum
+import math
 import os
+import time
 import typing
+import weakref
 
 # vendor imports
+import bson.errors
+import bson.json_util
 from bson.objectid import ObjectId as BsonObjectId
 import motor.motor_asyncio
 import pydantic
 import pydantic_core
+import pymongo
+import pymongo.errors
 
 # local imports
-
+from .. import metrics, strings
+from . import monitoring, storage
 
 db_client: typing.Optional[motor.motor_asyncio.AsyncIOMotorClient] = None
 
 # Co-opted from https://github.com/L0RD-ZER0/Motor-Types/blob/master/motor-stubs/core.pyi
 _Document = typing.Mapping[str, typing.Any]
+_Session = motor.motor_asyncio.AsyncIOMotorClientSession
+
+# Engine that stores the documents: "mongo" or "memory"
+storage_backend = os.environ.get("STORAGE_BACKEND", "mongo")
+_storage: typing.Optional[storage.Storage] = None
+
+# Whether multi-document writes should be made inside a transaction. This
+# requires MongoDB to be running as a replica set.
+use_transactions = os.environ.get("MONGODB_TRANSACTIONS", "") == "1"
 
 
 def get_db() -> motor.motor_asyncio.AsyncIOMotorDatabase:
@@ -24,20 +42,74 @@ def get_db() -> motor.motor_asyncio.AsyncIOMotorDatabase:
     return db_client.get_default_database()
 
 
+def get_storage() -> storage.Storage:
+    assert _storage is not None
+    return _storage
+
+
+def _observe(engine: storage.Storage) -> storage.Storage:
+    # Operations are counted for the metrics
+    return typing.cast(
+        storage.Storage,
+        storage.ObservedStorage(engine, metrics.count_storage_operation),
+    )
+
+
+# Lobbies are counted at most once every this many seconds, however often
+# the metrics are scraped
+LOBBY_COUNT_INTERVAL = float(
+    os.environ.get("METRICS_LOBBY_COUNT_INTERVAL", 60)
+)
+
+# The last counts of lobbies, and when they were made
+_lobby_counts: tuple[float, dict[str, int]] = (-math.inf, {})
+
+
+async def _collect_lobby_metrics():
+    global _lobby_counts
+    if _storage is None:
+        return []
+    counted, counts = _lobby_counts
+    if time.monotonic() - counted >= LOBBY_COUNT_INTERVAL:
+        counts = await _storage.count_lobbies(datetime.datetime.utcnow())
+        _lobby_counts = (time.monotonic(), counts)
+    return [
+        (metrics.lobbies, (state,), count) for state, count in counts.items()
+    ]
+
+
+metrics.registry.add_collector(_collect_lobby_metrics, metrics.lobbies)
+
+
 async def connect_and_init_db():
+    global db_client, _storage
+    if storage_backend == "memory":
+        print("Using in-memory storage...")
+        if _storage is None:
+            _storage = _observe(storage.MemoryStorage())
+        return
+
     print("Connecting to MongoDB...")
     mongodbUrl = os.environ.get("MONGODB_HOST", None)
-    global db_client
-    db_client = motor.motor_asyncio.AsyncIOMotorClient(mongodbUrl)
+    db_client = motor.motor_asyncio.AsyncIOMotorClient(
+        mongodbUrl, event_listeners=[monitoring.tracer]
+    )
+    monitoring.tracer.attach(db_client)
+    _storage = _observe(storage.MotorStorage(db_client.get_default_database()))
+
+    print("Ensuring MongoDB indexes...")
+    await ensure_indexes()
+    await check_indexes()
 
 
 async def close_db_connect():
-    print("Disconnecting from MongoDB...")
-    global db_client
+    global db_client, _storage
     if db_client is None:
         return
+    print("Disconnecting from MongoDB...")
     db_client.close()
     db_client = None
+    _storage = None
 
 
 class _ObjectIdPydanticAnnotation:
@@ -52,7 +124,12 @@ class _ObjectIdPydanticAnnotation:
         ],
     ) -> pydantic_core.core_schema.CoreSchema:
         def validate_from_str(input_value: str) -> BsonObjectId:
-            return BsonObjectId(input_value)
+            # Raise a ValueError so that pydantic treats this as a validation
+            # failure (e.g. when trying the members of a union)
+            try:
+                return BsonObjectId(input_value)
+            except (bson.errors.InvalidId, TypeError) as error:
+                raise ValueError(str(error)) from error
 
         return pydantic_core.core_schema.union_schema(
             [
@@ -62,11 +139,65 @@ class _ObjectIdPydanticAnnotation:
                     validate_from_str
                 ),
             ],
-            serialization=pydantic_core.core_schema.to_string_ser_schema(),
+            serialization=pydantic_core.core_schema.plain_serializer_function_ser_schema(
+                _serialize_object_id, info_arg=True
+            ),
         )
 
 
+# Serialization context selecting MongoDB extended JSON for ObjectIds and
+# datetimes, matching the output of `bson.json_util.dumps`
+EXTJSON_CONTEXT = {"extjson": True}
+
+
+def _is_extjson(info: pydantic_core.core_schema.SerializationInfo) -> bool:
+    return bool(info.context and info.context.get("extjson"))
+
+
+def _serialize_object_id(
+    value: BsonObjectId, info: pydantic_core.core_schema.SerializationInfo
+) -> typing.Any:
+    # Unions (e.g. event inserts) may hand other value types to this function
+    if not isinstance(value, BsonObjectId) or not info.mode_is_json():
+        return value
+    return {"$oid": str(value)} if _is_extjson(info) else str(value)
+
+
+def _serialize_datetime(
+    value: datetime.datetime,
+    handler: pydantic.SerializerFunctionWrapHandler,
+    info: pydantic_core.core_schema.SerializationInfo,
+) -> typing.Any:
+    if not _is_extjson(info):
+        return handler(value)
+
+    # Fast path for the naive UTC datetimes that we store. The fraction is
+    # truncated to milliseconds, and omitted if zero, like `bson.json_util`.
+    if value.tzinfo is None and value.year >= 1970:
+        text = value.isoformat(timespec="milliseconds")
+        if text.endswith(".000"):
+            text = text[:-4]
+        return {"$date": text + "Z"}
+    return bson.json_util.default(value)
+
+
 ObjectId = typing.Annotated[BsonObjectId, _ObjectIdPydanticAnnotation]
+Datetime = typing.Annotated[
+    datetime.datetime,
+    pydantic.WrapSerializer(_serialize_datetime, when_used="json"),
+]
+
+
+def extjson_dumps(value: typing.Any) -> str:
+    """
+    Serialize a value, which may contain documents, to MongoDB extended JSON.
+
+    This produces the same wire format as `bson.json_util.dumps` on the
+    documents' `.document()`, but runs in pydantic-core's compiled serializer.
+    """
+    return pydantic_core.to_json(
+        value, by_alias=True, context=EXTJSON_CONTEXT
+    ).decode("utf-8")
 
 
 class AppBaseModel(pydantic.BaseModel):
@@ -76,35 +207,203 @@ class AppBaseModel(pydantic.BaseModel):
 M = typing.TypeVar("M", bound="MongoDocument")
 
 
+class DocumentCache(typing.Generic[M]):
+    """
+    In-process LRU cache of documents, keyed by id, with a TTL.
+
+    Documents are kept in their stored form, and parsed again on the way out,
+    so that callers are free to mutate what they get back without affecting
+    the cache. Parsing is several times faster than a deep copy.
+    """
+
+    # Live caches, whose sizes are collected for the metrics
+    instances: typing.ClassVar["weakref.WeakSet[DocumentCache]"] = (
+        weakref.WeakSet()
+    )
+
+    def __init__(self, name: str, size: int, ttl: float) -> None:
+        self.name = name
+        self.size = size
+        self.ttl = ttl
+        DocumentCache.instances.add(self)
+        self._entries: collections.OrderedDict[
+            BsonObjectId, tuple[float, type[M], _Document]
+        ] = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, id: BsonObjectId) -> typing.Optional[M]:
+        entry = self._entries.get(id)
+        if entry is not None:
+            stored, cls, data = entry
+            if time.monotonic() - stored < self.ttl:
+                document = cls.parse_document(data)
+                if document.cacheable():
+                    self._entries.move_to_end(id)
+                    metrics.document_cache_requests.inc(self.name, "hit")
+                    return document
+            del self._entries[id]
+
+        metrics.document_cache_requests.inc(self.name, "miss")
+        return None
+
+    def put(self, document: M) -> None:
+        if self.size <= 0:
+            return
+        if not document.cacheable():
+            self.invalidate(document.id)
+            return
+
+        self._entries[document.id] = (
+            time.monotonic(),
+            type(document),
+            document.document(),
+        )
+        self._entries.move_to_end(document.id)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, id: BsonObjectId) -> None:
+        self._entries.pop(id, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    @classmethod
+    async def collect_metrics(cls):
+        return [
+            (metrics.document_cache_entries, (cache.name,), len(cache))
+            for cache in cls.instances
+        ]
+
+
+metrics.registry.add_collector(
+    DocumentCache.collect_metrics, metrics.document_cache_entries
+)
+
+
+class RecentIds:
+    """
+    Bounded set of ids added recently, that forgets them after a TTL (or
+    once more than `size` newer ids have been added).
+    """
+
+    def __init__(self, size: int, ttl: float) -> None:
+        self.size = size
+        self.ttl = ttl
+        self._ids: collections.OrderedDict[BsonObjectId, float] = (
+            collections.OrderedDict()
+        )
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, id: BsonObjectId) -> bool:
+        added = self._ids.get(id)
+        if added is None:
+            return False
+        if time.monotonic() - added < self.ttl:
+            return True
+        del self._ids[id]
+        return False
+
+    def add(self, id: BsonObjectId) -> None:
+        if self.size <= 0:
+            return
+        self._ids[id] = time.monotonic()
+        self._ids.move_to_end(id)
+        while len(self._ids) > self.size:
+            self._ids.popitem(last=False)
+
+
+# Negative caches of lobbies that are gone (disbanded, expired or removed),
+# and of players that were kicked or left, so that sessions pointing at them
+# are rejected without a read
+removed_lobbies = RecentIds(
+    size=int(os.environ.get("REMOVED_LOBBY_CACHE_SIZE", 16384)),
+    ttl=float(os.environ.get("REMOVED_LOBBY_CACHE_TTL", 24 * 60 * 60)),
+)
+removed_players = RecentIds(
+    size=int(os.environ.get("REMOVED_PLAYER_CACHE_SIZE", 16384)),
+    ttl=float(os.environ.get("REMOVED_PLAYER_CACHE_TTL", 24 * 60 * 60)),
+)
+
+
 class MongoDocument(AppBaseModel):
     collection: typing.ClassVar[str] = "CHANGE ME"
 
+    # Optional write-through cache for documents of this class
+    cache: typing.ClassVar[typing.Optional[DocumentCache]] = None
+
+    # Indexes applied to the collection at startup
+    indexes: typing.ClassVar[list[pymongo.IndexModel]] = []
+
+    # Representative queries (filter and sort) that must be served by an
+    # index, checked with `explain` at startup
+    hot_queries: typing.ClassVar[
+        list[tuple[dict[str, typing.Any], list[tuple[str, int]]]]
+    ] = []
+
+    @classmethod
+    async def prepare_indexes(cls) -> None:
+        """Hook to migrate existing documents before indexes are created."""
+        pass
+
     id: typing.Annotated[
         ObjectId, pydantic.Field(default_factory=ObjectId, alias="_id")
     ]
 
     @classmethod
-    def parse_document(cls, document: _Document):
-        return cls.parse_obj(document)
+    def parse_document(cls: type[M], document: _Document) -> M:
+        return cls.model_validate(document)
 
     def document(self) -> _Document:
-        return self.dict(by_alias=True)
+        return self.model_dump(by_alias=True)
+
+    def clone(self: M) -> M:
+        """A deep copy, made faster by parsing the stored form again."""
+        return self.parse_document(self.document())
+
+    def cacheable(self) -> bool:
+        """Whether this document may (still) be kept in the cache."""
+        return True
 
     @classmethod
     async def get_by_id(cls: type[M], id: ObjectId) -> typing.Union[M, None]:
-        db = get_db()
-        results = await db[cls.collection].find_one({"_id": id})
+        results = await get_storage().get(cls.collection, id)
         return cls.parse_document(results) if results is not None else None
 
-    async def insert(self) -> None:
-        db = get_db()
-        await db[self.collection].insert_one(self.document())
+    async def insert(self, session: typing.Optional[_Session] = None) -> None:
+        await get_storage().insert_many(
+            self.collection, [self.document()], session=session
+        )
+        if self.cache is not None:
+            self.cache.put(self)
+
+    @classmethod
+    async def insert_many(
+        cls: type[M],
+        documents: typing.Sequence[M],
+        session: typing.Optional[_Session] = None,
+    ) -> None:
+        if not documents:
+            return
+        await get_storage().insert_many(
+            cls.collection,
+            [document.document() for document in documents],
+            session=session,
+        )
+        if cls.cache is not None:
+            for document in documents:
+                cls.cache.put(document)
 
-    async def update(self) -> None:
-        db = get_db()
-        await db[self.collection].replace_one(
-            {"_id": self.id}, self.document()
+    async def update(self, session: typing.Optional[_Session] = None) -> None:
+        await get_storage().replace(
+            self.collection, self.document(), session=session
         )
+        if self.cache is not None:
+            self.cache.put(self)
 
 
 class LobbyCurrency(enum.Enum):
@@ -134,14 +433,78 @@ class Player(MongoDocument):
 
 
 class Lobby(MongoDocument):
-    collection: typing.ClassVar[str] = "lobbies"
+    collection: typing.ClassVar[str] = storage.LOBBIES
+
+    # Lobbies are read by every authenticated request, so the hot set is kept
+    # in memory. When running several server processes, keep the TTL short
+    # (or set the size to 0) since other processes write the same lobbies.
+    cache: typing.ClassVar[DocumentCache] = DocumentCache(
+        "lobbies",
+        size=int(os.environ.get("LOBBY_CACHE_SIZE", 4096)),
+        ttl=float(os.environ.get("LOBBY_CACHE_TTL", 300)),
+    )
+
+    indexes: typing.ClassVar[list[pymongo.IndexModel]] = [
+        # Join code lookups, and the uniqueness of codes in use
+        pymongo.IndexModel(
+            [("code", pymongo.ASCENDING)],
+            name="code_active_unique",
+            unique=True,
+            partialFilterExpression={"disbanded": False},
+        ),
+        # Expiry. Expired lobbies are deleted after the retention period.
+        pymongo.IndexModel(
+            [("expires", pymongo.ASCENDING)],
+            name="expires_ttl",
+            expireAfterSeconds=int(
+                os.environ.get("LOBBY_RETENTION_SECONDS", 7 * 24 * 60 * 60)
+            ),
+        ),
+        # Counts of lobbies by state, and disbanded lobbies for the reaper
+        pymongo.IndexModel(
+            [("disbanded", pymongo.ASCENDING), ("expires", pymongo.ASCENDING)],
+            name="disbanded_expires",
+        ),
+    ]
+
+    hot_queries: typing.ClassVar[
+        list[tuple[dict[str, typing.Any], list[tuple[str, int]]]]
+    ] = [
+        (
+            {
+                "code": "0000",
+                "expires": {"$gt": datetime.datetime.min},
+                "disbanded": False,
+            },
+            [],
+        ),
+        ({"expires": {"$gt": datetime.datetime.min}, "disbanded": False}, []),
+        ({"disbanded": True}, []),
+    ]
+
+    @classmethod
+    async def prepare_indexes(cls) -> None:
+        # Expired lobbies can never be used again, so mark them disbanded to
+        # take them out of the unique code index
+        await get_db()[cls.collection].update_many(
+            {
+                "expires": {"$lte": datetime.datetime.utcnow()},
+                "disbanded": False,
+            },
+            {"$set": {"disbanded": True}},
+        )
+
+        # Lobbies stored before they were versioned
+        await get_db()[cls.collection].update_many(
+            {"version": {"$exists": False}}, {"$set": {"version": 0}}
+        )
 
     id: ObjectId = pydantic.Field(default_factory=ObjectId, alias="_id")
 
     # Lobby session information
     code: str
-    created: datetime.datetime
-    expires: datetime.datetime
+    created: Datetime
+    expires: Datetime
     disbanded: bool
     options: CreateLobbyForm  # for now these are equivalent, but this may change in the future
 
@@ -155,6 +518,40 @@ class Lobby(MongoDocument):
     # List of players in the lobby
     players: list[Player]
 
+    # Incremented on every write, so clients can detect missed updates
+    version: int = 0
+
+    async def update(
+        self,
+        session: typing.Optional[_Session] = None,
+        if_version: typing.Optional[int] = None,
+    ) -> None:
+        """
+        Save the lobby, incrementing its version. If `if_version` is given,
+        the lobby is only saved if the stored version still matches it, and
+        `WriteConflict` is raised otherwise.
+        """
+        if if_version is None:
+            self.version += 1
+            await super().update(session)
+            return
+
+        self.version = if_version + 1
+        replaced = await get_storage().replace(
+            self.collection,
+            self.document(),
+            if_version=if_version,
+            session=session,
+        )
+        if not replaced:
+            self.version = if_version
+            self.cache.invalidate(self.id)
+            raise WriteConflict()
+        self.cache.put(self)
+
+    def cacheable(self) -> bool:
+        return not self.disbanded and self.expires > datetime.datetime.utcnow()
+
     def get_player(self, id: ObjectId) -> typing.Union[Player, None]:
         for player in self.players:
             if player.id == id:
@@ -162,15 +559,437 @@ class Lobby(MongoDocument):
         return None
 
 
-EventInsertType = list[typing.Union[ObjectId, int, str]]
+class PlayerSummary(AppBaseModel):
+    id: ObjectId = pydantic.Field(alias="_id")
+
+
+class LobbySummary(AppBaseModel):
+    """
+    The parts of a lobby needed to check a session against it, read with
+    `projection` instead of the whole document.
+    """
+
+    projection: typing.ClassVar[dict[str, int]] = {
+        "_id": 1,
+        "expires": 1,
+        "disbanded": 1,
+        "banker": 1,
+        "players._id": 1,
+    }
+
+    id: ObjectId = pydantic.Field(alias="_id")
+    expires: Datetime
+    disbanded: bool
+    banker: typing.Optional[ObjectId]
+    players: list[PlayerSummary]
+
+    def get_player(self, id: ObjectId) -> typing.Union[PlayerSummary, None]:
+        for player in self.players:
+            if player.id == id:
+                return player
+        return None
+
+
+# Values are tried in order, so that strings and numbers never reach the
+# (Python) validator of ObjectIds, which is slow to reject them
+EventInsertType = list[
+    typing.Annotated[
+        typing.Union[str, int, ObjectId],
+        pydantic.Field(union_mode="left_to_right"),
+    ]
+]
 
 
 class Event(MongoDocument):
-    collection: typing.ClassVar[str] = "events"
+    collection: typing.ClassVar[str] = storage.EVENTS
+
+    indexes: typing.ClassVar[list[pymongo.IndexModel]] = [
+        # Lobby history, in order
+        pymongo.IndexModel(
+            [
+                ("lobby", pymongo.ASCENDING),
+                ("time", pymongo.ASCENDING),
+                ("_id", pymongo.ASCENDING),
+            ],
+            name="lobby_time",
+        ),
+        # Events are deleted along with their lobby. Lobbies live for a day,
+        # so events are kept for a day longer than the lobby retention.
+        pymongo.IndexModel(
+            [("time", pymongo.ASCENDING)],
+            name="time_ttl",
+            expireAfterSeconds=int(
+                os.environ.get("LOBBY_RETENTION_SECONDS", 7 * 24 * 60 * 60)
+            )
+            + 24 * 60 * 60,
+        ),
+    ]
+
+    hot_queries: typing.ClassVar[
+        list[tuple[dict[str, typing.Any], list[tuple[str, int]]]]
+    ] = [
+        ({"lobby": BsonObjectId()}, [("time", 1), ("_id", 1)]),
+    ]
 
     id: ObjectId = pydantic.Field(default_factory=ObjectId, alias="_id")
 
     lobby: ObjectId
-    time: datetime.datetime
+    time: Datetime
     key: str
     inserts: list[EventInsertType]
+
+    @classmethod
+    async def insert_many(
+        cls,
+        documents: typing.Sequence["Event"],
+        session: typing.Optional[_Session] = None,
+    ) -> None:
+        await super().insert_many(documents, session=session)
+        if session is not None:
+            await Ledger.record(documents, session=session)
+            return
+
+        try:
+            await Ledger.record(documents)
+        except pymongo.errors.PyMongoError as error:
+            # Outside a transaction the events are already stored, and a
+            # ledger that missed them would stay wrong, so have it rebuilt
+            print("Ledger update failed: {!r}".format(error))
+            for lobby_id in {event.lobby for event in documents}:
+                await get_storage().drop_ledger(lobby_id)
+
+
+class LedgerAccount(AppBaseModel):
+    received: int = 0
+    sent: int = 0
+    transfers: int = 0
+
+
+# Accounts named by the bundle inserts of transfer events
+_ledgerBundleAccounts = {
+    strings.Bundle.TRANSFER_BANK.name: "bank",
+    strings.Bundle.TRANSFER_FP.name: "freeParking",
+}
+
+
+class Ledger(MongoDocument):
+    """
+    Snapshot of the money moved in a lobby. For every account (a player id,
+    "bank" or "freeParking") it holds the funds received and sent, and the
+    number of transfers. The id of a ledger is the id of its lobby.
+
+    Ledgers are updated as events are inserted, so summarizing a lobby only
+    reads the events that follow `lastEvent` (normally none), rather than the
+    whole history. A lobby's ledger is first built from a full scan of its
+    history, the first time it's needed.
+    """
+
+    collection: typing.ClassVar[str] = storage.LEDGERS
+
+    id: ObjectId = pydantic.Field(alias="_id")
+
+    accounts: dict[str, LedgerAccount] = {}
+    transfers: int = 0
+    events: int = 0
+
+    # Position of the last event counted, in history order
+    lastTime: typing.Optional[Datetime] = None
+    lastEvent: typing.Optional[ObjectId] = None
+
+    # Position of the last event counted by the scan the ledger was built
+    # from. Events up to there are never counted again.
+    builtTime: typing.Optional[Datetime] = None
+    builtEvent: typing.Optional[ObjectId] = None
+
+    @staticmethod
+    def _transfer(event: Event) -> typing.Optional[tuple[str, str, int]]:
+        """The source and destination accounts, and amount, of a transfer."""
+        if event.key != strings.Bundle.EVENT_TRANSFER.name:
+            return None
+        (_, player), (_, amount), source, destination = event.inserts
+
+        def account(insert: EventInsertType) -> str:
+            if insert[0] == "player":
+                return str(insert[1])
+            if insert[1] == strings.Bundle.TRANSFER_SELF.name:
+                return str(player)
+            return _ledgerBundleAccounts[typing.cast(str, insert[1])]
+
+        return (account(source), account(destination), int(amount))
+
+    @classmethod
+    def changes(cls, events: typing.Sequence[Event]) -> dict[str, int]:
+        """The `$inc` operations that count `events` into a ledger."""
+        changes: dict[str, int] = {"events": len(events)}
+        for event in events:
+            transfer = cls._transfer(event)
+            if transfer is None:
+                continue
+            source, destination, amount = transfer
+            for path, change in (
+                ("transfers", 1),
+                (f"accounts.{source}.sent", amount),
+                (f"accounts.{source}.transfers", 1),
+                (f"accounts.{destination}.received", amount),
+                (f"accounts.{destination}.transfers", 1),
+            ):
+                changes[path] = changes.get(path, 0) + change
+        return changes
+
+    def apply(self, events: typing.Sequence[Event]) -> None:
+        """Count `events`, which follow `lastEvent`, into this ledger."""
+        for path, change in self.changes(events).items():
+            if path.startswith("accounts."):
+                _, account, field = path.split(".")
+                entry = self.accounts.setdefault(account, LedgerAccount())
+                setattr(entry, field, getattr(entry, field) + change)
+            else:
+                setattr(self, path, getattr(self, path) + change)
+        if events:
+            self.lastTime = events[-1].time
+            self.lastEvent = events[-1].id
+
+    @classmethod
+    async def record(
+        cls,
+        events: typing.Sequence[Event],
+        session: typing.Optional[_Session] = None,
+    ) -> None:
+        """Count newly inserted events into the ledgers of their lobbies."""
+        lobbies: dict[ObjectId, list[Event]] = {}
+        for event in events:
+            lobbies.setdefault(event.lobby, []).append(event)
+
+        for lobby_id, lobby_events in lobbies.items():
+            lobby_events.sort(key=lambda event: (event.time, event.id))
+            changes = cls.changes(lobby_events)
+            first, last = lobby_events[0], lobby_events[-1]
+            for _ in range(2):
+                if await get_storage().record_ledger(
+                    lobby_id,
+                    changes,
+                    (first.time, first.id),
+                    (last.time, last.id),
+                    session=session,
+                ):
+                    break
+
+                # On first use, the ledger is built with these events. If
+                # another writer builds it first, they're counted into its
+                # ledger unless its scan already counted them.
+                if await cls._build(lobby_id, lobby_events, session=session):
+                    break
+
+    @classmethod
+    async def _build(
+        cls,
+        lobby_id: ObjectId,
+        pending: typing.Sequence[Event] = (),
+        session: typing.Optional[_Session] = None,
+    ) -> typing.Optional["Ledger"]:
+        """
+        Create the ledger of a lobby from its whole history, along with the
+        `pending` events (which may not be visible outside `session` yet).
+        Returns None if the ledger already exists.
+        """
+        ledger = cls(_id=lobby_id)
+        history = [
+            Event.parse_document(document)
+            async for document in get_storage().lobby_events(lobby_id)
+        ]
+        if history:
+            ledger.builtTime, ledger.builtEvent = (
+                history[-1].time,
+                history[-1].id,
+            )
+        stored = {event.id for event in history}
+        history.extend(event for event in pending if event.id not in stored)
+        history.sort(key=lambda event: (event.time, event.id))
+        ledger.apply(history)
+        try:
+            await ledger.insert(session=session)
+        except pymongo.errors.DuplicateKeyError:
+            return None
+        return ledger
+
+    @classmethod
+    async def summarize(cls, lobby_id: ObjectId) -> "Ledger":
+        """
+        The ledger of a lobby, brought up to date with any events that it
+        hasn't counted yet (e.g. events still being recorded).
+        """
+        ledger = (
+            await cls.get_by_id(lobby_id)
+            or await cls._build(lobby_id)
+            or await cls.get_by_id(lobby_id)
+            or cls(_id=lobby_id)
+        )
+        tail = [
+            Event.parse_document(document)
+            async for document in get_storage().lobby_events(
+                lobby_id,
+                after=(
+                    (ledger.lastTime, ledger.lastEvent)
+                    if ledger.lastTime is not None
+                    and ledger.lastEvent is not None
+                    else None
+                ),
+            )
+        ]
+        ledger.apply(tail)
+        return ledger
+
+
+class WriteConflict(Exception):
+    """Raised when a conditional write finds that a document has changed."""
+
+
+class UnitOfWork:
+    """
+    Collects the writes made while handling a request, so they can be flushed
+    together: one update of the lobby (a replace, or a batch of transfers),
+    followed by one `insert_many` of the new events and the update of their
+    ledger. If the lobby update fails, no events are written.
+
+    If `transaction` is true, all writes are made inside a session
+    transaction, so none is visible unless all succeed.
+    """
+
+    def __init__(self, transaction: typing.Optional[bool] = None) -> None:
+        self.transaction = (
+            use_transactions if transaction is None else transaction
+        )
+        self.lobby: typing.Optional[Lobby] = None
+        self.lobby_version: typing.Optional[int] = None
+        self.transfers: typing.Optional[storage.TransferBatch] = None
+        self.banker: typing.Optional[ObjectId] = None
+        self.events: list[Event] = []
+
+    def add_event(self, event: Event) -> Event:
+        """Queue a new event to be inserted."""
+        self.events.append(event)
+        return event
+
+    def save_lobby(
+        self, lobby: Lobby, if_version: typing.Optional[int] = None
+    ) -> None:
+        """Queue the lobby to be saved (see `Lobby.update`)."""
+        self.lobby = lobby
+        self.lobby_version = if_version
+
+    def apply_transfers(
+        self,
+        transfers: storage.TransferBatch,
+        banker: typing.Optional[ObjectId] = None,
+    ) -> None:
+        """
+        Queue a batch of transfers (see `Storage.apply_transfers`). Once
+        committed, `lobby` is the updated lobby. Raises `WriteConflict` on
+        commit if the transfers can't be made.
+        """
+        self.transfers = transfers
+        self.banker = banker
+
+    async def _flush(self, session: typing.Optional[_Session]) -> None:
+        if self.transfers is not None:
+            document = await get_storage().apply_transfers(
+                self.transfers, self.banker, session=session
+            )
+            if document is None:
+                # The cached copy may be what led the caller to believe the
+                # transfers would succeed, so drop it
+                Lobby.cache.invalidate(self.transfers.lobby_id)
+                raise WriteConflict()
+            self.lobby = Lobby.parse_document(document)
+            Lobby.cache.put(self.lobby)
+        elif self.lobby is not None:
+            await self.lobby.update(
+                session=session, if_version=self.lobby_version
+            )
+        await Event.insert_many(self.events, session=session)
+
+    async def commit(self) -> None:
+        if not self.transaction:
+            await self._flush(None)
+            return
+
+        try:
+            async with get_storage().transaction() as session:
+                await self._flush(session)
+        except Exception:
+            # The lobby may have been cached before the transaction aborted
+            if self.lobby is not None:
+                Lobby.cache.invalidate(self.lobby.id)
+            if self.transfers is not None:
+                Lobby.cache.invalidate(self.transfers.lobby_id)
+            raise
+
+
+# Document classes stored in their own collections
+document_classes: list[type[MongoDocument]] = [Lobby, Event, Ledger]
+
+
+async def ensure_indexes() -> None:
+    """
+    Create the declared indexes of every document class. This is idempotent;
+    an existing index whose options have changed is dropped and recreated.
+    """
+    db = get_db()
+    for cls in document_classes:
+        if not cls.indexes:
+            continue
+
+        await cls.prepare_indexes()
+        collection = db[cls.collection]
+        for index in cls.indexes:
+            try:
+                await collection.create_indexes([index])
+            except pymongo.errors.OperationFailure as error:
+                # IndexOptionsConflict, IndexKeySpecsConflict
+                if error.code not in (85, 86):
+                    raise
+                print(f"Recreating index {index.document['name']}...")
+                await collection.drop_index(index.document["name"])
+                await collection.create_indexes([index])
+
+
+def _find_stages(plan: typing.Mapping[str, typing.Any]) -> set[str]:
+    stages = {plan.get("stage", "")}
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            stages |= _find_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        stages |= _find_stages(child)
+    return stages
+
+
+async def check_indexes() -> list[str]:
+    """
+    Report declared indexes that are missing, and hot queries that would be
+    served by a collection scan. Returns the list of problems found.
+    """
+    db = get_db()
+    problems: list[str] = []
+    for cls in document_classes:
+        collection = db[cls.collection]
+        existing = await collection.index_information()
+        for index in cls.indexes:
+            if index.document["name"] not in existing:
+                problems.append(
+                    f"{cls.collection}: missing index {index.document['name']}"
+                )
+
+        for query, sort in cls.hot_queries:
+            cursor = collection.find(query)
+            if sort:
+                cursor = cursor.sort(sort)
+            explanation = await cursor.explain()
+            plan = explanation.get("queryPlanner", {}).get("winningPlan", {})
+            if "COLLSCAN" in _find_stages(plan):
+                problems.append(
+                    f"{cls.collection}: collection scan for {query} {sort}"
+                )
+
+    for problem in problems:
+        print("Index check:", problem)
+    return problems
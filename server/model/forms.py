@@ -9,4 +9,8 @@ import pydantic
 class TransferForm(pydantic.BaseModel):
     source: str
     destination: str
-    amount: int
+    amount: int = pydantic.Field(gt=0)
+
+
+class BatchTransferForm(pydantic.BaseModel):
+    transfers: list[TransferForm] = pydantic.Field(min_length=1, max_length=32)
@@ -0,0 +1,237 @@
+# stdlib imports
+import asyncio
+import os
+import random
+import threading
+import typing
+
+# vendor imports
+import bson.json_util
+import pymongo.errors
+import pymongo.monitoring
+
+# local imports
+from .. import metrics
+
+# Commands taking longer than this many milliseconds are logged
+SLOW_COMMAND_MS = float(os.environ.get("MONGO_SLOW_COMMAND_MS", 100))
+
+# Fraction of the queries of each shape that are explained, to find those
+# that don't use an index. Each shape is only reported once per process.
+EXPLAIN_SAMPLE_RATE = float(os.environ.get("MONGO_EXPLAIN_SAMPLE_RATE", 0.01))
+
+# Where the filter of each explainable command is found
+_filters: dict[str, typing.Callable[[dict], typing.Any]] = {
+    "find": lambda command: command.get("filter"),
+    "count": lambda command: command.get("query"),
+    "distinct": lambda command: command.get("query"),
+    "findAndModify": lambda command: command.get("query"),
+    "update": lambda command: command["updates"][0].get("q"),
+    "delete": lambda command: command["deletes"][0].get("q"),
+    "aggregate": lambda command: (command.get("pipeline") or [{}])[0].get(
+        "$match"
+    ),
+}
+
+# Fields of a command that belong to its session or transaction, rather than
+# to the operation itself
+_sessionFields = {
+    "lsid",
+    "txnNumber",
+    "autocommit",
+    "startTransaction",
+    "readConcern",
+    "writeConcern",
+}
+
+
+def _shape(value: typing.Any) -> typing.Any:
+    """The shape of a filter: its structure, without the values."""
+    if isinstance(value, dict):
+        return tuple(sorted((key, _shape(v)) for key, v in value.items()))
+    if isinstance(value, list):
+        return tuple(_shape(v) for v in value)
+    return None
+
+
+def _operation(command: dict) -> dict:
+    """A command without the fields of its session or transaction."""
+    return {
+        key: value
+        for key, value in command.items()
+        if not key.startswith("$") and key not in _sessionFields
+    }
+
+
+def _scans(plan: typing.Any) -> bool:
+    """Whether an explained plan scans a whole collection."""
+    if isinstance(plan, dict):
+        return plan.get("stage") == "COLLSCAN" or any(
+            _scans(value) for value in plan.values()
+        )
+    if isinstance(plan, list):
+        return any(_scans(value) for value in plan)
+    return False
+
+
+class CommandTracer(pymongo.monitoring.CommandListener):
+    """
+    Records every command sent to MongoDB in the metrics, and against the
+    request that made it (see `metrics.current_request`).
+
+    Motor runs commands, and therefore these callbacks, in a thread pool,
+    with a copy of the context of the coroutine that made them. Commands
+    slower than `SLOW_COMMAND_MS` are logged with the route and lobby of
+    their request, and queries are sampled and explained in the background
+    to report those that scan a whole collection.
+
+    A `getMore` on a tailable cursor that awaits data (e.g. the broadcasts
+    backend's) waits for new documents, so it is counted, but neither timed
+    nor logged as slow.
+    """
+
+    def __init__(self) -> None:
+        self.client: typing.Any = None
+        self.loop: typing.Optional[asyncio.AbstractEventLoop] = None
+
+        # Callbacks run in several threads at once
+        self.lock = threading.Lock()
+
+        # Started commands, until they succeed or fail
+        self.commands: dict[tuple[typing.Any, int], dict] = {}
+
+        # Ids of the open cursors that await data
+        self.awaiting: set[int] = set()
+
+        # Shapes of the queries that have been explained
+        self.explained: set[tuple] = set()
+
+    def attach(self, client: typing.Any) -> None:
+        """Set the client to explain queries with, on the running loop."""
+        self.client = client
+        self.loop = asyncio.get_running_loop()
+
+    def started(self, event: pymongo.monitoring.CommandStartedEvent) -> None:
+        if event.command_name == "explain":
+            return
+        with self.lock:
+            self.commands[(event.connection_id, event.request_id)] = (
+                event.command
+            )
+
+    def succeeded(
+        self, event: pymongo.monitoring.CommandSucceededEvent
+    ) -> None:
+        self._finished(event)
+
+    def failed(self, event: pymongo.monitoring.CommandFailedEvent) -> None:
+        self._finished(event)
+
+    def _finished(
+        self,
+        event: typing.Union[
+            pymongo.monitoring.CommandSucceededEvent,
+            pymongo.monitoring.CommandFailedEvent,
+        ],
+    ) -> None:
+        seconds = event.duration_micros / 1e6
+        request = metrics.current_request.get()
+        with self.lock:
+            command = self.commands.pop(
+                (event.connection_id, event.request_id), None
+            )
+            if command is None:
+                return
+
+            metrics.mongo_commands.inc(event.command_name)
+            if self._awaits(event, command):
+                return
+            metrics.mongo_command_duration.observe(seconds, event.command_name)
+            if request is not None:
+                request.mongo_commands += 1
+                request.mongo_seconds += seconds
+
+        if seconds * 1000 >= SLOW_COMMAND_MS:
+            self._log_slow(event, command, seconds, request)
+        if (
+            event.command_name in _filters
+            and isinstance(event, pymongo.monitoring.CommandSucceededEvent)
+            and random.random() < EXPLAIN_SAMPLE_RATE
+        ):
+            self._sample(event.database_name, event.command_name, command)
+
+    def _awaits(self, event: typing.Any, command: dict) -> bool:
+        """
+        Whether a command waited for data on a tailable cursor. Keeps track of
+        the cursors that await data, with the lock held.
+        """
+        reply = getattr(event, "reply", None) or {}
+        cursor = reply.get("cursor", {}).get("id", 0)
+        if event.command_name == "find" and command.get("awaitData"):
+            if cursor:
+                self.awaiting.add(cursor)
+        elif event.command_name == "getMore":
+            if command["getMore"] in self.awaiting:
+                if not cursor:
+                    self.awaiting.discard(command["getMore"])
+                return True
+        return False
+
+    def _log_slow(
+        self,
+        event: typing.Any,
+        command: dict,
+        seconds: float,
+        request: typing.Optional[metrics.RequestMetrics],
+    ) -> None:
+        with self.lock:
+            metrics.mongo_slow_commands.inc(event.command_name)
+        print(
+            "Slow MongoDB {} ({:.1f}ms) route={} lobby={}: {}".format(
+                event.command_name,
+                seconds * 1000,
+                request.route if request else None,
+                request.lobby if request else None,
+                bson.json_util.dumps(_operation(command))[:500],
+            )
+        )
+
+    def _sample(self, database: str, name: str, command: dict) -> None:
+        try:
+            query = _filters[name](command)
+        except (IndexError, KeyError, AttributeError):
+            return
+        shape = (database, name, command.get(name), _shape(query))
+        with self.lock:
+            if shape in self.explained or self.loop is None:
+                return
+            self.explained.add(shape)
+
+        self.loop.call_soon_threadsafe(
+            asyncio.ensure_future,
+            self._explain(database, name, _operation(command)),
+        )
+
+    async def _explain(
+        self, database: str, name: str, operation: dict
+    ) -> None:
+        try:
+            plan = await self.client[database].command(
+                {"explain": operation, "verbosity": "queryPlanner"}
+            )
+        except pymongo.errors.PyMongoError:
+            return
+
+        if _scans(plan):
+            collection = operation.get(name)
+            metrics.mongo_unindexed_queries.inc(str(collection))
+            print(
+                "Unindexed MongoDB {} on {}: {}".format(
+                    name,
+                    collection,
+                    bson.json_util.dumps(_filters[name](operation))[:500],
+                )
+            )
+
+
+tracer = CommandTracer()
@@ -0,0 +1,811 @@
+# stdlib imports
+import abc
+import asyncio
+import bisect
+import contextlib
+import datetime
+import typing
+
+# vendor imports
+from bson.objectid import ObjectId
+import motor.motor_asyncio
+import pymongo
+import pymongo.errors
+
+# local imports
+
+# Collections of the document classes
+LOBBIES = "lobbies"
+EVENTS = "events"
+LEDGERS = "ledgers"
+
+Document = dict[str, typing.Any]
+
+# Position of an event in the history of its lobby, ordered by (time, _id)
+EventPosition = tuple[datetime.datetime, ObjectId]
+
+
+class TransferBatch(typing.Protocol):
+    """The parts of `transfer.TransferUpdate` that storage engines use."""
+
+    lobby_id: ObjectId
+    changes: dict[typing.Union[str, ObjectId], int]
+    increments: dict[str, int]
+    array_filters: list[dict[str, typing.Any]]
+
+    def requirements(self) -> dict[typing.Union[str, ObjectId], int]:
+        """Funds each account must hold for the transfers to be made."""
+        ...
+
+    def query(
+        self, banker: typing.Optional[ObjectId] = None
+    ) -> dict[str, typing.Any]:
+        """Filter matching the lobby only if the transfers can be made."""
+        ...
+
+
+class Storage(abc.ABC):
+    """
+    Base class for the engines that store documents. Documents are passed as
+    plain dicts, as stored in MongoDB.
+
+    Besides reads and writes of documents by id, engines implement the few
+    queries the server makes, so that each engine can serve them from its
+    own indexes. Documents returned by an engine must not be modified.
+    """
+
+    # Whether removed lobbies can be archived
+    archives = False
+
+    @abc.abstractmethod
+    def transaction(
+        self,
+    ) -> typing.AsyncContextManager[typing.Any]:
+        """Context in which writes passed its session are made atomically."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get(
+        self, collection: str, id: ObjectId
+    ) -> typing.Optional[Document]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def insert_many(
+        self,
+        collection: str,
+        documents: list[Document],
+        session: typing.Any = None,
+    ) -> None:
+        """Insert new documents. Raises `DuplicateKeyError` on a clash."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def replace(
+        self,
+        collection: str,
+        document: Document,
+        if_version: typing.Optional[int] = None,
+        session: typing.Any = None,
+    ) -> bool:
+        """
+        Replace a document. If `if_version` is given, only replace it if its
+        stored version matches (a missing version matches 0). Returns whether
+        the document was replaced.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def find_lobby(
+        self,
+        id: typing.Optional[ObjectId] = None,
+        code: typing.Optional[str] = None,
+        now: typing.Optional[datetime.datetime] = None,
+        projection: typing.Optional[dict[str, int]] = None,
+    ) -> typing.Optional[Document]:
+        """
+        Find a lobby that is not disbanded by its id or join code. If `now`
+        is given, the lobby must also not have expired by then. If a
+        `projection` is given, only the fields it includes are needed.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def lobby_codes(
+        self, now: datetime.datetime
+    ) -> list[tuple[str, datetime.datetime]]:
+        """The codes and expiry of the lobbies active at `now`."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def disband_lobby(self, id: ObjectId) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def apply_transfers(
+        self,
+        update: TransferBatch,
+        banker: typing.Optional[ObjectId] = None,
+        session: typing.Any = None,
+    ) -> typing.Optional[Document]:
+        """
+        Atomically apply a batch of transfers to an active lobby, if its
+        accounts exist and have the required funds (and `banker` is still
+        the banker, if given). Returns the updated lobby, or None.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def event_position(
+        self, lobby_id: ObjectId, event_id: ObjectId
+    ) -> typing.Optional[EventPosition]:
+        """The position of an event of a lobby, if it exists."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def lobby_events(
+        self,
+        lobby_id: ObjectId,
+        after: typing.Optional[EventPosition] = None,
+        last: typing.Optional[int] = None,
+        batch_size: typing.Optional[int] = None,
+        limit: typing.Optional[int] = None,
+    ) -> typing.AsyncIterator[Document]:
+        """
+        The events of a lobby in order. Only the events following `after`
+        are returned if it's given, otherwise only the `last` events. At
+        most `limit` events are returned, if it's given.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def record_ledger(
+        self,
+        lobby_id: ObjectId,
+        increments: dict[str, int],
+        first: EventPosition,
+        last: EventPosition,
+        session: typing.Any = None,
+    ) -> bool:
+        """
+        Count the events from `first` to `last` into the existing ledger of
+        a lobby, in one atomic update: add `increments`, and move its
+        position to `last` if that follows it. Nothing changes if the ledger
+        was built from a scan that reached `first`, as the events are
+        already counted. Returns whether the ledger exists.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def drop_ledger(self, lobby_id: ObjectId) -> None:
+        """Remove the ledger of a lobby, so that it's rebuilt on next use."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def count_lobbies(self, now: datetime.datetime) -> dict[str, int]:
+        """The number of active, expired and disbanded lobbies stored."""
+        raise NotImplementedError
+
+    async def prepare_archive(self, retention: float) -> None:
+        """Prepare to archive lobbies, for `retention` seconds."""
+        pass
+
+    @abc.abstractmethod
+    async def finished_lobbies(
+        self, cutoff: datetime.datetime, limit: int
+    ) -> list[Document]:
+        """Lobbies that are disbanded, or that expired before `cutoff`."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def remove_lobbies(
+        self,
+        lobbies: list[Document],
+        archived: typing.Optional[datetime.datetime] = None,
+        pause: float = 0,
+    ) -> int:
+        """
+        Delete lobbies along with their events and ledgers, archiving them
+        first if `archived` is given. Events are removed in batches, with a
+        `pause` of that many seconds after each. Returns the number of events
+        removed.
+        """
+        raise NotImplementedError
+
+
+class MotorStorage(Storage):
+    """Storage in a MongoDB database, through Motor."""
+
+    archives = True
+    lobby_archive = "lobbies_archive"
+    event_archive = "events_archive"
+
+    def __init__(
+        self, database: motor.motor_asyncio.AsyncIOMotorDatabase
+    ) -> None:
+        self.database = database
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        async with await self.database.client.start_session() as session:
+            async with session.start_transaction():
+                yield session
+
+    async def get(
+        self, collection: str, id: ObjectId
+    ) -> typing.Optional[Document]:
+        return await self.database[collection].find_one({"_id": id})
+
+    async def insert_many(
+        self,
+        collection: str,
+        documents: list[Document],
+        session: typing.Any = None,
+    ) -> None:
+        await self.database[collection].insert_many(documents, session=session)
+
+    async def replace(
+        self,
+        collection: str,
+        document: Document,
+        if_version: typing.Optional[int] = None,
+        session: typing.Any = None,
+    ) -> bool:
+        query: dict[str, typing.Any] = {"_id": document["_id"]}
+        if if_version == 0:
+            # Lobbies stored before they were versioned have no version
+            query["version"] = {"$in": [0, None]}
+        elif if_version is not None:
+            query["version"] = if_version
+        result = await self.database[collection].replace_one(
+            query, document, session=session
+        )
+        return result.matched_count > 0
+
+    async def find_lobby(
+        self,
+        id: typing.Optional[ObjectId] = None,
+        code: typing.Optional[str] = None,
+        now: typing.Optional[datetime.datetime] = None,
+        projection: typing.Optional[dict[str, int]] = None,
+    ) -> typing.Optional[Document]:
+        query: dict[str, typing.Any] = {"disbanded": False}
+        if id is not None:
+            query["_id"] = id
+        if code is not None:
+            query["code"] = code
+        if now is not None:
+            query["expires"] = {"$gt": now}
+        return await self.database[LOBBIES].find_one(query, projection)
+
+    async def lobby_codes(
+        self, now: datetime.datetime
+    ) -> list[tuple[str, datetime.datetime]]:
+        return [
+            (document["code"], document["expires"])
+            async for document in self.database[LOBBIES].find(
+                {"expires": {"$gt": now}, "disbanded": False},
+                {"code": 1, "expires": 1},
+            )
+        ]
+
+    async def disband_lobby(self, id: ObjectId) -> None:
+        await self.database[LOBBIES].update_one(
+            {"_id": id}, {"$set": {"disbanded": True}}
+        )
+
+    async def apply_transfers(
+        self,
+        update: TransferBatch,
+        banker: typing.Optional[ObjectId] = None,
+        session: typing.Any = None,
+    ) -> typing.Optional[Document]:
+        return await self.database[LOBBIES].find_one_and_update(
+            update.query(banker),
+            {"$inc": {**update.increments, "version": 1}},
+            array_filters=update.array_filters or None,
+            return_document=pymongo.ReturnDocument.AFTER,
+            session=session,
+        )
+
+    async def event_position(
+        self, lobby_id: ObjectId, event_id: ObjectId
+    ) -> typing.Optional[EventPosition]:
+        document = await self.database[EVENTS].find_one(
+            {"_id": event_id, "lobby": lobby_id}, {"time": 1}
+        )
+        return (document["time"], event_id) if document else None
+
+    async def lobby_events(
+        self,
+        lobby_id: ObjectId,
+        after: typing.Optional[EventPosition] = None,
+        last: typing.Optional[int] = None,
+        batch_size: typing.Optional[int] = None,
+        limit: typing.Optional[int] = None,
+    ) -> typing.AsyncIterator[Document]:
+        collection = self.database[EVENTS]
+        query: dict[str, typing.Any] = {"lobby": lobby_id}
+        if after is not None:
+            query["$or"] = [
+                {"time": {"$gt": after[0]}},
+                {"time": after[0], "_id": {"$gt": after[1]}},
+            ]
+        elif last is not None:
+            # Find the oldest of the last events, and start there
+            oldest = (
+                await collection.find(query, {"time": 1})
+                .sort([("time", -1), ("_id", -1)])
+                .skip(last - 1)
+                .limit(1)
+                .to_list(1)
+            )
+            if oldest:
+                query["$or"] = [
+                    {"time": {"$gt": oldest[0]["time"]}},
+                    {
+                        "time": oldest[0]["time"],
+                        "_id": {"$gte": oldest[0]["_id"]},
+                    },
+                ]
+
+        cursor = collection.find(query).sort([("time", 1), ("_id", 1)])
+        if batch_size is not None:
+            cursor = cursor.batch_size(batch_size)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        async for document in cursor:
+            yield document
+
+    async def record_ledger(
+        self,
+        lobby_id: ObjectId,
+        increments: dict[str, int],
+        first: EventPosition,
+        last: EventPosition,
+        session: typing.Any = None,
+    ) -> bool:
+        def precedes(field: str, position: EventPosition) -> dict:
+            # Null (nothing scanned or counted) sorts before any date
+            return {
+                "$or": [
+                    {"$lt": [f"${field}Time", position[0]]},
+                    {
+                        "$and": [
+                            {"$eq": [f"${field}Time", position[0]]},
+                            {"$lt": [f"${field}Event", position[1]]},
+                        ]
+                    },
+                ]
+            }
+
+        # A pipeline update, so that every field is set from the same
+        # comparisons, against the ledger as it was
+        uncounted = precedes("built", first)
+        follows = {"$and": [uncounted, precedes("last", last)]}
+        changes: dict[str, typing.Any] = {
+            path: {
+                "$cond": [
+                    uncounted,
+                    {"$add": [{"$ifNull": [f"${path}", 0]}, change]},
+                    f"${path}",
+                ]
+            }
+            for path, change in increments.items()
+        }
+        changes["lastTime"] = {"$cond": [follows, last[0], "$lastTime"]}
+        changes["lastEvent"] = {"$cond": [follows, last[1], "$lastEvent"]}
+        result = await self.database[LEDGERS].update_one(
+            {"_id": lobby_id}, [{"$set": changes}], session=session
+        )
+        return result.matched_count > 0
+
+    async def drop_ledger(self, lobby_id: ObjectId) -> None:
+        await self.database[LEDGERS].delete_one({"_id": lobby_id})
+
+    async def count_lobbies(self, now: datetime.datetime) -> dict[str, int]:
+        collection = self.database[LOBBIES]
+        return {
+            "active": await collection.count_documents(
+                {"disbanded": False, "expires": {"$gt": now}}
+            ),
+            "expired": await collection.count_documents(
+                {"disbanded": False, "expires": {"$lte": now}}
+            ),
+            "disbanded": await collection.count_documents({"disbanded": True}),
+        }
+
+    async def prepare_archive(self, retention: float) -> None:
+        for collection in (self.lobby_archive, self.event_archive):
+            await self.database[collection].create_index(
+                [("archived", pymongo.ASCENDING)],
+                name="archived_ttl",
+                expireAfterSeconds=int(retention),
+            )
+        await self.database[self.event_archive].create_index(
+            [
+                ("lobby", pymongo.ASCENDING),
+                ("time", pymongo.ASCENDING),
+                ("_id", pymongo.ASCENDING),
+            ],
+            name="lobby_time",
+        )
+
+    async def finished_lobbies(
+        self, cutoff: datetime.datetime, limit: int
+    ) -> list[Document]:
+        return (
+            await self.database[LOBBIES]
+            .find(
+                {"$or": [{"disbanded": True}, {"expires": {"$lte": cutoff}}]}
+            )
+            .limit(limit)
+            .to_list(None)
+        )
+
+    async def _copy(
+        self,
+        collection: str,
+        documents: list[Document],
+        archived: datetime.datetime,
+    ) -> None:
+        try:
+            await self.database[collection].insert_many(
+                [{**document, "archived": archived} for document in documents],
+                ordered=False,
+            )
+        except pymongo.errors.BulkWriteError as error:
+            # Documents archived by an earlier, interrupted run are fine
+            if any(e["code"] != 11000 for e in error.details["writeErrors"]):
+                raise
+
+    async def remove_lobbies(
+        self,
+        lobbies: list[Document],
+        archived: typing.Optional[datetime.datetime] = None,
+        pause: float = 0,
+    ) -> int:
+        query = {"_id": {"$in": [lobby["_id"] for lobby in lobbies]}}
+
+        # Events are moved first, so that an interrupted run leaves no
+        # orphaned events behind its archived lobbies
+        events = 0
+        event_query = {"lobby": query["_id"]}
+        while True:
+            documents = (
+                await self.database[EVENTS]
+                .find(event_query)
+                .limit(1000)
+                .to_list(None)
+            )
+            if not documents:
+                break
+            if archived is not None:
+                await self._copy(self.event_archive, documents, archived)
+            await self.database[EVENTS].delete_many(
+                {"_id": {"$in": [event["_id"] for event in documents]}}
+            )
+            events += len(documents)
+            await asyncio.sleep(pause)
+
+        # Ledgers are archived as part of their lobby
+        if archived is not None:
+            ledgers = {
+                ledger["_id"]: ledger
+                async for ledger in self.database[LEDGERS].find(query)
+            }
+            await self._copy(
+                self.lobby_archive,
+                [
+                    {**lobby, "ledger": ledgers.get(lobby["_id"])}
+                    for lobby in lobbies
+                ],
+                archived,
+            )
+        await self.database[LEDGERS].delete_many(query)
+        await self.database[LOBBIES].delete_many(query)
+        return events
+
+
+class MemoryStorage(Storage):
+    """
+    Storage in the memory of this process, for single process deployments,
+    development and benchmarks. Nothing is persisted.
+
+    Documents are indexed by id, lobbies also by the code of those that are
+    not disbanded, and events by lobby in history order. Writes are made
+    without awaiting, so each is atomic, and transactions are not needed.
+    """
+
+    def __init__(self) -> None:
+        self.collections: dict[str, dict[ObjectId, Document]] = {
+            LOBBIES: {},
+            EVENTS: {},
+            LEDGERS: {},
+        }
+        self._codes: dict[str, ObjectId] = {}
+        self._events: dict[ObjectId, list[tuple[EventPosition, Document]]] = {}
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        yield None
+
+    async def get(
+        self, collection: str, id: ObjectId
+    ) -> typing.Optional[Document]:
+        return self.collections.setdefault(collection, {}).get(id)
+
+    def _index_lobby(
+        self, document: Document, previous: typing.Optional[Document]
+    ) -> None:
+        if previous is not None and not previous["disbanded"]:
+            del self._codes[previous["code"]]
+        if not document["disbanded"]:
+            self._codes[document["code"]] = document["_id"]
+
+    async def insert_many(
+        self,
+        collection: str,
+        documents: list[Document],
+        session: typing.Any = None,
+    ) -> None:
+        stored = self.collections.setdefault(collection, {})
+        for document in documents:
+            if document["_id"] in stored or (
+                collection == LOBBIES
+                and not document["disbanded"]
+                and document["code"] in self._codes
+            ):
+                raise pymongo.errors.DuplicateKeyError(
+                    f"Duplicate key in {collection}"
+                )
+
+        for document in documents:
+            stored[document["_id"]] = document
+            if collection == LOBBIES:
+                self._index_lobby(document, None)
+            elif collection == EVENTS:
+                bisect.insort(
+                    self._events.setdefault(document["lobby"], []),
+                    ((document["time"], document["_id"]), document),
+                    key=lambda entry: entry[0],
+                )
+
+    async def replace(
+        self,
+        collection: str,
+        document: Document,
+        if_version: typing.Optional[int] = None,
+        session: typing.Any = None,
+    ) -> bool:
+        stored = self.collections.setdefault(collection, {})
+        previous = stored.get(document["_id"])
+        if previous is None or (
+            if_version is not None and previous.get("version", 0) != if_version
+        ):
+            return False
+
+        if collection == LOBBIES:
+            code = self._codes.get(document["code"])
+            if not document["disbanded"] and code not in (
+                None,
+                document["_id"],
+            ):
+                raise pymongo.errors.DuplicateKeyError(
+                    f"Duplicate key in {collection}"
+                )
+            self._index_lobby(document, previous)
+        stored[document["_id"]] = document
+        return True
+
+    async def find_lobby(
+        self,
+        id: typing.Optional[ObjectId] = None,
+        code: typing.Optional[str] = None,
+        now: typing.Optional[datetime.datetime] = None,
+        projection: typing.Optional[dict[str, int]] = None,
+    ) -> typing.Optional[Document]:
+        if code is not None:
+            found = self._codes.get(code)
+            if found is None or (id is not None and found != id):
+                return None
+            id = found
+        document = self.collections[LOBBIES].get(id) if id else None
+        if (
+            document is None
+            or document["disbanded"]
+            or (now is not None and document["expires"] <= now)
+        ):
+            return None
+
+        # Documents are already in memory, so projecting them would only add
+        # work; the whole document is returned
+        return document
+
+    async def lobby_codes(
+        self, now: datetime.datetime
+    ) -> list[tuple[str, datetime.datetime]]:
+        lobbies = self.collections[LOBBIES]
+        return [
+            (code, lobbies[id]["expires"])
+            for code, id in self._codes.items()
+            if lobbies[id]["expires"] > now
+        ]
+
+    async def disband_lobby(self, id: ObjectId) -> None:
+        document = self.collections[LOBBIES].get(id)
+        if document is not None:
+            await self.replace(LOBBIES, {**document, "disbanded": True})
+
+    async def apply_transfers(
+        self,
+        update: TransferBatch,
+        banker: typing.Optional[ObjectId] = None,
+        session: typing.Any = None,
+    ) -> typing.Optional[Document]:
+        document = await self.find_lobby(
+            update.lobby_id, now=datetime.datetime.utcnow()
+        )
+        if document is None or (
+            banker is not None and document["banker"] != banker
+        ):
+            return None
+
+        players = {player["_id"]: player for player in document["players"]}
+
+        def balance(account: typing.Union[str, ObjectId]):
+            if isinstance(account, str):
+                return document[account]
+            player = players.get(account)
+            return player["balance"] if player is not None else None
+
+        for account in update.changes:
+            if balance(account) is None:
+                return None
+        for account, amount in update.requirements().items():
+            if balance(account) < amount:
+                return None
+
+        # Copy the parts being changed, leaving the stored document intact
+        document = {**document, "version": document["version"] + 1}
+        document["players"] = [dict(player) for player in document["players"]]
+        players = {player["_id"]: player for player in document["players"]}
+        for account, change in update.changes.items():
+            if isinstance(account, str):
+                document[account] += change
+            else:
+                players[account]["balance"] += change
+
+        await self.replace(LOBBIES, document)
+        return document
+
+    async def event_position(
+        self, lobby_id: ObjectId, event_id: ObjectId
+    ) -> typing.Optional[EventPosition]:
+        document = self.collections[EVENTS].get(event_id)
+        if document is None or document["lobby"] != lobby_id:
+            return None
+        return (document["time"], event_id)
+
+    async def lobby_events(
+        self,
+        lobby_id: ObjectId,
+        after: typing.Optional[EventPosition] = None,
+        last: typing.Optional[int] = None,
+        batch_size: typing.Optional[int] = None,
+        limit: typing.Optional[int] = None,
+    ) -> typing.AsyncIterator[Document]:
+        events = self._events.get(lobby_id, [])
+        if after is not None:
+            start = bisect.bisect_right(
+                events, after, key=lambda entry: entry[0]
+            )
+        elif last is not None:
+            start = max(len(events) - last, 0)
+        else:
+            start = 0
+
+        # Take a copy, in case events are inserted while iterating
+        end = start + limit if limit is not None else None
+        for _, document in events[start:end]:
+            yield document
+
+    async def record_ledger(
+        self,
+        lobby_id: ObjectId,
+        increments: dict[str, int],
+        first: EventPosition,
+        last: EventPosition,
+        session: typing.Any = None,
+    ) -> bool:
+        ledger = self.collections[LEDGERS].get(lobby_id)
+        if ledger is None:
+            return False
+
+        def position(field: str) -> typing.Optional[EventPosition]:
+            if ledger.get(f"{field}Time") is None:
+                return None
+            return (ledger[f"{field}Time"], ledger[f"{field}Event"])
+
+        built, counted = position("built"), position("last")
+        if built is not None and built >= first:
+            return True
+
+        ledger = dict(ledger)
+        for path, change in increments.items():
+            parent = ledger
+            *parents, field = path.split(".")
+            for key in parents:
+                parent[key] = parent = dict(parent.get(key, {}))
+            parent[field] = parent.get(field, 0) + change
+        if counted is None or last > counted:
+            ledger["lastTime"], ledger["lastEvent"] = last
+        self.collections[LEDGERS][lobby_id] = ledger
+        return True
+
+    async def drop_ledger(self, lobby_id: ObjectId) -> None:
+        self.collections[LEDGERS].pop(lobby_id, None)
+
+    async def count_lobbies(self, now: datetime.datetime) -> dict[str, int]:
+        counts = {"active": 0, "expired": 0, "disbanded": 0}
+        for document in self.collections[LOBBIES].values():
+            if document["disbanded"]:
+                counts["disbanded"] += 1
+            elif document["expires"] > now:
+                counts["active"] += 1
+            else:
+                counts["expired"] += 1
+        return counts
+
+    async def finished_lobbies(
+        self, cutoff: datetime.datetime, limit: int
+    ) -> list[Document]:
+        finished = []
+        for document in self.collections[LOBBIES].values():
+            if document["disbanded"] or document["expires"] <= cutoff:
+                finished.append(document)
+                if len(finished) >= limit:
+                    break
+        return finished
+
+    async def remove_lobbies(
+        self,
+        lobbies: list[Document],
+        archived: typing.Optional[datetime.datetime] = None,
+        pause: float = 0,
+    ) -> int:
+        # There is nowhere to archive to, so lobbies are only deleted
+        events = 0
+        for lobby in lobbies:
+            stored = self.collections[LOBBIES].pop(lobby["_id"], None)
+            if stored is not None and not stored["disbanded"]:
+                del self._codes[stored["code"]]
+            self.collections[LEDGERS].pop(lobby["_id"], None)
+            for _, event in self._events.pop(lobby["_id"], []):
+                del self.collections[EVENTS][event["_id"]]
+                events += 1
+        return events
+
+
+class ObservedStorage:
+    """
+    Wraps an engine, and calls `observe` with the name of every operation
+    made through it (e.g. to count them).
+    """
+
+    def __init__(
+        self, engine: Storage, observe: typing.Callable[[str], None]
+    ) -> None:
+        self.engine = engine
+        self.observe = observe
+
+    def __getattr__(self, name: str) -> typing.Any:
+        attribute = getattr(self.engine, name)
+        if name.startswith("_") or not callable(attribute):
+            return attribute
+
+        def observed(*args, **kwargs):
+            self.observe(name)
+            return attribute(*args, **kwargs)
+
+        return observed
@@ -0,0 +1,124 @@
+# stdlib imports
+import asyncio
+import datetime
+import os
+import typing
+
+# vendor imports
+
+# local imports
+from . import model
+
+
+class Reaper:
+    """
+    Background task that moves finished lobbies, and their events, out of the
+    live collections.
+
+    Every `interval` seconds, lobbies that are disbanded, or that expired more
+    than `grace` seconds ago, are copied (with their ledger embedded) to the
+    `lobbies_archive` collection, and their events to `events_archive`, and
+    then deleted. Archived documents are kept for `retention` seconds. If
+    `archive` is false, they are deleted without being copied.
+
+    Lobbies are handled `batch_size` at a time, and their events a thousand
+    at a time, with a `pause` after each batch of either, so that a large
+    backlog never competes for long with the requests of active lobbies.
+    Several processes may run a reaper at once; copies are idempotent, so at
+    worst a batch is archived twice. With the in-memory storage, lobbies are
+    always deleted.
+
+    The TTL indexes of the live collections (see `Lobby.indexes`) remain as
+    a backstop, should the reaper be disabled.
+    """
+
+    def __init__(
+        self,
+        interval: float = 600,
+        grace: float = 3600,
+        retention: float = 30 * 24 * 60 * 60,
+        batch_size: int = 100,
+        pause: float = 0.5,
+        archive: bool = True,
+    ) -> None:
+        self.interval = interval
+        self.grace = grace
+        self.retention = retention
+        self.batch_size = batch_size
+        self.pause = pause
+        self.archive = archive
+        self.task: typing.Optional[asyncio.Task] = None
+
+        # Totals for the last completed run
+        self.last_report: dict[str, typing.Any] = {}
+
+    async def start(self) -> None:
+        if self.interval <= 0:
+            return
+        if self.archive:
+            await model.db.get_storage().prepare_archive(self.retention)
+        self.task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await self.run()
+            except Exception as error:
+                # Keep reaping on the next run, whatever went wrong
+                print("Reaper run failed:", repr(error))
+            await asyncio.sleep(self.interval)
+
+    async def run(self) -> dict[str, typing.Any]:
+        """Reap every lobby that is ready, and report what was done."""
+        started = datetime.datetime.utcnow()
+        cutoff = started - datetime.timedelta(seconds=self.grace)
+        storage = model.db.get_storage()
+        archive = self.archive and storage.archives
+        report = {"lobbies": 0, "events": 0, "batches": 0}
+
+        while True:
+            lobbies = await storage.finished_lobbies(cutoff, self.batch_size)
+            if not lobbies:
+                break
+
+            report["events"] += await storage.remove_lobbies(
+                lobbies, started if archive else None, self.pause
+            )
+            for lobby in lobbies:
+                model.db.Lobby.cache.invalidate(lobby["_id"])
+                model.db.removed_lobbies.add(lobby["_id"])
+            report["lobbies"] += len(lobbies)
+            report["batches"] += 1
+            await asyncio.sleep(self.pause)
+
+        report["seconds"] = round(
+            (datetime.datetime.utcnow() - started).total_seconds(), 3
+        )
+        self.last_report = report
+        if report["lobbies"]:
+            print(
+                "Reaper {} {} lobbies and {} events in {}s".format(
+                    "archived" if archive else "deleted",
+                    report["lobbies"],
+                    report["events"],
+                    report["seconds"],
+                )
+            )
+        return report
+
+
+reaper = Reaper(
+    interval=float(os.environ.get("REAPER_INTERVAL", 600)),
+    grace=float(os.environ.get("REAPER_GRACE_SECONDS", 3600)),
+    retention=float(
+        os.environ.get("ARCHIVE_RETENTION_SECONDS", 30 * 24 * 60 * 60)
+    ),
+    batch_size=int(os.environ.get("REAPER_BATCH_SIZE", 100)),
+    pause=float(os.environ.get("REAPER_PAUSE", 0.5)),
+    archive=os.environ.get("REAPER_MODE", "archive") != "delete",
+)
@@ -1,121 +1,586 @@
 # stdlib imports
+import asyncio
+import enum
+import json
+import os
+import time
 
 # vendor imports
-import bson.json_util
 import fastapi
 import starlette.websockets
 import typing
 
 # local imports
-from . import model
-
+from . import broadcast, helpers, metrics, model
+from .messages import Message, compose_lobby_delta
 
 # Create the router
 socketRouter = fastapi.APIRouter()
 
 
+async def send_message(
+    sock: fastapi.WebSocket, message: Message, binary: bool = False
+) -> None:
+    """Send a message to a socket, in the protocol it negotiated."""
+    if binary:
+        await sock.send_bytes(message.binary())
+    else:
+        await sock.send_text(message.text())
+
+
 def compose_update_message(
     lobby: model.db.Lobby, events: list[model.db.Event]
-) -> str:
-    return bson.json_util.dumps(
-        {
-            "type": "update",
-            "payload": {
-                "lobby": lobby.document(),
-                "events": [e.document() for e in events],
-            },
-        }
+) -> Message:
+    return Message(
+        {"type": "update", "payload": {"lobby": lobby, "events": events}}
     )
 
 
 def compose_kick_message(
     player: typing.Optional[model.db.Player] = None,
-) -> str:
-    return bson.json_util.dumps(
-        {"type": "kick", "player": player.id if player else None}
-    )
+) -> Message:
+    return Message({"type": "kick", "player": player.id if player else None})
+
+
+def compose_resync_message() -> Message:
+    return Message({"type": "resync"})
+
+
+# Sent to every socket on each heartbeat. Clients answer with a "pong".
+PING_MESSAGE = Message({"type": "ping"})
+
+
+def is_disband_message(message: Message) -> bool:
+    """Whether a message kicks every player, i.e. the lobby was disbanded."""
+    data = message.data or message.documents()
+    return data.get("type") == "kick" and data.get("player") is None
+
+
+async def close_socket(sock: fastapi.WebSocket) -> None:
+    """Close a socket, unless it is already closed."""
+    if sock.application_state != starlette.websockets.WebSocketState.CONNECTED:
+        return
+    try:
+        await sock.close()
+    except Exception:
+        pass
+
+
+# Maximum number of outbound messages queued for a single socket
+SEND_QUEUE_SIZE = 32
+
+# Seconds to wait for a single message to be sent before giving up on a socket
+SEND_TIMEOUT = 10.0
+
+# Seconds between the pings sent to every socket, or 0 to send none
+PING_INTERVAL = float(os.environ.get("WEBSOCKET_PING_INTERVAL", 20))
+
+# Seconds without any message from a client before its socket is closed. Pings
+# are answered, so only dead connections should ever be idle for this long.
+IDLE_TIMEOUT = float(os.environ.get("WEBSOCKET_IDLE_TIMEOUT", 60))
+
+
+class SlowConsumerPolicy(enum.Enum):
+    """What to do with a socket whose outbound queue has filled up."""
+
+    # Drop the queued messages and tell the client to reconnect and resync
+    RESYNC = "resync"
+
+    # Drop the queued messages and close the socket
+    DISCONNECT = "disconnect"
+
+
+class SocketWriter:
+    """
+    Outbound message queue for a single socket, drained by its own task, so
+    that a slow client never holds up a broadcast to the rest of the lobby.
+
+    Messages are queued, but not sent, until `ready` is set (e.g. once the
+    socket has been sent the history of its lobby).
+    """
+
+    def __init__(
+        self,
+        lobby_id: model.db.ObjectId,
+        sock: fastapi.WebSocket,
+        policy: SlowConsumerPolicy,
+        binary: bool = False,
+        deltas: bool = False,
+        ready: bool = True,
+    ) -> None:
+        self.lobby_id = lobby_id
+        self.sock = sock
+        self.policy = policy
+        self.binary = binary
+        self.deltas = deltas
+        self.stalled = False
+        self.ready = asyncio.Event()
+        if ready:
+            self.ready.set()
+
+        # Messages are queued with the time they were queued at. A `None`
+        # message tells the writer to close the socket.
+        self.queue: asyncio.Queue[tuple[float, typing.Optional[Message]]] = (
+            asyncio.Queue(SEND_QUEUE_SIZE)
+        )
+        self.task = asyncio.create_task(self._drain())
+
+    async def _drain(self) -> None:
+        await self.ready.wait()
+        while True:
+            queued, message = await self.queue.get()
+            if (
+                self.sock.application_state
+                != starlette.websockets.WebSocketState.CONNECTED
+            ):
+                return
+
+            try:
+                if message is None:
+                    await self.sock.close()
+                    return
+                if self.deltas and message.delta is not None:
+                    message = message.delta
+                await asyncio.wait_for(
+                    send_message(self.sock, message, self.binary), SEND_TIMEOUT
+                )
+                metrics.socket_send_delay.observe(time.perf_counter() - queued)
+                metrics.socket_message_bytes.observe(
+                    message.size(self.binary),
+                    "msgpack" if self.binary else "json",
+                )
+
+            # Any error here means the connection has gone away underneath us
+            # or is stuck. It is removed by the endpoint once it disconnects,
+            # or by the next heartbeat.
+            except Exception:
+                await close_socket(self.sock)
+                return
+
+    def send(self, message: Message) -> None:
+        """Queue a message without waiting for it to be sent."""
+        if self.stalled:
+            return
+
+        try:
+            self.queue.put_nowait((time.perf_counter(), message))
+        except asyncio.QueueFull:
+            self.stall()
+
+    def stall(self) -> None:
+        """Apply the slow consumer policy to this socket."""
+        self.stalled = True
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+        if self.policy is SlowConsumerPolicy.RESYNC:
+            self.queue.put_nowait(
+                (time.perf_counter(), compose_resync_message())
+            )
+        else:
+            self.queue.put_nowait((time.perf_counter(), None))
+
+    def finish(self) -> None:
+        """Close the socket once the messages queued so far are sent."""
+        if self.stalled:
+            return
+        try:
+            self.queue.put_nowait((time.perf_counter(), None))
+        except asyncio.QueueFull:
+            self.stalled = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait((time.perf_counter(), None))
+
+    def close(self) -> None:
+        self.task.cancel()
+
+
+class PendingUpdate:
+    """An update of a lobby held back to be merged with those that follow."""
+
+    def __init__(self, lobby: model.db.Lobby) -> None:
+        self.lobby = lobby
+        self.events: list[model.db.Event] = []
+
+        # Version of the lobby before the first of the merged updates
+        self.base = lobby.version - 1
+        self.task: typing.Optional[asyncio.Task] = None
 
 
 class ConnectionManager:
-    def __init__(self) -> None:
+    """
+    The sockets held by this process, and the broadcasts sent to them.
+
+    If `window` is set, updates of a lobby are held back for up to `window`
+    seconds after the first, and those that follow within the window are
+    merged into it: the events are concatenated, and only the latest state
+    of the lobby is sent. Kicks and disbands flush the pending update
+    straight away.
+    """
+
+    def __init__(
+        self,
+        policy: SlowConsumerPolicy = SlowConsumerPolicy.RESYNC,
+        backend: typing.Optional[broadcast.BroadcastBackend] = None,
+        window: float = 0,
+    ) -> None:
+        self.policy = policy
+        self.backend = backend or broadcast.MemoryBroadcastBackend()
+        self.window = window
+        self.pending: dict[model.db.ObjectId, PendingUpdate] = {}
         self.lobby_sockets: dict[
             model.db.ObjectId, list[fastapi.WebSocket]
         ] = {}
+        self.writers: dict[fastapi.WebSocket, SocketWriter] = {}
+        self.heartbeat: typing.Optional[asyncio.Task] = None
+
+        # Last lobby state broadcast by this process, to compute deltas from
+        self.lobby_states: model.db.DocumentCache[model.db.Lobby] = (
+            model.db.DocumentCache("lobby_states", size=4096, ttl=24 * 60 * 60)
+        )
 
     def register_connection(
-        self, lobby_id: model.db.ObjectId, sock: fastapi.WebSocket
-    ) -> None:
+        self,
+        lobby_id: model.db.ObjectId,
+        sock: fastapi.WebSocket,
+        binary: bool = False,
+        deltas: bool = False,
+        ready: bool = True,
+    ) -> SocketWriter:
         if lobby_id not in self.lobby_sockets:
             self.lobby_sockets[lobby_id] = []
         self.lobby_sockets[lobby_id].append(sock)
+        writer = self.writers[sock] = SocketWriter(
+            lobby_id, sock, self.policy, binary, deltas, ready
+        )
+        return writer
 
     def remove_connection(
         self, lobby_id: model.db.ObjectId, sock: fastapi.WebSocket
     ):
-        if lobby_id in self.lobby_sockets:
-            self.lobby_sockets[lobby_id].remove(sock)
+        """Forget a socket. Sockets may be removed more than once."""
+        sockets = self.lobby_sockets.get(lobby_id)
+        if sockets is not None and sock in sockets:
+            sockets.remove(sock)
+            if not sockets:
+                del self.lobby_sockets[lobby_id]
+        writer = self.writers.pop(sock, None)
+        if writer is not None:
+            writer.close()
 
-    async def send_message_to_lobby(self, lobby: model.db.Lobby, message: str):
-        """Send a string message to all players in a lobby."""
-        for sock in self.lobby_sockets.get(lobby.id, []):
-            if (
-                sock.application_state
-                == starlette.websockets.WebSocketState.CONNECTED
-            ):
-                await sock.send_text(message)
+    async def start(self) -> None:
+        """Subscribe to the broadcast backend, and start the heartbeat."""
+        await self.backend.start(self.deliver)
+        if PING_INTERVAL > 0:
+            self.heartbeat = asyncio.create_task(self._heartbeat())
+
+    async def stop(self) -> None:
+        if self.heartbeat is not None:
+            self.heartbeat.cancel()
+            self.heartbeat = None
+        for lobby_id in list(self.pending):
+            await self.flush(lobby_id)
+        await self.backend.stop()
+
+    async def _heartbeat(self) -> None:
+        """
+        Ping every socket, so that clients answer and stay clear of the idle
+        timeout, and remove the sockets whose writer has given up on them.
+        """
+        while True:
+            await asyncio.sleep(PING_INTERVAL)
+            for sock, writer in list(self.writers.items()):
+                if writer.task.done():
+                    metrics.websocket_closes.inc("dead")
+                    self.remove_connection(writer.lobby_id, sock)
+                else:
+                    writer.send(PING_MESSAGE)
+
+    def deliver(self, lobby_id: model.db.ObjectId, message: Message) -> None:
+        """
+        Queue a message for the sockets of a lobby held by this process.
+        Returns as soon as the message is queued, without waiting for it to
+        be delivered.
+        """
+        sockets = self.lobby_sockets.get(lobby_id, [])
+        disband = is_disband_message(message)
+        for sock in sockets:
+            writer = self.writers.get(sock)
+            if writer is not None:
+                writer.send(message)
+
+                # Nothing more will be sent for a disbanded lobby
+                if disband:
+                    metrics.websocket_closes.inc("disband")
+                    writer.finish()
+        metrics.broadcast_recipients.observe(len(sockets))
+
+    async def send_message_to_lobby(
+        self, lobby: model.db.Lobby, message: Message
+    ):
+        """
+        Send a message to all players in a lobby, through the broadcast
+        backend so that sockets held by other processes receive it too.
+        """
+        started = time.perf_counter()
+        await self.backend.publish(lobby.id, message)
+        metrics.broadcast_duration.observe(
+            time.perf_counter() - started, message.type
+        )
+
+    async def collect_metrics(self):
+        samples = [
+            (metrics.websockets, (), len(self.writers)),
+            (metrics.websocket_lobbies, (), len(self.lobby_sockets)),
+            (
+                metrics.websocket_queued_messages,
+                (),
+                sum(writer.queue.qsize() for writer in self.writers.values()),
+            ),
+        ]
+        if metrics.PER_LOBBY:
+            samples += [
+                (metrics.lobby_websockets, (str(lobby_id),), len(sockets))
+                for lobby_id, sockets in self.lobby_sockets.items()
+                if sockets
+            ]
+        return samples
 
     async def broadcast_update(
         self, lobby: model.db.Lobby, events: list[model.db.Event] = []
     ):
-        """Broadcast a new event to all players in a lobby"""
-        await self.send_message_to_lobby(
-            lobby, compose_update_message(lobby, events)
-        )
+        """
+        Broadcast a new event to all players in a lobby. If this process
+        broadcast the previous version of the lobby, a delta is included for
+        the sockets that accept them.
+
+        With a coalescing window, the update is merged into the pending
+        update of the lobby, which is sent when the window closes.
+        """
+        pending = self.pending.get(lobby.id)
+        if pending is None:
+            pending = PendingUpdate(lobby)
+        else:
+            metrics.broadcast_coalesced.inc()
+            pending.lobby = lobby
+        pending.events.extend(events)
+
+        if self.window <= 0:
+            await self._send_update(pending)
+        elif pending.task is None:
+            self.pending[lobby.id] = pending
+            pending.task = asyncio.create_task(self._flush_later(lobby.id))
+
+    async def _flush_later(self, lobby_id: model.db.ObjectId) -> None:
+        await asyncio.sleep(self.window)
+        pending = self.pending.pop(lobby_id, None)
+        if pending is not None:
+            await self._send_update(pending)
+
+    async def flush(self, lobby_id: model.db.ObjectId) -> None:
+        """Send the pending update of a lobby now, if there is one."""
+        pending = self.pending.pop(lobby_id, None)
+        if pending is None:
+            return
+        if pending.task is not None:
+            pending.task.cancel()
+        await self._send_update(pending)
+
+    async def _send_update(self, pending: PendingUpdate) -> None:
+        lobby = pending.lobby
+        message = compose_update_message(lobby, pending.events)
+        previous = self.lobby_states.get(lobby.id)
+        if previous is not None and previous.version == pending.base:
+            message.delta = compose_lobby_delta(
+                previous, lobby, pending.events
+            )
+        self.lobby_states.put(lobby)
+
+        await self.send_message_to_lobby(lobby, message)
 
     async def broadcast_disband(self, lobby: model.db.Lobby):
         """Broadcast a disband message to all players in a lobby."""
+        await self.flush(lobby.id)
+        self.lobby_states.invalidate(lobby.id)
         await self.send_message_to_lobby(lobby, compose_kick_message())
 
     async def broadcast_kick(
         self, lobby: model.db.Lobby, player: model.db.Player
     ):
         """Broadcast a message to kick a specific player to an entire lobby"""
+        await self.flush(lobby.id)
         await self.send_message_to_lobby(lobby, compose_kick_message(player))
 
 
-manager = ConnectionManager()
+manager = ConnectionManager(
+    SlowConsumerPolicy(os.environ.get("SLOW_CONSUMER_POLICY", "resync")),
+    broadcast.create_backend(),
+    window=float(os.environ.get("BROADCAST_WINDOW", 0)),
+)
+metrics.registry.add_collector(
+    manager.collect_metrics,
+    metrics.websockets,
+    metrics.websocket_lobbies,
+    metrics.websocket_queued_messages,
+    metrics.lobby_websockets,
+)
 
 
-@socketRouter.websocket("/events/{lobby_id}")
-async def socket_endpoint(websocket: fastapi.WebSocket, lobby_id: str):
-    # Accept the socket connection on a preliminary basis
-    await websocket.accept()
-
-    # Try to find the lobby by ID, and close the connection if not found
-    lobby = await model.db.Lobby.get_by_id(model.db.ObjectId(lobby_id))
-    if lobby is None:
-        await websocket.close()
+# Maximum number of events sent to a client that connects without a cursor
+HISTORY_WINDOW = 250
+
+# Maximum number of events sent in each update message while streaming history
+HISTORY_PAGE_SIZE = 50
+
+
+async def history_events(
+    lobby: model.db.Lobby, after: typing.Optional[model.db.ObjectId]
+) -> typing.AsyncIterator[dict[str, typing.Any]]:
+    """
+    The events a (re)connecting client should receive, in order.
+
+    If `after` refers to an event in this lobby, only the events that follow
+    it are returned. Otherwise, the most recent `HISTORY_WINDOW` events are.
+    """
+    storage = model.db.get_storage()
+
+    # Resume from the client's cursor, ordering by (time, _id)
+    position = (
+        await storage.event_position(lobby.id, after)
+        if after is not None
+        else None
+    )
+    if position is not None:
+        return storage.lobby_events(
+            lobby.id, after=position, batch_size=HISTORY_PAGE_SIZE
+        )
+    return storage.lobby_events(
+        lobby.id, last=HISTORY_WINDOW, batch_size=HISTORY_PAGE_SIZE
+    )
+
+
+async def send_history(
+    websocket: fastapi.WebSocket,
+    lobby: model.db.Lobby,
+    after: typing.Optional[model.db.ObjectId] = None,
+    binary: bool = False,
+) -> None:
+    """
+    Stream the lobby's event history to a socket in pages of
+    `HISTORY_PAGE_SIZE` events. The lobby state is always sent, even if there
+    are no new events.
+    """
+    page: list[model.db.Event] = []
+    sent = False
+    async for document in await history_events(lobby, after):
+        page.append(model.db.Event.parse_document(document))
+        if len(page) >= HISTORY_PAGE_SIZE:
+            await send_message(
+                websocket, compose_update_message(lobby, page), binary
+            )
+            page = []
+            sent = True
+
+    if page or not sent:
+        await send_message(
+            websocket, compose_update_message(lobby, page), binary
+        )
+
+
+def read_client_message(
+    message: typing.Mapping[str, typing.Any],
+) -> dict[str, typing.Any]:
+    """Decode a message received from a client, in either protocol."""
+    try:
+        if message.get("bytes") is not None:
+            data = helpers.unpackMessage(message["bytes"])
+        else:
+            data = json.loads(message.get("text") or "null")
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+async def send_snapshot(
+    websocket: fastapi.WebSocket, lobby_id: model.db.ObjectId
+) -> None:
+    """Queue a full update of the lobby, without events, for a socket."""
+    writer = manager.writers.get(websocket)
+    lobby = model.db.Lobby.cache.get(
+        lobby_id
+    ) or await model.db.Lobby.get_by_id(lobby_id)
+    if writer is None or lobby is None or lobby.disbanded:
         return
+    writer.send(compose_update_message(lobby, []))
+
+
+@socketRouter.websocket("/events/{lobby_id}")
+async def socket_endpoint(
+    websocket: fastapi.WebSocket,
+    lobby_id: str,
+    after: typing.Optional[str] = None,
+    deltas: bool = False,
+):
+    # Accept the socket connection on a preliminary basis. Clients that offer
+    # the MessagePack subprotocol are sent binary frames instead of JSON.
+    binary = helpers.MSGPACK_SUBPROTOCOL in websocket.scope.get(
+        "subprotocols", []
+    )
+    await websocket.accept(
+        subprotocol=helpers.MSGPACK_SUBPROTOCOL if binary else None
+    )
+
+    # Register the websocket to receive updates before reading the lobby and
+    # its history, so that no update is missed in between. Updates are held
+    # back until the history has been sent. Clients that pass `deltas`
+    # receive delta messages instead of the full lobby, when possible.
+    lobby_id = model.db.ObjectId(lobby_id)
+    writer = manager.register_connection(
+        lobby_id, websocket, binary, deltas, ready=False
+    )
+
+    try:
+        # Try to find the lobby by ID, and close the connection if not found
+        lobby = await model.db.Lobby.get_by_id(lobby_id)
+        if lobby is None:
+            return
+
+        # Begin by sending the events the client has not seen yet. Clients
+        # may pass the id of the last event they received as the `after`
+        # cursor. Events inserted while the history is read may be sent
+        # again with the held back updates, so clients ignore events they
+        # have already received.
+        await send_history(
+            websocket,
+            lobby,
+            (
+                model.db.ObjectId(after)
+                if after and model.db.ObjectId.is_valid(after)
+                else None
+            ),
+            binary,
+        )
+        writer.ready.set()
+
+        while True:
+            # Clients answer every ping, so a client that has sent nothing
+            # for a while is gone, even if the connection was never closed
+            try:
+                message = await asyncio.wait_for(
+                    websocket.receive(), IDLE_TIMEOUT or None
+                )
+            except asyncio.TimeoutError:
+                metrics.websocket_closes.inc("idle")
+                break
+
+            # Upon receiving disconnect, close the connection and return
+            if message["type"] == "websocket.disconnect":
+                break
 
-    # Begin by sending all the current events to the client
-    db = model.db.get_db()
-    events = [
-        model.db.Event.parse_document(e)
-        for e in await db[model.db.Event.collection]
-        .find({"lobby": lobby.id})
-        .sort("time", 1)
-        .to_list(None)
-    ]
-    await websocket.send_text(compose_update_message(lobby, events))
-
-    # Then register the websocket to receive future updates
-    manager.register_connection(lobby.id, websocket)
-
-    while True:
-        message = await websocket.receive()
-
-        # Upon receiving disconnect, close the connection and return
-        if message["type"] == "websocket.disconnect":
-            await websocket.close()
-            manager.remove_connection(lobby.id, websocket)
-            break
+            # Clients that missed a version ask for a snapshot of the lobby
+            if read_client_message(message).get("type") == "snapshot":
+                await send_snapshot(websocket, lobby.id)
+    finally:
+        manager.remove_connection(lobby_id, websocket)
+        await close_socket(websocket)
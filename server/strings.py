@@ -13,12 +13,18 @@ class Bundle(enum.Enum):
     ERROR_PLY_NOT_FOUND = "Player not found"
     ERROR_LOBBY_CODE_INVALID = "Lobby with this code does not exist"
     ERROR_LOBBY_FULL = "This lobby is full"
+    ERROR_LOBBY_CODES_EXHAUSTED = (
+        "There are no lobby codes available. Please try again later."
+    )
     ERROR_LOBBY_EXPIRED = "This lobby has expired"
     ERROR_LOBBY_INVALID = "Invalid lobby data"
+    ERROR_LOBBY_BUSY = "The lobby is busy. Please try again."
     ERROR_SESSION_INVALID = "Invalid session data"
+    ERROR_CURSOR_INVALID = "Invalid event history cursor"
     ERROR_TRANSFER_INVALID_SRC = "Invalid transfer source"
     ERROR_TRANSFER_FUNDS = "Insufficient funds"
     ERROR_TRANSFER_INVALID_DEST = "Invalid transfer destination"
+    ERROR_TRANSFER_INVALID_AMOUNT = "Invalid transfer amount"
     ERROR_INVALID_OPTIONS = "Invalid game options"
 
     # Event strings
@@ -51,6 +57,7 @@ class TransferEntity(enum.Enum):
     SELF = "__self__"
     BANK = "__bank__"
     FP = "__fp__"
+    ALL = "__all__"
 
 
 # Dictionary of the transfer entities
@@ -0,0 +1,170 @@
+# stdlib imports
+import datetime
+import typing
+
+# vendor imports
+
+# local imports
+from . import model, strings
+
+# An account is either a balance field on the lobby document ("bank" or
+# "freeParking") or the id of a player in the lobby.
+Account = typing.Union[str, model.db.ObjectId]
+
+
+def resolve_account(
+    entity: typing.Union[strings.TransferEntity, str], player: model.db.Player
+) -> Account:
+    """Resolve a decoded transfer entity into the account it refers to."""
+    if entity is strings.TransferEntity.SELF:
+        return player.id
+    elif entity is strings.TransferEntity.BANK:
+        return "bank"
+    elif entity is strings.TransferEntity.FP:
+        return "freeParking"
+    return model.db.ObjectId(entity)
+
+
+def apply_transfer(
+    lobby: model.db.Lobby, source: Account, destination: Account, amount: int
+) -> None:
+    """Apply a transfer to an in-memory lobby, without any checks."""
+    for account, change in ((source, -amount), (destination, amount)):
+        if isinstance(account, str):
+            setattr(lobby, account, getattr(lobby, account) + change)
+        else:
+            player = lobby.get_player(account)
+            assert player is not None
+            player.balance += change
+
+
+class TransferUpdate:
+    """
+    Accumulates one or more transfers into a single conditional update.
+
+    Balance changes are collected as `$inc` operations and the funds checks
+    are collected as conditions on the update filter, so that the whole batch
+    is validated and committed by the database in one round trip.
+    """
+
+    def __init__(self, lobby_id: model.db.ObjectId) -> None:
+        self.lobby_id = lobby_id
+        self.changes: dict[Account, int] = {}
+        self.conditions: list[dict[str, typing.Any]] = []
+        self.increments: dict[str, int] = {}
+        self.array_filters: list[dict[str, typing.Any]] = []
+        self._player_labels: dict[model.db.ObjectId, str] = {}
+        self._required: dict[Account, int] = {}
+
+    def _path(self, account: Account) -> str:
+        if isinstance(account, str):
+            return account
+
+        # Each distinct player gets their own array filter identifier
+        label = self._player_labels.get(account)
+        if label is None:
+            label = f"p{len(self._player_labels)}"
+            self._player_labels[account] = label
+            self.array_filters.append({f"{label}._id": account})
+            self.conditions.append({"players._id": account})
+        return f"players.$[{label}].balance"
+
+    def add(
+        self,
+        source: Account,
+        destination: Account,
+        amount: int,
+        check_funds: bool = True,
+    ) -> None:
+        """Add a transfer of `amount` from `source` to `destination`."""
+        source_path = self._path(source)
+        destination_path = self._path(destination)
+        self.increments[source_path] = (
+            self.increments.get(source_path, 0) - amount
+        )
+        self.increments[destination_path] = (
+            self.increments.get(destination_path, 0) + amount
+        )
+
+        # Transfers apply in order, so a checked account must start with the
+        # largest shortfall it reaches along the way. Funds it receives
+        # earlier in the batch can be spent later on.
+        self.changes[source] = self.changes.get(source, 0) - amount
+        if check_funds:
+            self._required[source] = max(
+                self._required.get(source, 0), -self.changes[source]
+            )
+        self.changes[destination] = self.changes.get(destination, 0) + amount
+
+    def requirements(self) -> dict[Account, int]:
+        """The funds each checked account must hold for the batch to apply."""
+        return {
+            account: amount
+            for account, amount in self._required.items()
+            if amount > 0
+        }
+
+    def query(
+        self, banker: typing.Optional[model.db.ObjectId] = None
+    ) -> dict[str, typing.Any]:
+        """
+        Compose the update filter. If `banker` is given, the update will only
+        apply while that player is still the banker of the lobby.
+        """
+        conditions = list(self.conditions)
+        for account, amount in self.requirements().items():
+            if isinstance(account, str):
+                conditions.append({account: {"$gte": amount}})
+            else:
+                conditions.append(
+                    {
+                        "players": {
+                            "$elemMatch": {
+                                "_id": account,
+                                "balance": {"$gte": amount},
+                            }
+                        }
+                    }
+                )
+
+        query: dict[str, typing.Any] = {
+            "_id": self.lobby_id,
+            "expires": {"$gt": datetime.datetime.utcnow()},
+            "disbanded": False,
+        }
+        if banker is not None:
+            query["banker"] = banker
+        if conditions:
+            query["$and"] = conditions
+        return query
+
+    async def commit(
+        self, banker: typing.Optional[model.db.ObjectId] = None
+    ) -> typing.Optional[model.db.Lobby]:
+        """
+        Atomically apply the accumulated transfers.
+
+        Returns the updated lobby, or None if any of the conditions (lobby
+        still active, accounts present, sufficient funds, banker) failed.
+        """
+        work = model.db.UnitOfWork(transaction=False)
+        work.apply_transfers(self, banker)
+        try:
+            await work.commit()
+        except model.db.WriteConflict:
+            return None
+        return work.lobby
+
+
+async def commit_transfer(
+    lobby: model.db.Lobby,
+    source: Account,
+    destination: Account,
+    amount: int,
+    check_funds: bool = True,
+    banker: typing.Optional[model.db.ObjectId] = None,
+) -> typing.Optional[model.db.Lobby]:
+    """Atomically apply a single transfer. See `TransferUpdate.commit`."""
+    update = TransferUpdate(lobby.id)
+    update.add(source, destination, amount, check_funds)
+    return await update.commit(banker)
@@ -55,12 +55,16 @@ export interface Lobby {
   freeParking: number;
   banker: ObjectId;
   players: Player[];
+  version: number;
 }
 
 // #region WebSocket message types
 export enum WSMessageType {
   Kick = 'kick',
   Update = 'update',
+  Delta = 'delta',
+  Resync = 'resync',
+  Ping = 'ping',
 }
 
 export interface WSKickMessage {
@@ -75,7 +79,34 @@ export interface WSUpdateMessage {
   };
 }
 
-export type WSMessage = WSKickMessage | WSUpdateMessage;
+export interface WSDeltaMessage {
+  type: WSMessageType.Delta;
+  payload: {
+    lobby: ObjectId;
+    base: number;
+    version: number;
+    fields: Partial<Lobby>;
+    added: Player[];
+    removed: ObjectId[];
+    balances: [ObjectId, number][];
+    events: Event[];
+  };
+}
+
+export interface WSResyncMessage {
+  type: WSMessageType.Resync;
+}
+
+export interface WSPingMessage {
+  type: WSMessageType.Ping;
+}
+
+export type WSMessage =
+  | WSKickMessage
+  | WSUpdateMessage
+  | WSDeltaMessage
+  | WSResyncMessage
+  | WSPingMessage;
 
 // #endregion
 
@@ -34,10 +34,10 @@ export async function makeRequest<REQ = any, RESP = any>(
     message = response.data;
   } catch (err) {
     if (typeof err === 'object') {
-      const axiosErr = err as AxiosError;
-      message = {
-        error: axiosErr.message,
-      };
+      const axiosErr = err as AxiosError<ServerMessage<RESP | undefined>>;
+      message = axiosErr.response?.data?.error
+        ? axiosErr.response.data
+        : { error: axiosErr.message };
     }
   }
 
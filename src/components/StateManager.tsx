@@ -25,6 +25,24 @@ function shouldReconnect() {
   return true;
 }
 
+// The server pings every socket, and closes those that stop answering
+function isPing(event: MessageEvent) {
+  if (typeof event.data !== 'string' || event.data.length > 64) {
+    return false;
+  }
+  try {
+    return JSON.parse(event.data).type === WSMessageType.Ping;
+  } catch {
+    return false;
+  }
+}
+
+// Every message is handled in onMessage, as it arrives. The last message is
+// not kept, since messages that arrive together would be rendered only once.
+function filterMessage() {
+  return false;
+}
+
 export function StateManager({ children }: PropsWithChildren) {
   // Reducer for handling all global actions
   const [globalState, globalStateDispatch] = useReducer(
@@ -32,63 +50,114 @@ export function StateManager({ children }: PropsWithChildren) {
     defaultGlobalState,
   );
 
-  // When a new socket is opened, wipe the events array.
+  // Sockets resume from the last event received, so the events are kept
+  // when a socket reconnects. Any event sent again is ignored.
   const socketOpenHandler = useCallback(() => {
     console.log('SOCKET OPENED');
-    globalStateDispatch({
-      type: GlobalStateAction.UPDATE_STATE,
-      state: { events: [] },
-    });
   }, []);
 
-  const socketUri = globalState.lobbyId
-    ? `${
-        (window.location.protocol === 'https:' ? 'wss://' : 'ws://') +
-        window.location.host
-      }/events/${globalState.lobbyId}`
-    : null;
-
-  const { lastJsonMessage } = useWebSocket(socketUri, {
-    onOpen: socketOpenHandler,
-    shouldReconnect,
-  });
+  const { events, lobbyId } = globalState;
+  const lastEventId = useRef<string>();
+  useEffect(() => {
+    lastEventId.current = events?.length
+      ? events[events.length - 1]._id.$oid
+      : undefined;
+  }, [events]);
+
+  // The URL is built on every (re)connection, with the resume cursor
+  const getSocketUri = useCallback(async () => {
+    const params = new URLSearchParams({ deltas: 'true' });
+    if (lastEventId.current) {
+      params.set('after', lastEventId.current);
+    }
+    return `${
+      (window.location.protocol === 'https:' ? 'wss://' : 'ws://') +
+      window.location.host
+    }/events/${lobbyId}?${params}`;
+  }, [lobbyId]);
 
   const currentPlayerId = useRef<string>();
   useEffect(() => {
     currentPlayerId.current = globalState.currentPlayer?._id.$oid;
   }, [globalState.currentPlayer]);
 
-  // When messages are received, decode them and store the data in the state
+  const lobbyVersion = useRef<number>();
   useEffect(() => {
-    if (lastJsonMessage) {
-      const message = lastJsonMessage as unknown as WSMessage;
-
-      // If a kick message was received, reset the state
-      if (message.type === WSMessageType.Kick) {
-        if (
-          !message.player ||
-          message.player?.$oid === currentPlayerId.current
-        ) {
-          globalStateDispatch({
-            type: GlobalStateAction.RESET_STATE,
-          });
-        }
-      }
+    lobbyVersion.current = globalState.lobby?.version;
+  }, [globalState.lobby]);
 
-      // If an update message was received, update the event and lobby state
-      else if (message.type === WSMessageType.Update) {
+  // When messages are received, decode them and store the data in the state
+  const socketMessageHandler = useCallback((event: MessageEvent) => {
+    const socket = event.target as WebSocket;
+
+    // The server pings every socket, and closes those that stop answering
+    if (isPing(event)) {
+      socket.send(JSON.stringify({ type: 'pong' }));
+      return;
+    }
+
+    let message: WSMessage;
+    try {
+      message = JSON.parse(event.data);
+    } catch {
+      return;
+    }
+
+    // If a kick message was received, reset the state
+    if (message.type === WSMessageType.Kick) {
+      if (!message.player || message.player?.$oid === currentPlayerId.current) {
         globalStateDispatch({
-          type: GlobalStateAction.ADD_EVENTS,
-          events: message.payload.events,
+          type: GlobalStateAction.RESET_STATE,
         });
+      }
+    }
+
+    // If an update message was received, update the event and lobby state
+    else if (message.type === WSMessageType.Update) {
+      globalStateDispatch({
+        type: GlobalStateAction.ADD_EVENTS,
+        events: message.payload.events,
+      });
+
+      lobbyVersion.current = message.payload.lobby.version;
+      globalStateDispatch({
+        type: GlobalStateAction.UPDATE_LOBBY,
+        lobby: message.payload.lobby,
+      });
+    }
 
+    // If a delta was received, apply it to the lobby if it follows on from
+    // the version we have. Otherwise, ask the server for a full snapshot.
+    else if (message.type === WSMessageType.Delta) {
+      globalStateDispatch({
+        type: GlobalStateAction.ADD_EVENTS,
+        events: message.payload.events,
+      });
+
+      if (lobbyVersion.current === message.payload.base) {
+        lobbyVersion.current = message.payload.version;
         globalStateDispatch({
-          type: GlobalStateAction.UPDATE_LOBBY,
-          lobby: message.payload.lobby,
+          type: GlobalStateAction.APPLY_LOBBY_DELTA,
+          delta: message.payload,
         });
+      } else {
+        socket.send(JSON.stringify({ type: 'snapshot' }));
       }
     }
-  }, [lastJsonMessage]);
+
+    // If the server fell behind sending to us, close the socket so that it
+    // reconnects and receives a fresh copy of the lobby state
+    else if (message.type === WSMessageType.Resync) {
+      socket.close();
+    }
+  }, []);
+
+  useWebSocket(lobbyId ? getSocketUri : null, {
+    onOpen: socketOpenHandler,
+    onMessage: socketMessageHandler,
+    filter: filterMessage,
+    shouldReconnect,
+  });
 
   // const [websocketConnection, setWebsocketConnection] = useState<WebSocket>();
 
@@ -129,13 +198,18 @@ export function StateManager({ children }: PropsWithChildren) {
 
       const resp = await makeRequest('get', '/api/preflight');
 
+      // The string bundles are served separately, from a cacheable URL
+      const stringsResp = resp.error
+        ? resp
+        : await makeRequest('get', resp.payload.stringsUrl);
+
       // If there is no error, set the data and player id and leave
       // the preloader going.
-      if (!resp.error) {
+      if (!resp.error && !stringsResp.error) {
         globalStateDispatch({
           type: GlobalStateAction.UPDATE_STATE,
           state: {
-            preflight: resp.payload,
+            preflight: { ...resp.payload, ...stringsResp.payload },
             lobbyId: resp.payload.lobbyId,
             playerId: resp.payload.playerId,
           },
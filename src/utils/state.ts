@@ -3,7 +3,7 @@
 import React, { createContext } from 'react';
 
 // local imports
-import { Event, Lobby, Player } from '../api/APITypes';
+import { Event, Lobby, Player, WSDeltaMessage } from '../api/APITypes';
 
 /** Typing for application global state. */
 export interface GlobalStateType {
@@ -30,6 +30,7 @@ export enum GlobalStateAction {
   PAGE_LOADING_START = 'PAGE_LOADING_START',
   PAGE_LOADING_STOP = 'PAGE_LOADING_STOP',
   UPDATE_LOBBY = 'UPDATE_LOBBY',
+  APPLY_LOBBY_DELTA = 'APPLY_LOBBY_DELTA',
   ADD_EVENTS = 'ADD_EVENTS',
 }
 
@@ -39,6 +40,10 @@ export type GlobalStateActionType =
   | { type: GlobalStateAction.PAGE_LOADING_START }
   | { type: GlobalStateAction.PAGE_LOADING_STOP }
   | { type: GlobalStateAction.UPDATE_LOBBY; lobby: Lobby }
+  | {
+      type: GlobalStateAction.APPLY_LOBBY_DELTA;
+      delta: WSDeltaMessage['payload'];
+    }
   | { type: GlobalStateAction.ADD_EVENTS; events: Event[] };
 
 // /** Payload for dispatching a global action. */
@@ -90,8 +95,53 @@ export const globalActionReducer: GlobalActionReducerMethod = (
         ),
       };
 
-    case GlobalStateAction.ADD_EVENTS:
-      return { ...state, events: [...(state.events ?? []), ...action.events] };
+    case GlobalStateAction.APPLY_LOBBY_DELTA: {
+      if (!state.lobby) {
+        return state;
+      }
+
+      const { delta } = action;
+      const removed = new Set(delta.removed.map((id) => id.$oid));
+      const balances = new Map(
+        delta.balances.map(([id, balance]) => [id.$oid, balance]),
+      );
+      const lobby: Lobby = {
+        ...state.lobby,
+        ...delta.fields,
+        version: delta.version,
+        players: [
+          ...state.lobby.players
+            .filter((ply) => !removed.has(ply._id.$oid))
+            .map((ply) => ({
+              ...ply,
+              balance: balances.get(ply._id.$oid) ?? ply.balance,
+            })),
+          ...delta.added,
+        ],
+      };
+
+      return {
+        ...state,
+        lobby,
+        currentPlayer: lobby.players.find(
+          (ply) => ply._id.$oid === state.playerId,
+        ),
+      };
+    }
+
+    // Events may be received twice when a socket connects, so events that
+    // are already known are skipped
+    case GlobalStateAction.ADD_EVENTS: {
+      const events = state.events ?? [];
+      const known = new Set(events.map((event) => event._id.$oid));
+      return {
+        ...state,
+        events: [
+          ...events,
+          ...action.events.filter((event) => !known.has(event._id.$oid)),
+        ],
+      };
+    }
 
     default:
       // eslint-disable-next-line no-console
@@ -0,0 +1,87 @@
+# stdlib imports
+import typing
+
+# vendor imports
+import httpx
+import pytest
+
+# local imports
+from server import model
+from server.main import app
+
+LOBBY_OPTIONS = {
+    "unlimitedBank": False,
+    "freeParking": True,
+    "maxPlayers": 8,
+    "bankBalance": 20580,
+    "startingBalance": 1500,
+    "currency": "$",
+}
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def storage() -> typing.AsyncIterator[model.storage.MemoryStorage]:
+    """A fresh in-memory storage engine, with the app started on it."""
+    model.db.storage_backend = "memory"
+    model.db._storage = None
+    await app.router.startup()
+    yield typing.cast(model.storage.MemoryStorage, model.db.get_storage())
+    await app.router.shutdown()
+
+
+class Player:
+    """A client of the API, with their own session cookie."""
+
+    def __init__(self) -> None:
+        self.http = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://test"
+        )
+        self.id: typing.Optional[model.db.ObjectId] = None
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.http.post(url, **kwargs)
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.http.get(url, **kwargs)
+
+    async def transfer(
+        self, source: str, destination: str, amount: int
+    ) -> httpx.Response:
+        return await self.post(
+            "/api/transfer",
+            json={
+                "source": source,
+                "destination": destination,
+                "amount": amount,
+            },
+        )
+
+
+@pytest.fixture
+async def players(storage) -> typing.AsyncIterator[list[Player]]:
+    """Four players in a new lobby. The first of them is the banker."""
+    players = [Player() for _ in range(4)]
+    response = await players[0].post("/api/create", json=LOBBY_OPTIONS)
+    code = response.json()["payload"]["code"]
+    for index, player in enumerate(players):
+        response = await player.post(
+            "/api/join", json={"code": code, "name": f"Player {index}"}
+        )
+        player.id = model.db.ObjectId(response.json()["payload"]["player"])
+    yield players
+    for player in players:
+        await player.http.aclose()
+
+
+async def get_lobby(players: list[Player]) -> model.db.Lobby:
+    """The stored state of the lobby of `players`."""
+    response = await players[0].get("/api/preflight")
+    lobby_id = model.db.ObjectId(response.json()["payload"]["lobbyId"])
+    lobby = await model.db.Lobby.get_by_id(lobby_id)
+    assert lobby is not None
+    return lobby
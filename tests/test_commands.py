@@ -0,0 +1,112 @@
+# vendor imports
+import pytest
+
+# local imports
+from server import actors, model, strings
+
+from .conftest import LOBBY_OPTIONS, Player, get_lobby
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def conflicting(storage, monkeypatch):
+    """Make every conditional write of a lobby conflict, once enabled."""
+
+    async def replace(collection, document, if_version=None, session=None):
+        return False
+
+    return lambda: monkeypatch.setattr(
+        storage, "replace", replace, raising=False
+    )
+
+
+async def test_busy_lobby_answers_join_with_conflict(players, conflicting):
+    response = await players[0].post("/api/create", json=LOBBY_OPTIONS)
+    code = response.json()["payload"]["code"]
+    conflicting()
+
+    player = Player()
+    response = await player.post(
+        "/api/join", json={"code": code, "name": "Late"}
+    )
+    await player.http.aclose()
+    assert response.status_code == 409
+    assert response.json()["error"] == strings.Bundle.ERROR_LOBBY_BUSY.name
+
+
+async def test_busy_lobby_answers_leave_with_conflict(players, conflicting):
+    conflicting()
+    response = await players[1].get("/api/leave")
+    assert response.status_code == 409
+    assert response.json()["error"] == strings.Bundle.ERROR_LOBBY_BUSY.name
+
+    # The player is still in the lobby, with their session
+    response = await players[1].get("/api/preflight")
+    assert response.json()["payload"]["playerId"] == str(players[1].id)
+
+
+async def test_join_lobby_stored_without_version(storage, players):
+    lobby = await get_lobby(players)
+    document = dict(storage.collections["lobbies"][lobby.id])
+    del document["version"]
+    storage.collections["lobbies"][lobby.id] = document
+    model.db.Lobby.cache.invalidate(lobby.id)
+    await actors.registry.stop()
+
+    player = Player()
+    response = await player.post(
+        "/api/join", json={"code": lobby.code, "name": "Late"}
+    )
+    await player.http.aclose()
+    assert response.json()["error"] is None
+    assert (await get_lobby(players)).version == 1
+
+
+def take_from_bank(context: actors.CommandContext) -> int:
+    context.lobby.bank -= 1
+    context.save()
+    return context.lobby.bank
+
+
+async def test_cancelled_caller_does_not_fail_batch(players):
+    lobby = await get_lobby(players)
+    first = actors.registry.submit(lobby.id, take_from_bank)
+
+    def cancel_first(context: actors.CommandContext) -> int:
+        # The caller of the first command gives up while the batch runs
+        first.cancel()
+        return take_from_bank(context)
+
+    second = actors.registry.submit(lobby.id, cancel_first)
+    assert await second == lobby.bank - 2
+    assert first.cancelled()
+    assert (await get_lobby(players)).bank == lobby.bank - 2
+
+
+async def test_command_of_cancelled_caller_is_skipped(players):
+    lobby = await get_lobby(players)
+    first = actors.registry.submit(lobby.id, take_from_bank)
+    second = actors.registry.submit(lobby.id, take_from_bank)
+    first.cancel()
+    assert await second == lobby.bank - 1
+
+
+async def test_rejection_rechecks_writes_of_other_processes(storage, players):
+    # The lobby actor holds the state of the lobby
+    response = await players[1].transfer("__self__", "__bank__", 10)
+    assert response.json()["error"] is None
+
+    # Another process adds a player, and funds a player's account
+    lobby = await get_lobby(players)
+    joined = model.db.Player(name="Elsewhere", balance=0)
+    lobby.players.append(joined)
+    lobby.players[2].balance += lobby.bank
+    lobby.bank = 0
+    lobby.version += 1
+    await storage.replace(model.db.Lobby.collection, lobby.document())
+
+    response = await players[1].transfer("__self__", str(joined.id), 5)
+    assert response.json()["error"] is None
+    response = await players[2].transfer("__self__", "__fp__", 5000)
+    assert response.json()["error"] is None
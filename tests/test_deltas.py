@@ -0,0 +1,95 @@
+# vendor imports
+import pytest
+
+# local imports
+from server import messages, model, socket
+
+from .conftest import get_lobby
+
+pytestmark = pytest.mark.anyio
+
+
+def next_version(lobby: model.db.Lobby, change: int) -> model.db.Lobby:
+    """The following version of a lobby, with `change` moved to the bank."""
+    lobby = lobby.clone()
+    lobby.players[0].balance -= change
+    lobby.bank += change
+    lobby.version += 1
+    return lobby
+
+
+class Recorder(socket.ConnectionManager):
+    """Connection manager that records the messages it sends."""
+
+    def __init__(self) -> None:
+        super().__init__(socket.SlowConsumerPolicy.RESYNC)
+        self.sent: list[messages.Message] = []
+
+    async def send_message_to_lobby(self, lobby, message) -> None:
+        self.sent.append(message)
+
+
+async def test_delta_carries_changes_from_base(players):
+    previous = await get_lobby(players)
+    lobby = next_version(previous, 10)
+
+    payload = messages.compose_lobby_delta(previous, lobby, []).documents()[
+        "payload"
+    ]
+    assert payload["base"] == previous.version
+    assert payload["version"] == lobby.version
+    assert payload["fields"] == {"bank": lobby.bank}
+    assert payload["balances"] == [
+        [lobby.players[0].id, lobby.players[0].balance]
+    ]
+    assert payload["added"] == [] and payload["removed"] == []
+
+
+async def test_update_has_delta_from_previous_broadcast(players):
+    manager = Recorder()
+    first = await get_lobby(players)
+    second = next_version(first, 10)
+
+    await manager.broadcast_update(first)
+    await manager.broadcast_update(second)
+
+    delta = manager.sent[1].delta
+    assert delta is not None
+    assert delta.documents()["payload"]["base"] == first.version
+
+
+async def test_update_has_no_delta_from_stale_base(players):
+    manager = Recorder()
+    first = await get_lobby(players)
+    second = next_version(first, 10)
+    third = next_version(second, 10)
+
+    # This process missed the second version, so its last state is stale
+    await manager.broadcast_update(first)
+    await manager.broadcast_update(third)
+
+    assert manager.sent[1].delta is None
+    assert manager.lobby_states.get(first.id) == third
+
+
+async def test_coalesced_update_has_delta_from_first_base(players):
+    manager = Recorder()
+    manager.window = 60
+    first = await get_lobby(players)
+    second = next_version(first, 10)
+    third = next_version(second, 10)
+
+    manager.lobby_states.put(first)
+    await manager.broadcast_update(second)
+    await manager.broadcast_update(third)
+    await manager.flush(first.id)
+
+    assert len(manager.sent) == 1
+    payload = manager.sent[0].delta.documents()["payload"]
+    assert (payload["base"], payload["version"]) == (
+        first.version,
+        third.version,
+    )
+    assert payload["balances"] == [
+        [third.players[0].id, third.players[0].balance]
+    ]
@@ -0,0 +1,121 @@
+# stdlib imports
+import datetime
+
+# vendor imports
+import pytest
+
+# local imports
+from server import model, strings
+
+from .conftest import get_lobby
+
+pytestmark = pytest.mark.anyio
+
+
+async def recount(lobby_id: model.db.ObjectId) -> model.db.Ledger:
+    """The ledger of a lobby, counted from its whole history."""
+    ledger = model.db.Ledger(_id=lobby_id)
+    ledger.apply(
+        [
+            model.db.Event.parse_document(document)
+            async for document in model.db.get_storage().lobby_events(lobby_id)
+        ]
+    )
+    return ledger
+
+
+def totals(ledger: model.db.Ledger):
+    return (ledger.events, ledger.transfers, ledger.accounts)
+
+
+async def make_transfers(players, count: int) -> None:
+    for index in range(count):
+        player = players[1 + index % 3]
+        response = await player.transfer("__self__", "__bank__", 10)
+        assert response.json()["error"] is None
+
+
+async def test_ledger_counts_events_older_than_it(storage, players):
+    lobby = await get_lobby(players)
+    await make_transfers(players, 3)
+
+    # As if the events were written before ledgers existed
+    await storage.drop_ledger(lobby.id)
+    await make_transfers(players, 3)
+
+    ledger = await model.db.Ledger.get_by_id(lobby.id)
+    assert ledger is not None
+    assert totals(ledger) == totals(await recount(lobby.id))
+    assert ledger.transfers == 6
+    assert ledger.accounts["bank"].received == 60
+
+
+async def test_ledger_endpoint_builds_missing_ledger(storage, players):
+    lobby = await get_lobby(players)
+    await make_transfers(players, 4)
+    await storage.drop_ledger(lobby.id)
+
+    response = await players[0].get("/api/ledger")
+    payload = response.json()["payload"]
+    expected = await recount(lobby.id)
+    assert (payload["events"], payload["transfers"]) == (
+        expected.events,
+        expected.transfers,
+    )
+    assert payload["accounts"]["bank"]["received"] == 40
+    assert await model.db.Ledger.get_by_id(lobby.id) is not None
+
+
+async def test_events_counted_by_build_are_not_recounted(storage, players):
+    lobby = await get_lobby(players)
+    await make_transfers(players, 2)
+    events = [
+        model.db.Event.parse_document(document)
+        async for document in storage.lobby_events(lobby.id, last=2)
+    ]
+
+    # The ledger is built while the last events are still being recorded
+    await storage.drop_ledger(lobby.id)
+    await model.db.Ledger.summarize(lobby.id)
+    await model.db.Ledger.record(events)
+
+    ledger = await model.db.Ledger.get_by_id(lobby.id)
+    assert ledger is not None
+    assert totals(ledger) == totals(await recount(lobby.id))
+
+
+async def test_events_recorded_out_of_order_are_counted(storage, players):
+    lobby = await get_lobby(players)
+    ledger = await model.db.Ledger.get_by_id(lobby.id)
+    assert ledger is not None
+
+    time = datetime.datetime.utcnow() + datetime.timedelta(minutes=1)
+    player = lobby.players[1]
+    earlier, later = (
+        model.db.Event(
+            lobby=lobby.id,
+            time=time + datetime.timedelta(seconds=offset),
+            key=strings.Bundle.EVENT_TRANSFER.name,
+            inserts=[
+                ["player", player.id],
+                ["currency", 5],
+                ["player", player.id],
+                ["bundle", strings.Bundle.TRANSFER_BANK.name],
+            ],
+        )
+        for offset in (0, 1)
+    )
+
+    # Two writers insert these concurrently, and the later is counted first
+    await storage.insert_many(
+        model.db.Event.collection, [earlier.document(), later.document()]
+    )
+    await model.db.Ledger.record([later])
+    await model.db.Ledger.record([earlier])
+
+    updated = await model.db.Ledger.get_by_id(lobby.id)
+    assert updated is not None
+    assert updated.events == ledger.events + 2
+    assert updated.accounts["bank"].received == 10
+    assert (updated.lastTime, updated.lastEvent) == (later.time, later.id)
+    assert totals(updated) == totals(await recount(lobby.id))
@@ -0,0 +1,23 @@
+# vendor imports
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_document_cache_metrics_are_exported(players):
+    # Authenticated requests read the lobby through the cache
+    await players[1].get("/api/ledger")
+
+    response = await players[0].get("/metrics")
+    lines = response.text.splitlines()
+    assert any(
+        line.startswith(
+            'lobbyopoly_document_cache_requests_total{cache="lobbies",'
+            'result="hit"}'
+        )
+        for line in lines
+    )
+    assert any(
+        line.startswith('lobbyopoly_document_cache_entries{cache="lobbies"} ')
+        for line in lines
+    )
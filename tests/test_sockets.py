@@ -0,0 +1,120 @@
+# stdlib imports
+import asyncio
+import json
+
+# vendor imports
+import pytest
+import starlette.websockets
+
+# local imports
+from server import model, socket
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeSocket:
+    """Socket that records the types of messages sent, and can be held up."""
+
+    def __init__(self, blocked: bool = False) -> None:
+        self.application_state = starlette.websockets.WebSocketState.CONNECTED
+        self.sent: list[str] = []
+        self.messages: list[dict] = []
+        self.unblocked = asyncio.Event()
+        if not blocked:
+            self.unblocked.set()
+
+    async def send_text(self, text: str) -> None:
+        await self.unblocked.wait()
+        self.messages.append(json.loads(text))
+        self.sent.append(self.messages[-1]["type"])
+
+    async def close(self) -> None:
+        self.application_state = (
+            starlette.websockets.WebSocketState.DISCONNECTED
+        )
+
+
+async def settle() -> None:
+    """Let the socket writers run."""
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+@pytest.fixture
+async def manager():
+    manager = socket.ConnectionManager(socket.SlowConsumerPolicy.RESYNC)
+    yield manager
+    for sock, writer in list(manager.writers.items()):
+        manager.remove_connection(writer.lobby_id, sock)
+
+
+async def test_slow_socket_does_not_hold_up_others(manager):
+    lobby_id = model.db.ObjectId()
+    slow, fast = FakeSocket(blocked=True), FakeSocket()
+    manager.register_connection(lobby_id, slow)
+    manager.register_connection(lobby_id, fast)
+
+    for index in range(3):
+        manager.deliver(lobby_id, socket.Message({"type": str(index)}))
+    await settle()
+
+    assert fast.sent == ["0", "1", "2"]
+    assert slow.sent == []
+
+    slow.unblocked.set()
+    await settle()
+    assert slow.sent == fast.sent
+
+
+async def test_full_queue_resyncs_socket(manager):
+    lobby_id = model.db.ObjectId()
+    slow = FakeSocket(blocked=True)
+    writer = manager.register_connection(lobby_id, slow)
+
+    for index in range(socket.SEND_QUEUE_SIZE + 2):
+        manager.deliver(lobby_id, socket.Message({"type": str(index)}))
+    assert writer.stalled
+
+    slow.unblocked.set()
+    await settle()
+    assert len(slow.sent) <= 2
+    assert slow.sent[-1] == "resync"
+
+
+async def test_socket_not_ready_buffers_messages(manager):
+    lobby_id = model.db.ObjectId()
+    sock = FakeSocket()
+    writer = manager.register_connection(lobby_id, sock, ready=False)
+
+    manager.deliver(lobby_id, socket.Message({"type": "update"}))
+    await settle()
+    assert sock.sent == []
+
+    writer.ready.set()
+    await settle()
+    assert sock.sent == ["update"]
+
+
+async def test_kick_messages_are_delivered(manager):
+    lobby_id = model.db.ObjectId()
+    sock = FakeSocket()
+    manager.register_connection(lobby_id, sock)
+    player = model.db.Player(name="Kicked", balance=0)
+
+    manager.deliver(lobby_id, socket.compose_kick_message(player))
+    await settle()
+    assert sock.messages == [
+        {"type": "kick", "player": {"$oid": str(player.id)}}
+    ]
+    assert (
+        sock.application_state == starlette.websockets.WebSocketState.CONNECTED
+    )
+
+    # A kick of every player disbands the lobby, closing the socket
+    manager.deliver(lobby_id, socket.compose_kick_message())
+    await settle()
+    assert sock.messages[-1] == {"type": "kick", "player": None}
+    assert (
+        sock.application_state
+        == starlette.websockets.WebSocketState.DISCONNECTED
+    )
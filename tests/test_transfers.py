@@ -0,0 +1,87 @@
+# stdlib imports
+import asyncio
+import random
+
+# vendor imports
+import pytest
+
+# local imports
+from server import actors, api, strings
+
+from .conftest import LOBBY_OPTIONS, get_lobby
+
+pytestmark = pytest.mark.anyio
+
+
+def total_funds(lobby) -> int:
+    return (
+        lobby.bank
+        + lobby.freeParking
+        + sum(player.balance for player in lobby.players)
+    )
+
+
+async def test_concurrent_transfers_conserve_funds(players):
+    lobby = await get_lobby(players)
+    assert total_funds(lobby) == LOBBY_OPTIONS["bankBalance"]
+
+    random.seed(0)
+    requests = []
+    for _ in range(200):
+        player = random.choice(players)
+        destination = random.choice(
+            ["__bank__", "__fp__"]
+            + [str(other.id) for other in players if other is not player]
+        )
+        requests.append(
+            player.transfer("__self__", destination, random.randint(1, 200))
+        )
+    responses = await asyncio.gather(*requests)
+    assert all(response.status_code == 200 for response in responses)
+
+    lobby = await get_lobby(players)
+    assert total_funds(lobby) == LOBBY_OPTIONS["bankBalance"]
+    assert all(player.balance >= 0 for player in lobby.players)
+
+
+async def test_concurrent_transfers_never_overdraw(players):
+    # 50 transfers of 100 from a balance of 1500: only 15 can be made
+    responses = await asyncio.gather(
+        *(players[1].transfer("__self__", "__bank__", 100) for _ in range(50))
+    )
+    errors = [response.json()["error"] for response in responses]
+    assert errors.count(None) == 15
+    assert set(errors) == {None, strings.Bundle.ERROR_TRANSFER_FUNDS.name}
+
+    lobby = await get_lobby(players)
+    player = next(ply for ply in lobby.players if ply.id == players[1].id)
+    assert player.balance == 0
+    assert total_funds(lobby) == LOBBY_OPTIONS["bankBalance"]
+
+
+@pytest.mark.parametrize("amount", [0, -100])
+async def test_transfer_rejects_non_positive_amount(players, amount):
+    lobby = await get_lobby(players)
+    response = await players[1].transfer(
+        "__self__", str(players[2].id), amount
+    )
+    assert response.status_code == 422
+    assert await get_lobby(players) == lobby
+
+    player = next(ply for ply in lobby.players if ply.id == players[1].id)
+    with pytest.raises(actors.CommandRejected) as raised:
+        api.planTransfer(
+            lobby,
+            player,
+            strings.TransferEntity.SELF,
+            str(players[2].id),
+            amount,
+        )
+    assert raised.value.error is strings.Bundle.ERROR_TRANSFER_INVALID_AMOUNT
+
+
+async def test_transfer_rejects_insufficient_funds(players):
+    lobby = await get_lobby(players)
+    response = await players[1].transfer("__self__", "__bank__", 1501)
+    assert response.json()["error"] == strings.Bundle.ERROR_TRANSFER_FUNDS.name
+    assert await get_lobby(players) == lobby